@@ -112,6 +112,10 @@ int main(int argc, char **argv) {
     startTimeMs = (1.0 * start.tv_sec * 1000000 + start.tv_usec) / 1000;
     endTimeMs = (1.0 * end.tv_sec * 1000000 + end.tv_usec) / 1000;
     costTime_map.insert(std::pair<double, double>(startTimeMs, endTimeMs));
+    if (i == 0) {
+      // shapes of the .bin outputs, read by postprocess.py instead of assuming them
+      WriteOutputMeta(outputs);
+    }
     WriteResult(all_files[i], outputs);
   }
   double average = 0.0;
@@ -62,6 +62,41 @@ int WriteResult(const std::string& imageFile, const std::vector<MSTensor> &outpu
   return 0;
 }
 
+std::string DataTypeName(DataType type) {
+  switch (type) {
+    case DataType::kNumberTypeFloat16:
+      return "float16";
+    case DataType::kNumberTypeInt32:
+      return "int32";
+    case DataType::kNumberTypeUInt8:
+      return "uint8";
+    default:
+      return "float32";
+  }
+}
+
+int WriteOutputMeta(const std::vector<MSTensor> &outputs) {
+  std::string metaFileName = "./result_Files/output_meta.json";
+  std::ofstream metaFile(metaFileName.c_str(), std::ios::trunc);
+  if (!metaFile.is_open()) {
+    std::cout << "Can not open " << metaFileName << std::endl;
+    return 1;
+  }
+  metaFile << "{\"outputs\": [";
+  for (size_t i = 0; i < outputs.size(); ++i) {
+    metaFile << (i == 0 ? "" : ", ") << "{\"name\": \"" << outputs[i].Name() << "\", \"dtype\": \""
+             << DataTypeName(outputs[i].DataType()) << "\", \"shape\": [";
+    auto shape = outputs[i].Shape();
+    for (size_t j = 0; j < shape.size(); ++j) {
+      metaFile << (j == 0 ? "" : ", ") << shape[j];
+    }
+    metaFile << "]}";
+  }
+  metaFile << "]}" << std::endl;
+  metaFile.close();
+  return 0;
+}
+
 mindspore::MSTensor ReadFileToTensor(const std::string &file) {
   if (file.empty()) {
     std::cout << "Pointer file is nullptr" << std::endl;
@@ -0,0 +1,1042 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Host side micro benchmarks, run e.g. `python benchmark.py --case decode`."""
+import sys
+import time
+import argparse
+import numpy as np
+
+
+def _timeit(func, repeat=3):
+    """Best wall time of `repeat` runs."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _fake_heads(batch, input_size=416, num_classes=2, seed=0):
+    """Random sigmoid-range head outputs shaped like DetectionBlock in inference mode."""
+    rng = np.random.RandomState(seed)
+    return [rng.random_sample((batch, input_size // stride, input_size // stride, 3, 5 + num_classes))
+            .astype(np.float32) for stride in (8, 16, 32)]
+
+
+def _legacy_decode(outputs, batch, image_shape, image_id, ignore_threshold):
+    """Reference per-box decode loop that DetectionEngine.detect used before the batched path."""
+    results = []
+    for batch_id in range(batch):
+        for out_item in outputs:
+            out_item_single = out_item[batch_id, :]
+            ori_w, ori_h = image_shape[batch_id]
+            img_id = int(image_id[batch_id])
+            x = (out_item_single[..., 0] * ori_w).reshape(-1)
+            y = (out_item_single[..., 1] * ori_h).reshape(-1)
+            w = (out_item_single[..., 2] * ori_w).reshape(-1)
+            h = (out_item_single[..., 3] * ori_h).reshape(-1)
+            conf = out_item_single[..., 4:5].reshape(-1)
+            cls_emb = out_item_single[..., 5:]
+            cls_argmax = np.argmax(cls_emb, axis=-1).reshape(-1)
+            cls_emb = cls_emb.reshape(-1, cls_emb.shape[-1])
+            x_top_left = x - w / 2.
+            y_top_left = y - h / 2.
+            flag = np.random.random(cls_emb.shape) > sys.maxsize
+            for i in range(flag.shape[0]):
+                flag[i, cls_argmax[i]] = True
+            confidence = cls_emb[flag] * conf
+            for x_lefti, y_lefti, wi, hi, confi, clsi in zip(x_top_left, y_top_left, w, h, confidence, cls_argmax):
+                if confi < ignore_threshold:
+                    continue
+                results.append([img_id, clsi, max(0, x_lefti), max(0, y_lefti), min(wi, ori_w), min(hi, ori_h), confi])
+    return results
+
+
+def bench_decode(ignore_threshold=0.001):
+    """Batched decode against the legacy per-box loop at batch 1/8/32."""
+    from src.util import decode_detections
+    for batch in (1, 8, 32):
+        outputs = _fake_heads(batch)
+        image_shape = np.tile(np.array([[1024, 1024]]), (batch, 1))
+        image_id = np.arange(batch)
+
+        legacy = np.array(_legacy_decode(outputs, batch, image_shape, image_id, ignore_threshold), np.float64)
+        img_ids, clsi, boxes, scores = decode_detections(outputs, image_shape, image_id, ignore_threshold)
+        batched = np.concatenate([img_ids[:, None], clsi[:, None], boxes, scores[:, None]], axis=-1)
+        assert batched.shape == legacy.shape and np.allclose(batched, legacy, rtol=1e-5, atol=1e-3), \
+            "batched decode does not match the legacy decode"
+
+        t_legacy = _timeit(lambda: _legacy_decode(outputs, batch, image_shape, image_id, ignore_threshold), 1)
+        t_batched = _timeit(lambda: decode_detections(outputs, image_shape, image_id, ignore_threshold))
+        print('decode batch {:>2}: legacy {:8.3f}s, batched {:8.4f}s, speedup {:6.1f}x'.format(
+            batch, t_legacy, t_batched, t_legacy / t_batched))
+
+
+def _fake_candidates(num, num_classes=2, size=1024, seed=0):
+    """Random clustered candidates as [x, y, w, h], scores and classes."""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, size, (max(num // 50, 1), 2))
+    xy = centers[rng.randint(0, centers.shape[0], num)] + rng.normal(0, 8, (num, 2))
+    wh = rng.uniform(10, 60, (num, 2))
+    boxes = np.concatenate([np.maximum(xy - wh / 2, 0), wh], axis=-1)
+    return boxes, rng.random_sample(num), rng.randint(0, num_classes, num)
+
+
+def bench_nms(threshold=0.5):
+    """Class-offset blocked NMS against the per-class greedy NMS, checks that both keep the same boxes."""
+    from src.nms import greedy_nms, batched_nms
+    for num in (1000, 5000, 20000):
+        boxes, scores, classes = _fake_candidates(num)
+
+        def legacy():
+            keep = []
+            for clsi in np.unique(classes):
+                index = np.nonzero(classes == clsi)[0]
+                dets = np.concatenate([boxes[index], scores[index, None]], axis=-1)
+                keep.extend(index[greedy_nms(dets, threshold)])
+            return keep
+
+        assert sorted(legacy()) == sorted(batched_nms(boxes, scores, classes, threshold).tolist()), \
+            "batched NMS does not match the greedy NMS"
+        for block_size in (64, 4096):
+            assert sorted(legacy()) == sorted(batched_nms(boxes, scores, classes, threshold,
+                                                          block_size=block_size).tolist())
+        t_legacy = _timeit(legacy)
+        t_batched = _timeit(lambda: batched_nms(boxes, scores, classes, threshold))
+        print('nms {:>5} candidates: greedy {:8.4f}s, batched {:8.4f}s, speedup {:6.1f}x'.format(
+            num, t_legacy, t_batched, t_legacy / t_batched))
+
+
+def bench_writers(num=1000000, chunk=2000):
+    """Result writers on a 1M box result set against one json.dump of a list of dicts."""
+    import os
+    import json
+    import tempfile
+    from src.detection_store import DetectionStore
+    from src.result_writer import RESULT_WRITERS, create_result_writer, load_results
+    rng = np.random.RandomState(0)
+    store = DetectionStore(num)
+    store.append(np.repeat(np.arange(num // 100), 100), rng.randint(1, 3, num),
+                 rng.uniform(0, 1024, (num, 4)), rng.random_sample(num))
+    with tempfile.TemporaryDirectory() as out_dir:
+        def legacy():
+            det_boxes = [{'image_id': int(store.image_ids[i]),
+                          'category_id': int(store.category_ids[i]),
+                          'bbox': list(store.boxes[i].astype(float)),
+                          'score': store.scores[i].astype(float)} for i in range(num)]
+            with open(os.path.join(out_dir, 'legacy.json'), 'w') as f:
+                json.dump(det_boxes, f)
+        print('writers {} boxes: legacy json.dump {:.2f}s'.format(num, _timeit(legacy, 1)))
+
+        for result_format in RESULT_WRITERS:
+            for background in (False, True):
+                blocked = []
+
+                def write():
+                    writer = create_result_writer(out_dir, result_format, background)
+                    start = time.perf_counter()
+                    for i in range(0, num, chunk):
+                        writer.write(store.image_ids[i:i + chunk], store.category_ids[i:i + chunk],
+                                     store.boxes[i:i + chunk], store.scores[i:i + chunk])
+                    blocked.append(time.perf_counter() - start)
+                    blocked.append(writer.close())
+                total = _timeit(write, 1)
+                path = blocked[-1]
+                t_load = _timeit(lambda: load_results(path), 1)
+                print('writers {} boxes: {:>6} {:>10} total {:.2f}s, blocking the caller {:.2f}s, '
+                      '{:.1f} MB, load {:.2f}s'.format(num, result_format,
+                                                      'background' if background else 'inline', total,
+                                                      blocked[-2], os.path.getsize(path) / 2 ** 20, t_load))
+                os.remove(path)
+
+
+def _graph_topk(dense, k, score_threshold):
+    """NumPy version of DetectionBlock.select_topk on a dense head output, [B, K, 6]."""
+    dense = dense.reshape(dense.shape[0], -1, dense.shape[-1])
+    box_class = np.argmax(dense[..., 5:], axis=-1)
+    scores = dense[..., 4] * np.max(dense[..., 5:], axis=-1)
+    scores = scores * (scores >= score_threshold)
+    k = min(k, scores.shape[1])
+    top_index = np.argsort(-scores, axis=-1, kind='stable')[:, :k]
+    top_scores = np.take_along_axis(scores, top_index, axis=-1)
+    top_boxes = np.take_along_axis(dense[..., :4], top_index[..., None], axis=1)
+    top_class = np.take_along_axis(box_class, top_index, axis=-1)
+    return np.concatenate([top_boxes, top_scores[..., None], top_class[..., None]], axis=-1).astype(np.float32)
+
+
+def bench_topk(batch=8, threshold=0.5, ignore_threshold=0.3):
+    """Host decode of in-graph top K outputs against the dense heads, checks the same boxes survive NMS."""
+    from src.nms import batched_nms
+    from src.util import decode_detections, decode_topk_detections
+    for input_size in (416, 1024):
+        dense = _fake_heads(batch, input_size)
+        image_shape = np.tile(np.array([[1024, 1024]]), (batch, 1))
+        image_id = np.arange(batch)
+
+        def finals(decoded):
+            img_ids, clsi, boxes, scores = decoded
+            kept = []
+            for img_id in np.unique(img_ids):
+                index = np.flatnonzero(img_ids == img_id)
+                keep = index[batched_nms(boxes[index], scores[index], clsi[index], threshold)]
+                kept.append(np.concatenate([img_ids[keep, None], clsi[keep, None], boxes[keep],
+                                            scores[keep, None]], axis=-1))
+            rows = np.concatenate(kept)
+            return rows[np.lexsort(rows.T[::-1])]
+
+        reference = finals(decode_detections(dense, image_shape, image_id, ignore_threshold))
+        # with K covering every candidate the top K path must keep exactly the same boxes
+        full = [_graph_topk(out, out[0].size, ignore_threshold) for out in dense]
+        assert np.allclose(finals(decode_topk_detections(full, image_shape, image_id, ignore_threshold)),
+                           reference, rtol=1e-6, atol=1e-3), "top K decode does not match the dense decode"
+
+        for k in (1000, 100):
+            topk = [_graph_topk(out, k, ignore_threshold) for out in dense]
+            t_dense = _timeit(lambda: decode_detections(dense, image_shape, image_id, ignore_threshold))
+            t_topk = _timeit(lambda: decode_topk_detections(topk, image_shape, image_id, ignore_threshold))
+            print('topk input {:>4} K {:>4}: device to host {:8.2f} MB -> {:6.2f} MB, host decode {:.4f}s -> '
+                  '{:.5f}s'.format(input_size, k, sum(out.nbytes for out in dense) / 2 ** 20,
+                                   sum(out.nbytes for out in topk) / 2 ** 20, t_dense, t_topk))
+
+
+def bench_export(batch=2, input_size=128, threshold=0.5, ignore_threshold=0.05, max_detections=100,
+                 latency_size=256, pre_nms_topk=1000, nms_topk=1000):
+    """YOLOV3EndToEnd on CPU against the head outputs postprocessed like DetectionEngine, needs MindSpore."""
+    import mindspore as ms
+    from src.yolo import YOLOV3DarkNet53, YOLOV3EndToEnd
+    from src.nms import batched_nms
+    from src.util import decode_detections
+    ms.set_context(mode=ms.GRAPH_MODE, device_target='CPU')
+    ms.set_seed(0)
+    rng = np.random.RandomState(0)
+    image = ms.Tensor(rng.normal(0, 1, (batch, 3, input_size, input_size)).astype(np.float32))
+    image_shape = np.tile(np.array([[1280., 720.]], np.float32), (batch, 1))
+    network = YOLOV3DarkNet53(is_training=False)
+    network.set_train(False)
+    # untrained heads score every box about the same, spread them so NMS order is not decided by ties
+    for param in network.get_parameters():
+        if '.conv6.' in param.name:
+            scale = 20. if param.name.endswith('weight') else 2.
+            param.set_data(ms.Tensor(rng.normal(0, scale, param.shape).astype(np.float32)))
+
+    output_big, output_me, output_small, seg_road = network(image)
+    outputs = [output_small.asnumpy(), output_me.asnumpy(), output_big.asnumpy()]
+    img_ids, clsi, boxes, scores = decode_detections(outputs, image_shape, np.arange(batch), ignore_threshold)
+
+    # K covering every box of the largest scale leaves the NMS input the same as on host
+    num_boxes = 3 * (input_size // 8) ** 2
+    end_to_end = YOLOV3EndToEnd(network, num_boxes, max_detections, threshold, ignore_threshold)
+    end_to_end.set_train(False)
+    detections, mask = end_to_end(image, ms.Tensor(image_shape))
+    detections = detections.asnumpy()
+    for block in (network.detect_1, network.detect_2, network.detect_3):
+        assert (block.topk, block.score_threshold) == (network.config.detect_topk,
+                                                       network.config.eval_ignore_threshold), \
+            "wrapping changed the detection blocks of the network"
+    dense = network(image)[0].asnumpy()
+    assert np.array_equal(dense, outputs[2]), "the network gives other outputs once wrapped"
+    assert np.array_equal(mask.asnumpy(), (seg_road.asnumpy() > 0.4).astype(np.uint8))
+    for b in range(batch):
+        index = np.flatnonzero(img_ids == b)
+        keep = index[batched_nms(boxes[index], scores[index], clsi[index], threshold)][:max_detections]
+        expected = np.concatenate([boxes[keep], scores[keep, None], clsi[keep, None]], axis=-1)
+        got = detections[b][detections[b, :, 4] > 0]
+        assert got.shape == expected.shape and np.allclose(got, expected, rtol=1e-4, atol=1e-2), \
+            "end to end model does not match DetectionEngine on image {}".format(b)
+        print('export end2end image {}: {} boxes match DetectionEngine, max abs diff {:.2e}'.format(
+            b, got.shape[0], np.abs(got - expected).max()))
+
+    # latency at the export defaults, global top K against NMS over every box kept per scale
+    image = ms.Tensor(rng.normal(0, 1, (batch, 3, latency_size, latency_size)).astype(np.float32))
+    per_scale = [min(pre_nms_topk, 3 * (latency_size // stride) ** 2) for stride in (8, 16, 32)]
+    for k in (0, nms_topk):
+        end_to_end = YOLOV3EndToEnd(network, pre_nms_topk, max_detections, threshold, ignore_threshold,
+                                    nms_topk=k)
+        end_to_end.set_train(False)
+        run = lambda: end_to_end(image, ms.Tensor(image_shape))[0].asnumpy()
+        # the first call compiles the graph
+        run()
+        print('export end2end {}px batch {}: {} boxes into NMS, {:.2f} s/batch'.format(
+            latency_size, batch, min(k or sum(per_scale), sum(per_scale)), _timeit(run, 2)))
+
+
+def _fake_coco(num_images, boxes_per_image=8, num_classes=2, size=1024, seed=0):
+    """Synthetic COCO ground truth and noisy detections of it as [N, 7] rows."""
+    import io
+    import contextlib
+    from pycocotools.coco import COCO
+    rng = np.random.RandomState(seed)
+    num = num_images * boxes_per_image
+    img_ids = np.repeat(np.arange(1, num_images + 1), boxes_per_image)
+    cats = rng.randint(1, num_classes + 1, num)
+    wh = rng.uniform(4, 200, (num, 2))
+    xy = rng.uniform(0, size - 200, (num, 2))
+    dataset = {'images': [{'id': i, 'file_name': '{}.tif'.format(i), 'width': size, 'height': size}
+                          for i in range(1, num_images + 1)],
+               'categories': [{'id': i, 'name': str(i)} for i in range(1, num_classes + 1)],
+               'annotations': [{'id': i + 1, 'image_id': int(img_ids[i]), 'category_id': int(cats[i]),
+                                'bbox': [xy[i, 0], xy[i, 1], wh[i, 0], wh[i, 1]], 'area': wh[i, 0] * wh[i, 1],
+                                'iscrowd': 0} for i in range(num)]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco = COCO()
+        coco.dataset = dataset
+        coco.createIndex()
+    # every box detected twice with jitter, plus a false positive per box
+    jitter = np.concatenate([xy, wh], axis=-1)[:, None, :] + rng.normal(0, 6, (num, 2, 4))
+    fake = np.concatenate([rng.uniform(0, size - 200, (num, 1, 2)), rng.uniform(4, 200, (num, 1, 2))], axis=-1)
+    boxes = np.concatenate([jitter, fake], axis=1).reshape(-1, 4)
+    boxes[:, 2:] = np.maximum(boxes[:, 2:], 1)
+    dets = np.concatenate([np.repeat(img_ids, 3)[:, None], boxes, rng.random_sample((num * 3, 1)),
+                           np.repeat(cats, 3)[:, None]], axis=-1)
+    return coco, dets
+
+
+def bench_cocoeval(num_images=10000, workers=(2, 4, 8)):
+    """Process pool COCOeval against the serial evaluate on a synthetic set, checks bit-identical results."""
+    import io
+    import contextlib
+    from pycocotools.cocoeval import COCOeval
+    from src.coco_eval import evaluate_in_parallel
+    coco, dets = _fake_coco(num_images)
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_dt = coco.loadRes(dets)
+
+    def run(num_workers):
+        coco_eval = COCOeval(coco, coco_dt, 'bbox')
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            evaluate_in_parallel(coco_eval, num_workers)
+            elapsed = time.perf_counter() - start
+            coco_eval.accumulate()
+            coco_eval.summarize()
+        return coco_eval, elapsed
+
+    serial, t_serial = run(1)
+    print('cocoeval {} images, {} detections: serial evaluate {:.2f}s'.format(num_images, dets.shape[0], t_serial))
+    for num_workers in workers:
+        parallel, t_parallel = run(num_workers)
+        for key in ('precision', 'recall', 'scores'):
+            assert np.array_equal(serial.eval[key], parallel.eval[key]), \
+                "parallel COCOeval {} differs from the serial run".format(key)
+        assert np.array_equal(serial.stats, parallel.stats)
+        print('cocoeval {} images: {} workers {:.2f}s, speedup {:5.1f}x'.format(
+            num_images, num_workers, t_parallel, t_serial / t_parallel))
+
+
+def _legacy_map_match(accumulator, k, gts, dt_boxes, dt_scores):
+    """The per threshold, per detection, per ground truth loop MapAccumulator used to match with."""
+    from pycocotools import mask as mask_utils
+    gt_ignore = np.array([bool(ann.get('iscrowd', 0)) for ann in gts], dtype=bool)
+    gt_order = np.argsort(gt_ignore, kind='mergesort')
+    gt_ignore = gt_ignore[gt_order]
+    gt_crowd = np.array([int(gts[g].get('iscrowd', 0)) for g in gt_order], dtype=np.uint8)
+    accumulator.num_gt[k] += int((~gt_ignore).sum())
+    if not dt_scores.shape[0]:
+        return
+    num_thresholds = accumulator.iou_thresholds.shape[0]
+    matched = np.zeros((num_thresholds, dt_scores.shape[0]), dtype=bool)
+    dt_ignore = np.zeros((num_thresholds, dt_scores.shape[0]), dtype=bool)
+    if gts:
+        gt_boxes = np.array([gts[g]['bbox'] for g in gt_order], dtype=np.float64)
+        ious = np.asarray(mask_utils.iou(dt_boxes, gt_boxes, gt_crowd)).reshape(dt_scores.shape[0], -1)
+        for t, threshold in enumerate(accumulator.iou_thresholds):
+            gt_taken = np.zeros(len(gts), dtype=bool)
+            for d in range(dt_scores.shape[0]):
+                best = min(threshold, 1 - 1e-10)
+                m = -1
+                for g in range(len(gts)):
+                    if gt_taken[g] and not gt_crowd[g]:
+                        continue
+                    if m > -1 and not gt_ignore[m] and gt_ignore[g]:
+                        break
+                    if ious[d, g] < best:
+                        continue
+                    best = ious[d, g]
+                    m = g
+                if m == -1:
+                    continue
+                dt_ignore[t, d] = gt_ignore[m]
+                matched[t, d] = True
+                gt_taken[m] = True
+    bins = np.minimum((np.clip(dt_scores, 0, 1) * accumulator.num_bins).astype(np.int64), accumulator.num_bins - 1)
+    for t in range(num_thresholds):
+        counted = ~dt_ignore[t]
+        np.add.at(accumulator.tp[t, k], bins[matched[t] & counted], 1)
+        np.add.at(accumulator.fp[t, k], bins[~matched[t] & counted], 1)
+
+
+def bench_running_map(num_images=2000, boxes_per_image=8, crowd_rate=0.1):
+    """Vectorized running mAP matching against the old Python loop, checks identical histograms."""
+    from src.map_accumulator import MapAccumulator
+    coco, dets = _fake_coco(num_images, boxes_per_image)
+    rng = np.random.RandomState(1)
+    for ann in coco.dataset['annotations']:
+        ann['iscrowd'] = int(rng.random_sample() < crowd_rate)
+    order = np.argsort(dets[:, 0], kind='mergesort')
+    split = np.flatnonzero(np.diff(dets[order, 0])) + 1
+    images = [dets[index] for index in np.split(order, split)]
+
+    def legacy():
+        accumulator = MapAccumulator(coco)
+        for det in images:
+            img_id = int(det[0, 0])
+            gts = accumulator._gt_by_category(img_id)  # pylint: disable=protected-access
+            accumulator.num_images += 1
+            for cat_id in set(gts) | set(det[:, 6].astype(np.int64).tolist()):
+                index = np.flatnonzero(det[:, 6] == cat_id)
+                index = index[np.argsort(-det[index, 5], kind='mergesort')][:accumulator.max_dets]
+                _legacy_map_match(accumulator, accumulator._cat_index[cat_id],  # pylint: disable=protected-access
+                                  gts.get(cat_id, []), det[index, 1:5], det[index, 5])
+        return accumulator
+
+    def vectorized():
+        accumulator = MapAccumulator(coco)
+        for det in images:
+            accumulator.update(int(det[0, 0]), det[:, 6].astype(np.int64), det[:, 1:5], det[:, 5])
+        return accumulator
+
+    reference, current = legacy(), vectorized()
+    for key in ('tp', 'fp', 'num_gt'):
+        assert np.array_equal(getattr(reference, key), getattr(current, key)), \
+            "vectorized running mAP {} differs from the loop".format(key)
+    t_legacy = _timeit(legacy, 1)
+    t_vectorized = _timeit(vectorized)
+    print('running map {} images, {} detections: loop {:.2f}s ({:.2f}ms/image), vectorized {:.2f}s '
+          '({:.2f}ms/image), speedup {:5.1f}x, AP {:.4f}'.format(
+              num_images, dets.shape[0], t_legacy, t_legacy * 1000 / num_images, t_vectorized,
+              t_vectorized * 1000 / num_images, t_legacy / t_vectorized, current.summary()['AP']))
+
+
+def bench_postprocess(num_images=300, input_size=416, workers=(1, 4, 8)):
+    """Memory-mapped pool postprocessing of offline .bin outputs against the serial np.fromfile + PIL loop."""
+    import os
+    import json
+    import types
+    import tempfile
+    from PIL import Image
+    from src.util import DetectionEngine
+    from src.infer_outputs import OUTPUT_META_FILE, postprocess_results
+    with tempfile.TemporaryDirectory() as root:
+        img_path, result_path = os.path.join(root, 'images'), os.path.join(root, 'result_Files')
+        os.makedirs(img_path)
+        os.makedirs(result_path)
+        images = []
+        for i in range(num_images):
+            stem = 'tile_{:06d}'.format(i + 1)
+            Image.new('RGB', (1024, 768)).save(os.path.join(img_path, stem + '.jpg'))
+            images.append({'id': i + 1, 'file_name': stem + '.jpg', 'width': 1024, 'height': 768})
+            heads = _fake_heads(1, input_size, seed=i)[::-1]
+            for j, head in enumerate(heads):
+                head.tofile(os.path.join(result_path, '{}_{}.bin'.format(stem, j)))
+        with open(os.path.join(result_path, OUTPUT_META_FILE), 'w') as f:
+            json.dump({'outputs': [{'name': str(j), 'dtype': 'float32', 'shape': list(head.shape)}
+                                   for j, head in enumerate(heads)]}, f)
+        ann_file = os.path.join(root, 'ann.json')
+        with open(ann_file, 'w') as f:
+            json.dump({'images': images, 'annotations': [],
+                       'categories': [{'id': 1, 'name': '1'}, {'id': 2, 'name': '2'}]}, f)
+        args = types.SimpleNamespace(eval_ignore_threshold=0.3, outputs_dir=root, annFile=ann_file, nms_thresh=0.5,
+                                     nms_pre_top_k=0, eval_streaming=True, cache_candidates=False,
+                                     result_format='json', coco_eval_workers=1, eval_running_map=False,
+                                     coco_cache=False)
+
+        def legacy():
+            engine = DetectionEngine(args)
+            for f in sorted(os.listdir(img_path)):
+                image_size = Image.open(os.path.join(img_path, f)).size
+                stem = f.split('.')[0]
+                outputs = [np.fromfile(os.path.join(result_path, '{}_{}.bin'.format(stem, j)), np.float32)
+                           .reshape(head.shape) for j, head in enumerate(heads)]
+                engine.detect(outputs[::-1], 1, [image_size], [int(stem.split('_')[-1])])
+            return engine.det_boxes.to_ndarray()
+
+        def pooled(num_workers):
+            engine = DetectionEngine(args)
+            postprocess_results(engine, result_path, num_workers)
+            return engine.det_boxes.to_ndarray()
+
+        reference = legacy()
+        t_legacy = _timeit(legacy, 1)
+        print('postprocess {} images: serial fromfile {:.2f}s'.format(num_images, t_legacy))
+        for num_workers in workers:
+            assert np.array_equal(pooled(num_workers), reference), "pooled postprocess does not match the legacy loop"
+            t_pooled = _timeit(lambda: pooled(num_workers), 1)
+            print('postprocess {} images: {} workers {:.2f}s, speedup {:5.1f}x'.format(
+                num_images, num_workers, t_pooled, t_legacy / t_pooled))
+
+
+def bench_annotation_index(num_images=20000):
+    """Per-sample pycocotools lookups against slicing the precompiled AnnotationIndex."""
+    from src.annotation_index import AnnotationIndex
+    coco, _ = _fake_coco(num_images)
+    cat_ids_to_continuous_ids = {v: i for i, v in enumerate(coco.getCatIds())}
+
+    def legacy(img_id):
+        annos = [anno for anno in coco.loadAnns(coco.getAnnIds(imgIds=img_id)) if anno["iscrowd"] == 0]
+        return [[x, y, x + w, y + h, cat_ids_to_continuous_ids[anno["category_id"]]]
+                for anno, (x, y, w, h) in ((anno, anno["bbox"]) for anno in annos)]
+
+    start = time.perf_counter()
+    index = AnnotationIndex.from_coco(coco)
+    t_build = time.perf_counter() - start
+    img_ids = sorted(coco.imgs.keys())
+    for img_id in img_ids:
+        expected = np.array(legacy(img_id), np.float32).reshape(-1, 5)
+        assert np.allclose(index.image_boxes(index.position(img_id)), expected), "index does not match pycocotools"
+        assert index.file_names[index.position(img_id)] == coco.imgs[img_id]['file_name'], "file name differs"
+    assert not index.image_boxes(0).flags.writeable, "image_boxes hands out a writable view of the index"
+    t_legacy = _timeit(lambda: [legacy(img_id) for img_id in img_ids], 1)
+    t_index = _timeit(lambda: [index.image_boxes(index.position(img_id)) for img_id in img_ids])
+    print('annotation index {} images: build {:.2f}s, per-sample lookups {:.2f}s -> {:.3f}s, speedup {:5.1f}x'.format(
+        num_images, t_build, t_legacy, t_index, t_legacy / t_index))
+
+
+def bench_folds(num_images=20003):
+    """Fold selection by one sorted join against a boolean scan of the fold table per image."""
+    from src.annotation_index import AnnotationIndex
+    from src.fold_manifest import FoldManifest, assign_folds
+    coco, _ = _fake_coco(num_images)
+    # an annotation file whose images are not sorted by id
+    np.random.RandomState(1).shuffle(coco.dataset['images'])
+    index = AnnotationIndex.from_coco(coco)
+    train_folds = {0, 1, 2, 3}
+    img_ids = index.img_ids.tolist()
+    # the id,fold table generate_csv wrote, contiguous runs in the order of the annotation file
+    fold_len = num_images // 5
+    csv_ids = np.array([im['id'] for im in coco.dataset['images']], np.int64)
+    csv_folds = np.arange(num_images) // fold_len
+
+    def legacy():
+        # what df[df['id'] == img_id]['fold'].tolist()[0] does for every image
+        return [img_id for img_id in img_ids if csv_folds[csv_ids == img_id][0] in train_folds]
+
+    def joined():
+        return FoldManifest(csv_ids, csv_folds).select(train_folds, img_ids)
+
+    expected = legacy()
+    assert expected == joined(), "manifest folds do not match the per-image scan"
+    folds = assign_folds(len(index), 5, image_order=index.image_order)
+    assert expected == FoldManifest(index.img_ids, folds).select(train_folds, img_ids), \
+        "assigned folds differ from generate_csv"
+    t_legacy = _timeit(legacy, 1)
+    t_joined = _timeit(joined)
+    print('folds {} images: per-image scan {:.2f}s, join {:.4f}s, speedup {:6.0f}x'.format(
+        num_images, t_legacy, t_joined, t_legacy / t_joined))
+    counts = np.diff(index.offsets)
+    stratified = assign_folds(len(index), 5, counts)
+    print('folds {} images: mean boxes per fold, contiguous {}, stratified {}'.format(
+        num_images, [round(float(counts[folds == f].mean()), 2) for f in range(5)],
+        [round(float(counts[stratified == f].mean()), 2) for f in range(5)]))
+
+
+def bench_coco_cache(num_images=50000, boxes_per_image=20):
+    """COCO(json) against the pickled cache and the in-process memo of load_coco."""
+    import os
+    import io
+    import json
+    import tempfile
+    import contextlib
+    from pycocotools.coco import COCO
+    from src.coco_cache import load_coco, clear_coco_cache
+    rng = np.random.RandomState(0)
+    num = num_images * boxes_per_image
+    xywh = rng.uniform(0, 500, (num, 4)).round(2).tolist()
+    dataset = {'images': [{'id': i, 'file_name': '{}.tif'.format(i), 'width': 1024, 'height': 1024}
+                          for i in range(1, num_images + 1)],
+               'categories': [{'id': 1, 'name': '1'}, {'id': 2, 'name': '2'}],
+               'annotations': [{'id': i + 1, 'image_id': i // boxes_per_image + 1, 'category_id': i % 2 + 1,
+                                'bbox': xywh[i], 'area': xywh[i][2] * xywh[i][3], 'iscrowd': 0}
+                               for i in range(num)]}
+    with tempfile.TemporaryDirectory() as root:
+        ann_file = os.path.join(root, 'ann.json')
+        with open(ann_file, 'w') as f:
+            json.dump(dataset, f)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t_json = _timeit(lambda: COCO(ann_file), 1)
+            clear_coco_cache()
+            load_coco(ann_file)
+            clear_coco_cache()
+            start = time.perf_counter()
+            coco = load_coco(ann_file)
+            t_pickle = time.perf_counter() - start
+            t_memo = _timeit(lambda: load_coco(ann_file))
+        assert coco.dataset == dataset and len(coco.imgToAnns) == num_images
+        print('coco cache {:.0f} MB json: COCO() {:.2f}s, pickled cache {:.2f}s, in-process {:.6f}s'.format(
+            os.path.getsize(ann_file) / 2 ** 20, t_json, t_pickle, t_memo))
+
+
+def bench_shards(num_images=2000, tile_kb=256, mask_size=512):
+    """Shard streaming against np.fromfile + cv2.imread of loose tiles and masks in random order."""
+    import os
+    import tempfile
+    import cv2
+    from src.annotation_index import AnnotationIndex
+    from src.shard_format import ShardWriter, ShardReader, ShardStream
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as root:
+        file_names = ['{:06d}.tif'.format(i) for i in range(num_images)]
+        for file_name in file_names:
+            with open(os.path.join(root, file_name), 'wb') as f:
+                f.write(rng.bytes(tile_kb << 10))
+            mask = np.zeros((mask_size, mask_size), np.uint8)
+            mask[:, rng.randint(mask_size):][:, :16] = 255
+            cv2.imwrite(os.path.join(root, file_name.replace('.tif', '.png')), mask)
+        index = AnnotationIndex(np.arange(num_images), file_names, np.zeros(num_images + 1, np.int64),
+                                np.zeros((0, 5), np.float32), np.ones(num_images, bool))
+        shard_dir = os.path.join(root, 'shards')
+        writer = ShardWriter(shard_dir, index, 64 << 20)
+        for file_name in file_names:
+            with open(os.path.join(root, file_name), 'rb') as f:
+                image_bytes = f.read()
+            writer.add(image_bytes, cv2.imread(os.path.join(root, file_name.replace('.tif', '.png')), -1))
+        writer.close()
+        reader = ShardReader(shard_dir)
+
+        def loose():
+            for i in rng.permutation(num_images).tolist():
+                img = np.fromfile(os.path.join(root, file_names[i]), dtype="int8")
+                mask = cv2.imread(os.path.join(root, file_names[i].replace('.tif', '.png')), -1)
+            return img, mask
+
+        def sharded():
+            for _, img, mask in ShardStream(reader, np.arange(num_images)):
+                pass
+            return img, mask
+
+        for position, img, mask in ShardStream(reader, np.arange(num_images), shuffle=False):
+            assert np.array_equal(img, np.fromfile(os.path.join(root, file_names[position]), dtype="int8"))
+            assert np.array_equal(mask, cv2.imread(os.path.join(root, file_names[position].replace('.tif', '.png')),
+                                                   -1)), "shard mask does not match the png"
+        # every rank yields len(stream) records each epoch, also when the last shard holds none of them
+        num_shards = len(reader.shard_files)
+        positions = np.concatenate([reader.shard_positions(shard) for shard in range(num_shards - 1)])
+        for epoch in range(3):
+            for rank in range(num_shards - 1):
+                stream = ShardStream(reader, positions, num_shards - 1, rank)
+                stream.epoch = epoch
+                assert sum(1 for _ in stream) == len(stream), "rank {} ran a short epoch".format(rank)
+        try:
+            ShardStream(reader, reader.shard_positions(0), 2, 0)
+            raise AssertionError("a rank was left without shards")
+        except ValueError:
+            pass
+        # the page cache serves both here, on network storage the gap is much larger
+        t_loose = _timeit(loose, 1)
+        t_sharded = _timeit(sharded, 1)
+        print('shards {} tiles: loose files {:.0f} samples/s, shards {:.0f} samples/s, {} shards'.format(
+            num_images, num_images / t_loose, num_images / t_sharded, len(reader.shard_files)))
+
+
+def _decode_tile(root, i):
+    """RGB tile and mask i of bench_tile_cache, decoded like COCOYoloDatasetWithSeg._load_decoded."""
+    import os
+    import cv2
+    img = cv2.cvtColor(cv2.imread(os.path.join(root, '{}.tif'.format(i)), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    return img, cv2.imread(os.path.join(root, '{}.png'.format(i)), -1)
+
+
+def bench_tile_cache(num_images=200, size=1024, epochs=3):
+    """Decoding tiles and masks every epoch against the tile cache, in the generator process like GeneratorDataset."""
+    import os
+    import tempfile
+    import cv2
+    from src.tile_cache import TileCache
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as root:
+        for i in range(num_images):
+            cv2.imwrite(os.path.join(root, '{}.tif'.format(i)), rng.randint(0, 255, (size, size, 3), np.uint8))
+            cv2.imwrite(os.path.join(root, '{}.png'.format(i)),
+                        (rng.random_sample((size, size)) > 0.9).astype(np.uint8) * 255)
+        tile_bytes = 4 * size * size
+
+        def run(cache):
+            for i in rng.permutation(num_images).tolist():
+                entry = cache.get(i) if cache is not None else None
+                if entry is None:
+                    entry = _decode_tile(root, i)
+                    if cache is not None:
+                        cache.put(i, *entry)
+
+        check = TileCache(4 * tile_bytes)
+        for i in range(8):
+            check.put(i, *_decode_tile(root, i))
+        assert check.stats()['evictions'] == 4 and check.get(0) is None, "least recently used tiles not evicted"
+        assert all(np.array_equal(a, b) for a, b in zip(check.get(7), _decode_tile(root, 7))), "cached tile differs"
+        # a cache holding every tile, and one holding half of them
+        for name, cache in (('decode', None), ('cache', TileCache(num_images * tile_bytes)),
+                            ('cache/2', TileCache(num_images * tile_bytes // 2))):
+            times = [_timeit(lambda: run(cache), 1) for _ in range(epochs)]
+            print('tile cache {} tiles of {}px: {:>7} epochs {}'.format(
+                num_images, size, name, ', '.join('{:.2f}s'.format(t) for t in times)))
+            if cache is not None:
+                print('tile cache: ' + cache.report())
+
+
+def bench_eval_decode(num_images=50, size=1024, input_size=(608, 608)):
+    """Eval input of a tile: fromfile + PIL open/resize + float64 normalize + transpose against one cv2 decode."""
+    import os
+    import tempfile
+    import cv2
+    from PIL import Image
+    from src.transforms import decode_eval_image
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as root:
+        paths = [os.path.join(root, '{}.tif'.format(i)) for i in range(num_images)]
+        for path in paths:
+            cv2.imwrite(path, rng.randint(0, 255, (size, size, 3), np.uint8))
+
+        def legacy(path):
+            np.fromfile(path, dtype="uint8")
+            img = Image.open(path).convert("RGB").resize((input_size[1], input_size[0]), Image.BICUBIC)
+            return _legacy_normalize(np.array(img)).astype(np.float32).transpose(2, 0, 1)
+
+        # without a resize both paths see the same pixels, only the float rounding differs
+        expected = _legacy_normalize(np.array(Image.open(paths[0]).convert("RGB")))
+        got, _ = decode_eval_image(paths[0])
+        assert np.abs(got - expected.transpose(2, 0, 1)).max() < 1e-5, "normalized tile differs"
+        t_legacy = _timeit(lambda: [legacy(path) for path in paths])
+        print('eval decode {} tiles of {}px to {}: legacy {:.2f} ms/tile'.format(
+            num_images, size, input_size, t_legacy * 1000 / num_images))
+        for reduce in (1, 2):
+            t = _timeit(lambda: [decode_eval_image(path, input_size, reduce) for path in paths])
+            print('eval decode reduce {}: cv2 {:.2f} ms/tile, {:.1f}x'.format(
+                reduce, t * 1000 / num_images, t_legacy / t))
+        # only JPEG decodes at a reduced resolution, the tif tiles above are decoded in full either way
+        jpeg_paths = [os.path.splitext(path)[0] + '.jpg' for path in paths]
+        for path, jpeg_path in zip(paths, jpeg_paths):
+            cv2.imwrite(jpeg_path, cv2.imread(path))
+        for reduce in (1, 2):
+            t = _timeit(lambda: [decode_eval_image(path, input_size, reduce) for path in jpeg_paths])
+            print('eval decode jpeg reduce {}: cv2 {:.2f} ms/tile'.format(reduce, t * 1000 / num_images))
+
+
+def bench_blank_tile(size=1024):
+    """Strided blank tile check against np.unique on textured, nodata and two valued tiles."""
+    from src.blank_tile import is_blank_tile
+    rng = np.random.RandomState(0)
+    textured = rng.randint(0, 255, (size, size, 3), np.uint8)
+    nodata = np.zeros((size, size, 3), np.uint8)
+    border = nodata.copy()
+    border[:, size // 3:] = 255
+    # one odd pixel the subsample misses, only the full scan finds it
+    speck = border.copy()
+    speck[size - 1, 1] = 7
+    for name, img in (('textured', textured), ('nodata', nodata), ('border', border), ('speck', speck)):
+        expected = np.unique(img).shape[0] <= 2
+        assert is_blank_tile(img) == expected, "blank check differs from np.unique on " + name
+        t_unique = _timeit(lambda: np.unique(img))
+        t_blank = _timeit(lambda: is_blank_tile(img))
+        print('blank tile {:>8} {}px: np.unique {:7.2f} ms, strided {:7.3f} ms, {:6.1f}x'.format(
+            name, size, t_unique * 1000, t_blank * 1000, t_unique / t_blank))
+
+
+def _legacy_true_boxes(true_boxes, anchors, in_shape, num_classes, max_boxes, label_smooth, label_smooth_factor):
+    """Reference per-box target loop that MultiScaleTrans ran for every image before the batched builder."""
+    anchors = np.array(anchors)
+    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+    true_boxes = np.array(true_boxes, dtype='float32')
+    input_shape = np.array(in_shape, dtype='int32')
+    boxes_xy = (true_boxes[..., 0:2] + true_boxes[..., 2:4]) // 2.
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    true_boxes[..., 0:2] = boxes_xy / input_shape[::-1]
+    true_boxes[..., 2:4] = boxes_wh / input_shape[::-1]
+    grid_shapes = [input_shape // 32, input_shape // 16, input_shape // 8]
+    y_true = [np.zeros((grid_shapes[l][0], grid_shapes[l][1], 3, 5 + num_classes), dtype='float32')
+              for l in range(3)]
+    anchors = np.expand_dims(anchors, 0)
+    wh = boxes_wh[boxes_wh[..., 0] > 0]
+    if wh.size > 0:
+        wh = np.expand_dims(wh, -2)
+        intersect_wh = np.maximum(np.minimum(wh / 2., anchors / 2.) - np.maximum(-wh / 2., -anchors / 2.), 0.)
+        intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+        iou = intersect_area / (wh[..., 0] * wh[..., 1] + anchors[..., 0] * anchors[..., 1] - intersect_area)
+        for t, n in enumerate(np.argmax(iou, axis=-1)):
+            for l in range(3):
+                if n in anchor_mask[l]:
+                    i = np.floor(true_boxes[t, 0] * grid_shapes[l][1]).astype('int32')
+                    j = np.floor(true_boxes[t, 1] * grid_shapes[l][0]).astype('int32')
+                    k = anchor_mask[l].index(n)
+                    c = true_boxes[t, 4].astype('int32')
+                    y_true[l][j, i, k, 0:4] = true_boxes[t, 0:4]
+                    y_true[l][j, i, k, 4] = 1.
+                    if label_smooth:
+                        y_true[l][j, i, k, 5:] = label_smooth_factor / (num_classes - 1)
+                        y_true[l][j, i, k, 5 + c] = 1 - label_smooth_factor
+                    else:
+                        y_true[l][j, i, k, 5 + c] = 1.
+    pad_gt_boxes = []
+    for l in range(3):
+        pad_gt_box = np.zeros(shape=[max_boxes, 4], dtype=np.float32)
+        gt_box = np.reshape(y_true[l][..., 0:4], [-1, 4])[np.reshape(y_true[l][..., 4:5], [-1]) == 1]
+        pad_gt_box[:gt_box.shape[0]] = gt_box
+        pad_gt_boxes.append(pad_gt_box)
+    return (*y_true, *pad_gt_boxes)
+
+
+def _fake_annos(batch, max_boxes=50, input_size=(416, 416), num_classes=2, seed=0):
+    """Padded [x_min, y_min, x_max, y_max, label] boxes as _data_aug returns them, valid boxes first."""
+    rng = np.random.RandomState(seed)
+    annos = np.zeros((batch, max_boxes, 5))
+    for b in range(batch):
+        num = rng.randint(0, max_boxes + 1)
+        xy = rng.uniform(0, min(input_size) - 80, (num, 2)).round()
+        # some boxes twice so that cells are shared
+        xy[num // 2:] = xy[:num - num // 2]
+        wh = rng.uniform(2, 80, (num, 2)).round()
+        annos[b, :num] = np.concatenate([xy, xy + wh, rng.randint(0, num_classes, (num, 1))], axis=-1)
+    return annos
+
+
+def bench_targets(batch=32, max_boxes=50, input_size=(608, 608), num_classes=2):
+    """Batched target builder against the per-image, per-box loop with label smoothing off and on."""
+    from src.transforms import _batch_true_boxes
+    anchors = [[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119], [116, 90], [156, 198], [373, 326]]
+    annos = _fake_annos(batch, max_boxes, input_size, num_classes)
+    for label_smooth in (False, True):
+        def legacy():
+            return [_legacy_true_boxes(anno, anchors, input_size, num_classes, max_boxes, label_smooth, 0.1)
+                    for anno in annos]
+
+        def batched():
+            return _batch_true_boxes(annos, anchors, input_size, num_classes, max_boxes, label_smooth, 0.1)
+
+        for expected, got in zip(zip(*legacy()), batched()):
+            assert np.array_equal(np.stack(expected), got), "batched targets differ, label_smooth {}".format(
+                label_smooth)
+        t_legacy = _timeit(legacy)
+        t_batched = _timeit(batched)
+        print('targets batch {} of {} boxes, label_smooth {:d}: loop {:.2f} ms, batched {:.2f} ms, {:.1f}x'.format(
+            batch, max_boxes, label_smooth, t_legacy * 1000, t_batched * 1000, t_legacy / t_batched))
+
+
+def _scatter_sparse_targets(rows, layer, grid_shape, num_classes, label_smooth, label_smooth_factor):
+    """NumPy counterpart of SparseTargets in src/yolo.py."""
+    in_scale = (rows[..., 0] == layer).astype(np.float32)
+    last = (rows[..., 9] * in_scale)[..., None]
+    cells = (rows[..., 1:4] * in_scale[..., None]).astype(np.int32)
+    classes = np.eye(num_classes, dtype=np.float32)[rows[..., 8].astype(np.int32)]
+    if label_smooth:
+        classes = (classes * (1 - label_smooth_factor) + (1 - classes) * label_smooth_factor / (num_classes - 1)) * last
+    else:
+        classes = classes * in_scale[..., None]
+    gt_box = rows[..., 4:8] * last
+    y_true = np.zeros((rows.shape[0],) + tuple(grid_shape) + (3, 5 + num_classes), np.float32)
+    batch_index = np.broadcast_to(np.arange(rows.shape[0])[:, None], rows.shape[:2])
+    np.add.at(y_true, (batch_index, cells[..., 0], cells[..., 1], cells[..., 2]),
+              np.concatenate([gt_box, last, classes], axis=-1))
+    if not label_smooth:
+        y_true[..., 5:] = np.minimum(y_true[..., 5:], 1.)
+    return y_true, gt_box
+
+
+def bench_sparse_targets(batch=32, max_boxes=50, input_size=(608, 608), num_classes=2):
+    """Sparse target rows against the dense grids: bytes per image, build time and the scattered result."""
+    import pickle
+    from src.transforms import _batch_true_boxes, _batch_sparse_targets
+    anchors = [[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119], [116, 90], [156, 198], [373, 326]]
+    annos = _fake_annos(batch, max_boxes, input_size, num_classes)
+    rows = _batch_sparse_targets(annos, anchors, input_size, max_boxes)
+    for label_smooth in (False, True):
+        dense = _batch_true_boxes(annos, anchors, input_size, num_classes, max_boxes, label_smooth, 0.1)
+        for layer in range(3):
+            y_true, gt_box = _scatter_sparse_targets(rows, layer, dense[layer].shape[1:3], num_classes,
+                                                     label_smooth, 0.1)
+            assert np.array_equal(y_true, dense[layer]), "scattered targets differ on layer {}".format(layer)
+            # same gt boxes per image, the order and padding do not matter to the best IoU
+            for b in range(batch):
+                kept = gt_box[b][gt_box[b].any(-1)]
+                packed = dense[3 + layer][b][dense[3 + layer][b].any(-1)]
+                assert np.array_equal(kept[np.lexsort(kept.T)], packed[np.lexsort(packed.T)])
+    dense_bytes = sum(target[0].nbytes for target in dense)
+    print('sparse targets {}x{}: dense {:.1f} KB, sparse {:.1f} KB per image, pickled batch {:.0f} KB / {:.0f} KB'
+          .format(input_size[0], input_size[1], dense_bytes / 1024, rows[0].nbytes / 1024,
+                  len(pickle.dumps([list(target) for target in dense])) / 1024, len(pickle.dumps(list(rows))) / 1024))
+    t_dense = _timeit(lambda: _batch_true_boxes(annos, anchors, input_size, num_classes, max_boxes, False, 0.1))
+    t_sparse = _timeit(lambda: _batch_sparse_targets(annos, anchors, input_size, max_boxes))
+    print('sparse targets batch {}: dense {:.2f} ms, sparse {:.2f} ms'.format(batch, t_dense * 1000, t_sparse * 1000))
+
+
+def _legacy_place_image(image, dx, dy, nw, nh, flip, input_w, input_h, interp):
+    """Reference PIL resize, gray canvas, paste and flip that _data_aug ran before the cv2 path."""
+    from PIL import Image
+    from src.transforms import pil_image_reshape
+    image = Image.fromarray(image).resize((nw, nh), pil_image_reshape(interp))
+    new_image = Image.new('RGB', (input_w, input_h), (128, 128, 128))
+    new_image.paste(image, (dx, dy))
+    if flip:
+        new_image = new_image.transpose(Image.FLIP_LEFT_RIGHT)
+    return np.array(new_image)
+
+
+def bench_data_aug(num=200, size=1024, input_size=(608, 608)):
+    """Per-sample geometry of _data_aug, PIL resize + paste + flip against cv2.resize + one slice copy."""
+    import random
+    import cv2
+    from src.transforms import _place_on_canvas, cv2_image_reshape
+    rng = np.random.RandomState(0)
+    input_h, input_w = input_size
+    # a smooth tile with some texture, like imagery, so resampling differences show up as they would
+    image = cv2.resize(rng.randint(0, 255, (size // 16, size // 16, 3), np.uint8), (size, size),
+                       interpolation=cv2.INTER_CUBIC)
+    image = cv2.add(image, rng.randint(0, 32, (size, size, 3), np.uint8))
+    random.seed(0)
+    # (dx, dy, nw, nh, flip, interp) drawn like _choose_candidate_by_constraints, offsets may be negative
+    samples = []
+    for _ in range(num):
+        nw = int(input_w * rng.uniform(0.25, 2))
+        nh = int(nw * rng.uniform(0.7, 1.3))
+        samples.append((int(rng.uniform(0, input_w - nw)), int(rng.uniform(0, input_h - nh)), nw, nh,
+                        rng.random_sample() < .5, random.randint(0, 4)))
+
+    # at native scale both paths move the same pixels
+    for flip in (False, True):
+        expected = _legacy_place_image(image, 13, -7, size, size, flip, input_w, input_h, 0)
+        got = _place_on_canvas(image, 13, -7, size, size, flip, input_w, input_h, cv2.INTER_NEAREST, (128, 128, 128))
+        assert np.array_equal(got, expected), "placed image differs from paste, flip {}".format(flip)
+    # the mask sees exactly the geometry of the image
+    mask = (rng.random_sample((size, size)) > 0.5).astype(np.uint8) * 255
+    for dx, dy, nw, nh, flip, _ in samples[:20]:
+        placed = _place_on_canvas(np.dstack([mask] * 3), dx, dy, nw, nh, flip, input_w, input_h,
+                                  cv2.INTER_NEAREST_EXACT, 0)
+        assert np.array_equal(_place_on_canvas(mask, dx, dy, nw, nh, flip, input_w, input_h,
+                                               cv2.INTER_NEAREST_EXACT, 0), placed[..., 0]), \
+            "mask geometry differs from the image"
+
+    def legacy(sample):
+        dx, dy, nw, nh, flip, interp = sample
+        return _legacy_place_image(image, dx, dy, nw, nh, flip, input_w, input_h, interp)
+
+    def place(sample):
+        dx, dy, nw, nh, flip, interp = sample
+        return _place_on_canvas(image, dx, dy, nw, nh, flip, input_w, input_h, cv2_image_reshape(interp),
+                                (128, 128, 128))
+
+    # resampling filters differ between PIL and cv2, so away from native scale only report the gap
+    diffs = [np.abs(legacy(sample).astype(np.int16) - place(sample)).mean() for sample in samples[:50]]
+    t_legacy = _timeit(lambda: [legacy(sample) for sample in samples])
+    t_place = _timeit(lambda: [place(sample) for sample in samples])
+    print('data aug {}px to {}: PIL {:.2f} ms/sample, cv2 {:.2f} ms/sample, {:.1f}x, '
+          'mean abs diff {:.2f} (max {:.2f})'.format(size, input_size, t_legacy * 1000 / num, t_place * 1000 / num,
+                                                     t_legacy / t_place, np.mean(diffs), np.max(diffs)))
+
+
+def _legacy_hsv_jitter(img, hue, sat, val):
+    """Reference float64 HSV jitter that color_distortion ran on whole images before the lookup table."""
+    import cv2
+    x = cv2.cvtColor(img, cv2.COLOR_RGB2HSV_FULL)
+    x = x / 255.
+    x[..., 0] += hue
+    x[..., 0][x[..., 0] > 1] -= 1
+    x[..., 0][x[..., 0] < 0] += 1
+    x[..., 1] *= sat
+    x[..., 2] *= val
+    x[x > 1] = 1
+    x[x < 0] = 0
+    x = x * 255.
+    return cv2.cvtColor(x.astype(np.uint8), cv2.COLOR_HSV2RGB_FULL)
+
+
+def bench_color_jitter(num=50, input_size=(608, 608)):
+    """HSV jitter of color_distortion, float64 masked passes against one cv2.LUT in uint8."""
+    import cv2
+    from src.transforms import _hsv_lut
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 255, input_size + (3,), np.uint8)
+    # hue both ways so the wrap around is hit, saturation and value scaled up and down
+    params = [(rng.uniform(-0.1, 0.1), rng.uniform(1 / 1.5, 1.5), rng.uniform(1 / 1.5, 1.5)) for _ in range(num)]
+
+    def lut(hue, sat, val):
+        x = cv2.LUT(cv2.cvtColor(img, cv2.COLOR_RGB2HSV_FULL), _hsv_lut(hue, sat, val))
+        return cv2.cvtColor(x, cv2.COLOR_HSV2RGB_FULL)
+
+    for hue, sat, val in params[:10]:
+        assert np.array_equal(lut(hue, sat, val), _legacy_hsv_jitter(img, hue, sat, val)), "LUT jitter differs"
+    t_legacy = _timeit(lambda: [_legacy_hsv_jitter(img, *p) for p in params])
+    t_lut = _timeit(lambda: [lut(*p) for p in params])
+    print('color jitter {}: float64 {:.2f} ms/sample, LUT {:.2f} ms/sample, {:.1f}x'.format(
+        input_size, t_legacy * 1000 / num, t_lut * 1000 / num, t_legacy / t_lut))
+
+
+def _legacy_normalize(img):
+    """Reference float64 statistic normalization that ran before the fused float32 kernel."""
+    img = img / 255.
+    mean = np.array([0.485, 0.456, 0.406])
+    std = np.array([0.229, 0.224, 0.225])
+    return (img - mean) / std
+
+
+def bench_normalize(batch=8, input_size=(608, 608)):
+    """Batch of augmented uint8 images to network input: float64 normalize + transpose + stack against
+    the fused float32 kernel into one CHW buffer, and the bytes shipped when the device normalizes."""
+    from src.transforms import normalize_chw, statistic_normalize_img
+    rng = np.random.RandomState(0)
+    imgs = [rng.randint(0, 255, input_size + (3,), np.uint8) for _ in range(batch)]
+
+    def legacy():
+        return np.stack([_legacy_normalize(img).astype('float32').transpose(2, 0, 1).copy() for img in imgs])
+
+    def fused():
+        out = np.empty((batch, 3) + input_size, np.float32)
+        for i, img in enumerate(imgs):
+            normalize_chw(img, out=out[i])
+        return out
+
+    expected = legacy()
+    assert np.abs(fused() - expected).max() < 1e-5, "fused normalization differs"
+    assert np.abs(statistic_normalize_img(imgs[0], True).transpose(2, 0, 1) - expected[0]).max() < 1e-5, \
+        "statistic_normalize_img differs"
+    t_legacy = _timeit(legacy)
+    t_fused = _timeit(fused)
+    t_uint8 = _timeit(lambda: np.stack(imgs))
+    print('normalize batch {} of {}: float64 {:.2f} ms, fused {:.2f} ms, {:.1f}x'.format(
+        batch, input_size, t_legacy * 1000, t_fused * 1000, t_legacy / t_fused))
+    print('normalize shipped bytes per batch: float32 CHW {:.1f} MB, uint8 HWC {:.1f} MB (stack {:.2f} ms)'.format(
+        expected.nbytes / 2 ** 20, np.stack(imgs).nbytes / 2 ** 20, t_uint8 * 1000))
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'nms': bench_nms,
+    'topk': bench_topk,
+    'export': bench_export,
+    'writers': bench_writers,
+    'cocoeval': bench_cocoeval,
+    'running_map': bench_running_map,
+    'postprocess': bench_postprocess,
+    'annotation_index': bench_annotation_index,
+    'folds': bench_folds,
+    'coco_cache': bench_coco_cache,
+    'shards': bench_shards,
+    'tile_cache': bench_tile_cache,
+    'eval_decode': bench_eval_decode,
+    'blank_tile': bench_blank_tile,
+    'targets': bench_targets,
+    'sparse_targets': bench_sparse_targets,
+    'data_aug': bench_data_aug,
+    'color_jitter': bench_color_jitter,
+    'normalize': bench_normalize,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="YOLOv3 host side benchmarks")
+    parser.add_argument("--case", type=str, default="all", choices=["all"] + list(BENCHMARKS.keys()))
+    args, unknown = parser.parse_known_args()
+    # the remaining arguments are left for model_utils.config, which parses sys.argv on import
+    sys.argv = sys.argv[:1] + unknown
+    for name, bench in BENCHMARKS.items():
+        if args.case in ("all", name):
+            bench()
@@ -24,6 +24,9 @@ from src.yolo import YOLOV3DarkNet53
 from src.logger import get_logger
 from src.yolo_dataset import create_yolo_dataset
 from src.util import DetectionEngine
+from src.eval_pipeline import EvalPipeline
+from src.coco_eval import format_metrics
+from src.candidate_cache import candidate_cache_key, candidate_cache_path, save_candidates
 import numpy as np
 from model_utils.config import config
 # only useful for huawei cloud modelarts.
@@ -50,12 +53,11 @@ def load_parameters(network, file_name):
     ms.load_param_into_net(network, param_dict_new)
     config.logger.info('load_model %s success', file_name)
 
-def get_iou(mask, pred_mask):
-    mask = mask>0.4
-    pred_mask = pred_mask>0.4
-    mask = mask.reshape(-1)
-    pred_mask = pred_mask.reshape(-1)
-    return np.mean(mask&pred_mask)
+def log_running_map(detection):
+    running_map = detection.running_map()
+    if running_map is not None:
+        config.logger.info('running mAP over {images} images: AP {AP:.3f}, AP50 {AP50:.3f}, '
+                           'AP75 {AP75:.3f}'.format(**running_map))
 
 @moxing_wrapper(pre_process=modelarts_pre_process)
 def run_test():
@@ -99,43 +101,44 @@ def run_test():
 
     # init detection engine
     detection = DetectionEngine(config)
-    iou_list = []
+    # decode, NMS and seg IoU of a batch run on worker threads while the next batch is inferred
+    pipeline = EvalPipeline(detection, config.per_batch_size, config.eval_pipeline_workers,
+                            config.eval_pipeline_queue)
     config.logger.info('Start inference....')
+    data_start = time.perf_counter()
     for i, data in enumerate(ds.create_dict_iterator(num_epochs=1)):
+        pipeline.timer.add('data', time.perf_counter() - data_start)
         image = data["image"]
         mask = data['masks']
         image_shape = data["image_shape"]
         image_id = data["img_id"]
 
-        output_big, output_me, output_small, pred_mask = network(image)
-        output_big = output_big.asnumpy()
-        output_me = output_me.asnumpy()
-        output_small = output_small.asnumpy()
-        image_id = image_id.asnumpy()
-        image_shape = image_shape.asnumpy()
-        # pred_mask = pred_mask.asnumpy()
-        mask = ms.Tensor(mask, dtype=ms.float32)
-        detection.detect([output_small, output_me, output_big], config.per_batch_size, image_shape, image_id)
-        
-        
-        mask = mask.squeeze(0).squeeze(0)
-        pred_mask = pred_mask.squeeze(0).squeeze(0)
-
-        
-        iou = get_iou(mask, pred_mask)
-        iou_list.append(iou)
+        with pipeline.timer('infer'):
+            output_big, output_me, output_small, pred_mask = network(image)
+        pipeline.submit([output_small, output_me, output_big], image_shape, image_id, mask, pred_mask)
         if i % 50 == 0:
             config.logger.info('Processing... {:.2f}% '.format(i / ds.get_dataset_size() * 100))
+            log_running_map(detection)
+        data_start = time.perf_counter()
 
+    iou_list = pipeline.close()
+    config.logger.info('stage timings: %s', pipeline.timer.report())
     config.logger.info('Calculating mAP...')
+    if config.cache_candidates:
+        key = candidate_cache_key(config.pretrained, config.annFile, config.data_root, config.test_img_shape)
+        cache_path = candidate_cache_path(config.candidate_cache_dir, key)
+        save_candidates(cache_path, detection.results, config.eval_ignore_threshold,
+                        meta={'checkpoint': config.pretrained, 'annFile': config.annFile})
+        config.logger.info('candidates cached for sweep.py: %s', cache_path)
     detection.do_nms_for_results()
+    log_running_map(detection)
     config.logger.info("average iou:{}".format(np.mean(np.array(iou_list))))
     result_file_path = detection.write_result()
     config.logger.info('result file path: %s', result_file_path)
     eval_result = detection.get_eval_result()
 
     cost_time = time.time() - start_time
-    eval_print_str = '\n=============coco eval result=========\n' + eval_result
+    eval_print_str = '\n=============coco eval result=========\n' + format_metrics(eval_result)
     config.logger.info(eval_print_str)
     config.logger.info('testing cost time %.2f h', cost_time / 3600.)
 
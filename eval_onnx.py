@@ -20,6 +20,7 @@ import mindspore as ms
 from src.logger import get_logger
 from src.yolo_dataset import create_yolo_dataset
 from src.util import DetectionEngine
+from src.coco_eval import format_metrics
 from model_utils.config import config
 
 def conver_testing_shape(args):
@@ -89,7 +90,7 @@ def run_test():
     eval_result = detection.get_eval_result()
 
     cost_time = time.time() - start_time
-    eval_print_str = '\n=============coco eval result=========\n' + eval_result
+    eval_print_str = '\n=============coco eval result=========\n' + format_metrics(eval_result)
     config.logger.info(eval_print_str)
     config.logger.info('testing cost time %.2f h', cost_time / 3600.)
 
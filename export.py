@@ -12,9 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ============================================================================
+import numpy as np
 import mindspore as ms
 
-from src.yolo import YOLOV3DarkNet53
+from src.yolo import YOLOV3DarkNet53, YOLOV3EndToEnd
 from model_utils.config import config
 from model_utils.moxing_adapter import moxing_wrapper, modelarts_export_preprocess
 
@@ -34,6 +35,18 @@ def run_export():
     shape = [config.batch_size, 3] + config.test_img_shape
     input_data = ms.numpy.zeros(shape, ms.float32)
 
+    if config.export_mode == "end2end":
+        if config.file_format == "ONNX":
+            # NMSWithMask has no ONNX export, eval_onnx.py postprocesses a raw export on host instead
+            raise ValueError("export_mode end2end supports MINDIR and AIR, export ONNX with export_mode raw.")
+        # decode, NMS and mask thresholding in the model, the second input is the original (w, h) of every image
+        network = YOLOV3EndToEnd(network, config.export_pre_nms_topk, config.export_max_detections,
+                                 config.nms_thresh, config.eval_ignore_threshold, config.export_mask_threshold,
+                                 config.export_nms_topk)
+        network.set_train(False)
+        image_shape = ms.Tensor(np.tile(np.array([config.test_img_shape[::-1]], np.float32), (config.batch_size, 1)))
+        ms.export(network, input_data, image_shape, file_name=config.file_name, file_format=config.file_format)
+        return
     ms.export(network, input_data, file_name=config.file_name, file_format=config.file_format)
 
 
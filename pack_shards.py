@@ -0,0 +1,48 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Pack the tiles, masks and boxes of data_root / seg_path / annFile into shards for ShardYoloDatasetWithSeg."""
+import os
+import cv2
+import numpy as np
+
+from src.coco_cache import load_coco
+from src.annotation_index import load_annotation_index
+from src.shard_format import ShardWriter
+from model_utils.config import config
+
+
+def pack_shards(data_root, seg_path, ann_file, shard_dir, shard_size):
+    """Write one record per annotated image, in annotation index order."""
+    index = load_annotation_index(load_coco(ann_file, config.coco_cache), ann_file, filter_crowd=True,
+                                  use_cache=config.annotation_index_cache)
+    writer = ShardWriter(shard_dir, index, shard_size)
+    for i, file_name in enumerate(index.file_names.tolist()):
+        with open(os.path.join(data_root, file_name), 'rb') as f:
+            image_bytes = f.read()
+        mask_path = os.path.join(seg_path, file_name.replace(".tif", ".png"))
+        mask, mask_bytes = None, None
+        if os.path.isfile(mask_path):
+            with open(mask_path, 'rb') as f:
+                mask_bytes = f.read()
+            mask = cv2.imdecode(np.frombuffer(mask_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
+        writer.add(image_bytes, mask, mask_bytes)
+        if (i + 1) % 1000 == 0:
+            print('packed {} / {} images'.format(i + 1, len(index)))
+    path = writer.close()
+    print('packed {} images into {} shards, index {}'.format(len(index), len(writer.shard_files), path))
+
+
+if __name__ == "__main__":
+    pack_shards(config.data_root, config.seg_path, config.annFile, config.shard_dir, config.shard_size_mb << 20)
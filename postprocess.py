@@ -15,15 +15,11 @@
 """YoloV3 postprocess."""
 import os
 import datetime
-import numpy as np
-from PIL import Image
 from src.util import DetectionEngine
+from src.coco_eval import format_metrics
+from src.infer_outputs import postprocess_results
 from model_utils.config import config
 
-def get_img_size(file_name):
-    img = Image.open(file_name)
-    return img.size
-
 if __name__ == "__main__":
     config.outputs_dir = os.path.join(config.log_path,
                                       datetime.datetime.now().strftime('%Y-%m-%d_time_%H_%M_%S'))
@@ -31,23 +27,12 @@ if __name__ == "__main__":
         os.makedirs(config.outputs_dir)
 
     detection = DetectionEngine(config)
-    bs = config.per_batch_size
-
-    f_list = os.listdir(config.img_path)
-    for f in f_list:
-        image_size = get_img_size(os.path.join(config.img_path, f))
-        f = f.split('.')[0]
-        output_big = np.fromfile(os.path.join(config.result_path, f + '_0.bin'), np.float32).reshape(bs, 13, 13, 3, 85)
-        output_me = np.fromfile(os.path.join(config.result_path, f + '_1.bin'), np.float32).reshape(bs, 26, 26, 3, 85)
-        output_small = np.fromfile(os.path.join(config.result_path,
-                                                f + '_2.bin'), np.float32).reshape(bs, 52, 52, 3, 85)
-        image_id = [int(f.split('_')[-1])]
-        image_shape = [[image_size[0], image_size[1]]]
-
-        detection.detect([output_small, output_me, output_big], bs, image_shape, image_id)
+    # output shapes come from the inference run and image sizes from the annotation
+    num_images = postprocess_results(detection, config.result_path, config.postprocess_workers)
+    print('postprocessed {} images from {}'.format(num_images, config.result_path))
 
     detection.do_nms_for_results()
     result_file_path = detection.write_result()
     eval_result = detection.get_eval_result()
 
-    print('\n=============coco eval result=========\n' + eval_result)
+    print('\n=============coco eval result=========\n' + format_metrics(eval_result))
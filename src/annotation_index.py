@@ -0,0 +1,153 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Precompiled per-image box index of a COCO annotation file."""
+import os
+import json
+import numpy as np
+
+
+class AnnotationIndex:
+    """
+    Boxes of every image of a COCO annotation as flat arrays.
+
+    All boxes live in one contiguous float32 [N_boxes, 5] array of [x_min, y_min, x_max, y_max, label],
+    label being the continuous class index, and the boxes of the i-th image are
+    boxes[offsets[i]:offsets[i + 1]]. Image ids, file names and a has-valid-box flag are kept per image.
+    There are no per-box Python objects, so forked dataset workers share the arrays copy-on-write
+    and looking up an image is a slice.
+
+    Args:
+        img_ids: Array of shape [N_images], image ids in index order.
+        file_names: Array of shape [N_images], file name of every image.
+        offsets: Array of shape [N_images + 1], start of the boxes of every image.
+        boxes: Array of shape [N_boxes, 5].
+        valid: Array of shape [N_images], whether an image has a box larger than one pixel, crowd included.
+        image_order: Array of shape [N_images], position of every image in the images list of the
+            annotation file. Default: None, the index order.
+    """
+    def __init__(self, img_ids, file_names, offsets, boxes, valid, image_order=None):
+        self.img_ids = np.asarray(img_ids, dtype=np.int64)
+        self.file_names = np.asarray(file_names, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 5)
+        # image_boxes hands out views of this array
+        self.boxes.flags.writeable = False
+        self.valid = np.asarray(valid, dtype=bool)
+        self.image_order = np.arange(self.img_ids.shape[0], dtype=np.int64) if image_order is None else \
+            np.asarray(image_order, dtype=np.int64)
+        self._positions = None
+
+    def __len__(self):
+        return self.img_ids.shape[0]
+
+    def position(self, img_id):
+        """Position of an image id in the index."""
+        if self._positions is None:
+            self._positions = {img_id: i for i, img_id in enumerate(self.img_ids.tolist())}
+        return self._positions[img_id]
+
+    def image_boxes(self, position):
+        """Read-only [k, 5] view of the boxes of the image at `position`."""
+        return self.boxes[self.offsets[position]:self.offsets[position + 1]]
+
+    @classmethod
+    def from_coco(cls, coco, filter_crowd=True):
+        """
+        Build the index from a loaded COCO in one pass over its annotations.
+
+        Args:
+            coco: COCO. Loaded annotation.
+            filter_crowd: Bool. Leave out crowd boxes. Default: True.
+        """
+        img_ids = np.array(sorted(coco.imgs.keys()), dtype=np.int64)
+        file_names = [coco.imgs[img_id]['file_name'] for img_id in img_ids.tolist()]
+        # the index is sorted by id, folds and the like follow the order of the annotation file
+        json_pos = {img['id']: i for i, img in enumerate(coco.dataset.get('images', []))}
+        image_order = np.argsort(np.argsort([json_pos[img_id] for img_id in img_ids.tolist()], kind='stable'))
+        cat_ids = np.asarray(coco.getCatIds(), dtype=np.int64)
+        anns = coco.dataset.get('annotations', [])
+        ann_img_ids = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+        ann_cat_ids = np.array([ann['category_id'] for ann in anns], dtype=np.int64)
+        crowd = np.array([ann.get('iscrowd', 0) for ann in anns], dtype=bool)
+        xywh = np.array([ann['bbox'] for ann in anns], dtype=np.float32).reshape(-1, 4)
+
+        image_pos = np.searchsorted(img_ids, ann_img_ids)
+        # an image has a valid annotation unless all its boxes are at most one pixel wide or high
+        valid = np.zeros(img_ids.shape[0], dtype=bool)
+        valid[image_pos[np.all(xywh[:, 2:] > 1, axis=-1)]] = True
+
+        keep = ~crowd if filter_crowd else np.ones(crowd.shape, dtype=bool)
+        # stable, so the boxes of an image keep their annotation order
+        order = np.flatnonzero(keep)[np.argsort(image_pos[keep], kind='stable')]
+        label_lut = np.full(int(cat_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+        label_lut[cat_ids] = np.arange(cat_ids.shape[0])
+        boxes = np.empty((order.shape[0], 5), dtype=np.float32)
+        boxes[:, :2] = xywh[order, :2]
+        boxes[:, 2:4] = xywh[order, :2] + xywh[order, 2:]
+        boxes[:, 4] = label_lut[ann_cat_ids[order]]
+        counts = np.bincount(image_pos[order], minlength=img_ids.shape[0])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(img_ids, file_names, offsets, boxes, valid, image_order)
+
+    def save(self, file_path, meta=None):
+        """Save as an uncompressed npz, written aside and renamed."""
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, img_ids=self.img_ids, file_names=self.file_names, offsets=self.offsets,
+                 boxes=self.boxes, valid=self.valid, image_order=self.image_order, meta=np.array(json.dumps(meta or {})))
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        """Load a saved index, returns (AnnotationIndex, meta dict)."""
+        with np.load(file_path) as data:
+            index = cls(data['img_ids'], data['file_names'], data['offsets'], data['boxes'], data['valid'],
+                        data['image_order'] if 'image_order' in data.files else None)
+            meta = json.loads(str(data['meta']))
+        return index, meta
+
+
+def annotation_index_path(ann_file, filter_crowd=True):
+    """Cache file of the index of an annotation file, next to it."""
+    return os.path.splitext(ann_file)[0] + ('.index.npz' if filter_crowd else '.index_crowd.npz')
+
+
+def load_annotation_index(coco, ann_file, filter_crowd=True, use_cache=True):
+    """
+    Index of an annotation file, loaded from its cache when the file is unchanged.
+
+    The cache is keyed by the size and mtime of the annotation file and rebuilt when either changes.
+    A cache that cannot be written, e.g. next to a read-only dataset, is skipped.
+
+    Args:
+        coco: COCO. The loaded annotation file.
+        ann_file: String. Path of the annotation file.
+        filter_crowd: Bool. Leave out crowd boxes. Default: True.
+        use_cache: Bool. Load and save the cache file. Default: True.
+    """
+    stat = os.stat(ann_file)
+    # format 2 added image_order, older caches are rebuilt
+    meta = {'size': stat.st_size, 'mtime': stat.st_mtime, 'filter_crowd': bool(filter_crowd), 'format': 2}
+    cache_path = annotation_index_path(ann_file, filter_crowd)
+    if use_cache and os.path.isfile(cache_path):
+        index, cached_meta = AnnotationIndex.load(cache_path)
+        if cached_meta == meta:
+            return index
+    index = AnnotationIndex.from_coco(coco, filter_crowd)
+    if use_cache:
+        try:
+            index.save(cache_path, meta)
+        except OSError:
+            pass
+    return index
@@ -0,0 +1,54 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Detection of blank / nodata tiles without sorting their pixels."""
+import numpy as np
+
+
+def _others(values, low, high):
+    """Values of an array that are neither low nor high."""
+    return values[(values != low) & (values != high)]
+
+
+def is_blank_tile(img, stride=16, rows=64):
+    """
+    Whether a tile holds at most two distinct values, e.g. nodata fill plus a border.
+
+    Same answer as np.unique(img).shape[0] <= 2 without the sort. A strided subsample gives the
+    candidate values first, any third value in it settles a textured tile at once. Only tiles the
+    subsample cannot tell apart are scanned in blocks of rows, stopping at the first third value.
+
+    Args:
+        img: Array of shape [H, W] or [H, W, C].
+        stride: Integer. Step of the subsample in both directions. Default: 16.
+        rows: Integer. Rows scanned per block. Default: 64.
+    """
+    img = np.asarray(img)
+    if not img.size:
+        return True
+    sample = img[::stride, ::stride].reshape(-1)
+    low, high = sample.min(), sample.max()
+    if _others(sample, low, high).shape[0]:
+        return False
+    for start in range(0, img.shape[0], rows):
+        others = _others(img[start:start + rows].reshape(-1), low, high)
+        if not others.shape[0]:
+            continue
+        if low != high:
+            return False
+        # the subsample was flat, the first other value is the second one allowed
+        high = others[0]
+        if _others(others, low, high).shape[0]:
+            return False
+    return True
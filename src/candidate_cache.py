@@ -0,0 +1,78 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""On-disk cache of decoded pre-NMS candidates, keyed by checkpoint and dataset."""
+import os
+import json
+import hashlib
+import numpy as np
+
+from .detection_store import DetectionStore
+
+
+def file_sha1(file_path, chunk_size=1 << 20):
+    """Sha1 hex digest of a file's content."""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def candidate_cache_key(checkpoint, ann_file, data_root, test_img_shape):
+    """Key of the candidates of a checkpoint on a dataset at a test shape."""
+    sha1 = hashlib.sha1()
+    sha1.update(file_sha1(checkpoint).encode())
+    sha1.update(file_sha1(ann_file).encode())
+    sha1.update(os.path.abspath(data_root).encode())
+    sha1.update(str(list(test_img_shape)).encode())
+    return sha1.hexdigest()
+
+
+def candidate_cache_path(cache_dir, key):
+    return os.path.join(cache_dir, 'candidates_' + key + '.npz')
+
+
+def save_candidates(file_path, store, ignore_threshold, meta=None):
+    """
+    Save the candidates of a DetectionStore as compressed columns.
+
+    Args:
+        file_path: String. Target .npz file.
+        store: DetectionStore. Decoded candidates before NMS.
+        ignore_threshold: Float. Score threshold the candidates were decoded with, sweeps can only go above it.
+        meta: Dict. Extra json serializable information kept with the cache. Default: None.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    meta = dict(meta or {}, ignore_threshold=float(ignore_threshold), num_candidates=len(store))
+    # write aside and rename, a crashed run never leaves a truncated cache behind
+    tmp_path = file_path + '.tmp.npz'
+    np.savez_compressed(tmp_path, image_ids=store.image_ids, category_ids=store.category_ids,
+                        boxes=store.boxes, scores=store.scores, meta=np.array(json.dumps(meta)))
+    os.replace(tmp_path, file_path)
+
+
+def load_candidates(file_path):
+    """
+    Load cached candidates.
+
+    Returns:
+        Tuple (DetectionStore, meta dict).
+    """
+    with np.load(file_path) as data:
+        scores = data['scores']
+        store = DetectionStore(max(scores.shape[0], 1))
+        store.append(data['image_ids'], data['category_ids'], data['boxes'], scores)
+        meta = json.loads(str(data['meta']))
+    return store, meta
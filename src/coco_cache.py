@@ -0,0 +1,93 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Parsed COCO annotations shared within a process and cached next to the JSON."""
+import os
+import pickle
+import threading
+from pycocotools.coco import COCO
+
+# (absolute path, size, mtime) -> COCO
+_LOADED = {}
+_LOCK = threading.Lock()
+
+
+def coco_cache_path(ann_file):
+    """Pickled COCO of an annotation file, next to it."""
+    return ann_file + '.coco.pkl'
+
+
+def _file_key(ann_file):
+    stat = os.stat(ann_file)
+    return os.path.abspath(ann_file), stat.st_size, stat.st_mtime
+
+
+def _load_pickled(cache_path, key):
+    """The pickled COCO when it was made from the same annotation file, else None."""
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            if tuple(pickle.load(f)) != key[1:]:
+                return None
+            return pickle.load(f)
+    except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+        # a truncated cache, or one pickled by another pycocotools or Python version, is rebuilt
+        return None
+
+
+def _save_pickled(cache_path, key, coco):
+    """Pickle the indexed COCO aside and rename it, skipped when the directory is read-only."""
+    tmp_path = cache_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(key[1:], f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(coco, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_coco(ann_file, use_cache=True):
+    """
+    COCO of an annotation file, parsed at most once per process.
+
+    Every caller asking for the same unchanged file gets the same instance, treat it as read-only.
+    With use_cache the indexed COCO is also pickled next to the JSON and loaded from there while
+    the JSON keeps its size and mtime, which skips both json parsing and createIndex.
+
+    Args:
+        ann_file: String. Path of the annotation JSON.
+        use_cache: Bool. Load and save the pickled COCO next to ann_file. Default: True.
+    """
+    key = _file_key(ann_file)
+    with _LOCK:
+        coco = _LOADED.get(key)
+        if coco is not None:
+            return coco
+        cache_path = coco_cache_path(ann_file)
+        coco = _load_pickled(cache_path, key) if use_cache else None
+        if coco is None:
+            coco = COCO(ann_file)
+            if use_cache:
+                _save_pickled(cache_path, key, coco)
+        _LOADED[key] = coco
+        return coco
+
+
+def clear_coco_cache():
+    """Forget the COCOs loaded in this process."""
+    with _LOCK:
+        _LOADED.clear()
@@ -0,0 +1,138 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""In-process COCO evaluation."""
+import io
+import os
+import copy
+import threading
+import contextlib
+import multiprocessing
+import numpy as np
+from pycocotools.cocoeval import COCOeval
+
+# name, (title, iou, area, max dets) of every entry of COCOeval.stats
+COCO_METRICS = (
+    ('AP', ('Average Precision', '0.50:0.95', 'all', 100)),
+    ('AP50', ('Average Precision', '0.50', 'all', 100)),
+    ('AP75', ('Average Precision', '0.75', 'all', 100)),
+    ('APs', ('Average Precision', '0.50:0.95', 'small', 100)),
+    ('APm', ('Average Precision', '0.50:0.95', 'medium', 100)),
+    ('APl', ('Average Precision', '0.50:0.95', 'large', 100)),
+    ('AR1', ('Average Recall', '0.50:0.95', 'all', 1)),
+    ('AR10', ('Average Recall', '0.50:0.95', 'all', 10)),
+    ('AR100', ('Average Recall', '0.50:0.95', 'all', 100)),
+    ('ARs', ('Average Recall', '0.50:0.95', 'small', 100)),
+    ('ARm', ('Average Recall', '0.50:0.95', 'medium', 100)),
+    ('ARl', ('Average Recall', '0.50:0.95', 'large', 100)),
+)
+
+
+# COCOeval shared with the forked workers of evaluate_in_parallel
+_SHARD_EVAL = None
+
+
+def _evaluate_shard(img_ids):
+    """Per-image evaluation of a shard of images, ordered [category][area][image] like COCOeval.evalImgs."""
+    coco_eval = _SHARD_EVAL
+    coco_eval.params.imgIds = img_ids
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval.evaluate()
+    return coco_eval.evalImgs
+
+
+def evaluate_in_parallel(coco_eval, workers=1):
+    """
+    Drop-in replacement of COCOeval.evaluate sharded by image id over a pool of forked processes.
+
+    Every image is evaluated independently, so the shards are merged back into the serial
+    [category][area][image] layout and accumulate() gives bit-identical results.
+
+    A forked child inherits every lock held by the other threads of the parent at fork time, so the
+    pool is only used from a single threaded process: close the EvalPipeline and the result writer
+    first. While other Python threads are alive the evaluation runs serially.
+
+    Args:
+        coco_eval: COCOeval. Evaluation with its ground truth and results loaded.
+        workers: Integer. Number of processes, 0 for one per cpu core, 1 runs serially. Default: 1.
+    """
+    global _SHARD_EVAL
+    workers = workers or os.cpu_count() or 1
+    p = coco_eval.params
+    img_ids = list(np.unique(p.imgIds))
+    if workers <= 1 or len(img_ids) < 2 * workers or 'fork' not in multiprocessing.get_all_start_methods() \
+            or threading.active_count() > 1:
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_eval.evaluate()
+        return
+
+    # a few shards per worker to even out images with many boxes
+    shards = [shard.tolist() for shard in np.array_split(np.array(img_ids, dtype=object), workers * 4)]
+    _SHARD_EVAL = coco_eval
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.map(_evaluate_shard, shards, chunksize=1)
+    finally:
+        _SHARD_EVAL = None
+
+    # the same normalized params as COCOeval.evaluate leaves behind
+    if p.useCats:
+        p.catIds = list(np.unique(p.catIds))
+    p.imgIds = img_ids
+    p.maxDets = sorted(p.maxDets)
+    num_blocks = (len(p.catIds) if p.useCats else 1) * len(p.areaRng)
+    eval_imgs = []
+    for block in range(num_blocks):
+        for shard, result in zip(shards, results):
+            eval_imgs.extend(result[block * len(shard):(block + 1) * len(shard)])
+    coco_eval.evalImgs = eval_imgs
+    coco_eval.eval = {}
+    coco_eval._paramsEval = copy.deepcopy(p)  # pylint: disable=protected-access
+
+
+def evaluate_detections(coco_gt, detections, iou_type='bbox', workers=1):
+    """
+    Evaluate detections against an already loaded ground truth.
+
+    Args:
+        coco_gt: COCO. Ground truth.
+        detections: Array of shape [N, 7], [image_id, x, y, w, h, score, category_id].
+        iou_type: String. COCOeval iou type. Default: 'bbox'.
+        workers: Integer. Processes of the per-image evaluation, see evaluate_in_parallel. Default: 1.
+
+    Returns:
+        Dict, metric name to value, see COCO_METRICS.
+    """
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 7)
+    if detections.shape[0] == 0:
+        # loadRes can not build an empty result set, nothing detected scores zero
+        return {name: 0.0 for name, _ in COCO_METRICS}
+    coco_dt = coco_gt.loadRes(detections)
+    coco_eval = COCOeval(coco_gt, coco_dt, iou_type)
+    # COCOeval prints its progress and the table it computes, the numbers are returned instead
+    with contextlib.redirect_stdout(io.StringIO()):
+        evaluate_in_parallel(coco_eval, workers)
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return {name: float(value) for (name, _), value in zip(COCO_METRICS, coco_eval.stats)}
+
+
+def format_metrics(metrics):
+    """Format metrics in the layout of COCOeval.summarize."""
+    lines = []
+    for name, (title, iou, area, max_dets) in COCO_METRICS:
+        short = '(AP)' if title.startswith('Average Precision') else '(AR)'
+        lines.append(' {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}'.format(
+            title, short, iou, area, max_dets, metrics[name]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,147 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Columnar storage of detection boxes."""
+import numpy as np
+
+
+class DetectionStore:
+    """
+    Growable column arrays of detections.
+
+    Every box is one row of image_ids (int64), category_ids (int32), boxes (float32 [x, y, w, h])
+    and scores (float32). Columns are preallocated and doubled when full, and a per-image offset
+    index is built lazily, so slicing one image or exporting everything never goes through per-box
+    Python objects.
+
+    Args:
+        capacity: Integer. Initial number of rows. Default: 1024.
+
+    Examples:
+        store = DetectionStore()
+        store.append(image_ids, category_ids, boxes, scores)
+    """
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._image_ids = np.zeros(capacity, dtype=np.int64)
+        self._category_ids = np.zeros(capacity, dtype=np.int32)
+        self._boxes = np.zeros((capacity, 4), dtype=np.float32)
+        self._scores = np.zeros(capacity, dtype=np.float32)
+        self._index = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def image_ids(self):
+        return self._image_ids[:self._size]
+
+    @property
+    def category_ids(self):
+        return self._category_ids[:self._size]
+
+    @property
+    def boxes(self):
+        return self._boxes[:self._size]
+
+    @property
+    def scores(self):
+        return self._scores[:self._size]
+
+    def _reserve(self, size):
+        """Grow every column to hold at least `size` rows, doubling the capacity."""
+        capacity = self._scores.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity = max(capacity * 2, 1)
+        for name in ('_image_ids', '_category_ids', '_boxes', '_scores'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def append(self, image_ids, category_ids, boxes, scores):
+        """Append detections, image_ids may be a scalar shared by all rows."""
+        scores = np.asarray(scores).reshape(-1)
+        num = scores.shape[0]
+        if num == 0:
+            return
+        self._reserve(self._size + num)
+        end = self._size + num
+        self._image_ids[self._size:end] = image_ids
+        self._category_ids[self._size:end] = category_ids
+        self._boxes[self._size:end] = np.asarray(boxes).reshape(num, 4)
+        self._scores[self._size:end] = scores
+        self._size = end
+        self._index = None
+
+    def extend(self, other):
+        """Append every detection of another store."""
+        self.append(other.image_ids, other.category_ids, other.boxes, other.scores)
+
+    def clear(self):
+        self._size = 0
+        self._index = None
+
+    def image_index(self):
+        """
+        Per-image offset index.
+
+        Returns:
+            Tuple (img_ids, offsets, order), rows order[offsets[i]:offsets[i + 1]] belong to img_ids[i].
+        """
+        if self._index is None:
+            order = np.argsort(self.image_ids, kind='stable')
+            img_ids, starts = np.unique(self.image_ids[order], return_index=True)
+            offsets = np.append(starts, self._size).astype(np.int64)
+            self._index = (img_ids, offsets, order)
+        return self._index
+
+    def image_slice(self, img_id):
+        """Category ids, boxes and scores of one image."""
+        img_ids, offsets, order = self.image_index()
+        i = np.searchsorted(img_ids, img_id)
+        if i == img_ids.shape[0] or img_ids[i] != img_id:
+            rows = order[:0]
+        else:
+            rows = order[offsets[i]:offsets[i + 1]]
+        return self.category_ids[rows], self.boxes[rows], self.scores[rows]
+
+    def iter_images(self):
+        """Yield (img_id, category_ids, boxes, scores) image by image."""
+        img_ids, offsets, order = self.image_index()
+        for i, img_id in enumerate(img_ids.tolist()):
+            rows = order[offsets[i]:offsets[i + 1]]
+            yield img_id, self.category_ids[rows], self.boxes[rows], self.scores[rows]
+
+    def filter(self, mask):
+        """New store holding the rows selected by a boolean mask or an index array."""
+        scores = self.scores[mask]
+        store = DetectionStore(max(scores.shape[0], 1))
+        store.append(self.image_ids[mask], self.category_ids[mask], self.boxes[mask], scores)
+        return store
+
+    def to_ndarray(self):
+        """Export as a [N, 7] float64 array of [image_id, x, y, w, h, score, category_id]."""
+        return np.concatenate([self.image_ids[:, None], self.boxes, self.scores[:, None],
+                               self.category_ids[:, None]], axis=-1).astype(np.float64)
+
+    def to_coco_list(self):
+        """Export as a list of COCO result dicts."""
+        return [{'image_id': img_id, 'category_id': category_id, 'bbox': bbox, 'score': score}
+                for img_id, category_id, bbox, score in zip(self.image_ids.tolist(),
+                                                            self.category_ids.tolist(),
+                                                            self.boxes.astype(np.float64).tolist(),
+                                                            self.scores.astype(np.float64).tolist())]
@@ -0,0 +1,130 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Eval pipeline overlapping device inference with host side postprocessing."""
+import time
+import queue
+import threading
+import contextlib
+import numpy as np
+
+
+def _asnumpy(value):
+    return value.asnumpy() if hasattr(value, 'asnumpy') else np.asarray(value)
+
+
+def seg_iou(mask, pred_mask):
+    """Foreground intersection of the ground truth and predicted masks over all pixels."""
+    mask = np.asarray(mask).reshape(-1) > 0.4
+    pred_mask = np.asarray(pred_mask).reshape(-1) > 0.4
+    return np.mean(mask & pred_mask)
+
+
+class StageTimer:
+    """Thread safe wall time totals per named stage."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}
+        self.counts = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        yield
+        self.add(stage, time.perf_counter() - start)
+
+    def report(self):
+        with self._lock:
+            return ', '.join('{} {:.2f}s ({:.1f}ms/batch)'.format(stage, total, total * 1000 / self.counts[stage])
+                             for stage, total in self.totals.items())
+
+
+class EvalPipeline:
+    """
+    Postprocess batches on worker threads while the next batch is inferred.
+
+    The main thread only launches the network and puts its output tensors on a bounded queue. Workers
+    copy them to host, decode and NMS them through the DetectionEngine and compute the seg IoU, so
+    batch N is postprocessed while batch N + 1 runs on device. The queue bounds the batches in flight.
+
+    Args:
+        detection: DetectionEngine. Receives the decoded batches, it must be thread safe.
+        batch_size: Integer. Images per batch.
+        num_workers: Integer. Postprocessing threads, 0 postprocesses inline on the calling thread. Default: 2.
+        max_queue: Integer. Batches waiting for a worker before submit blocks. Default: 4.
+
+    Examples:
+        pipeline = EvalPipeline(detection, batch_size)
+        pipeline.submit([output_small, output_me, output_big], image_shape, image_id, mask, pred_mask)
+        iou_list = pipeline.close()
+    """
+    def __init__(self, detection, batch_size, num_workers=2, max_queue=4):
+        self.detection = detection
+        self.batch_size = batch_size
+        self.timer = StageTimer()
+        self.iou_list = []
+        self._error = None
+        self._queue = queue.Queue(max(max_queue, 1))
+        self._workers = [threading.Thread(target=self._run, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _process(self, outputs, image_shape, image_id, mask, pred_mask):
+        with self.timer('fetch'):
+            outputs = [_asnumpy(output) for output in outputs]
+            image_shape = _asnumpy(image_shape)
+            image_id = _asnumpy(image_id)
+        with self.timer('detect'):
+            self.detection.detect(outputs, self.batch_size, image_shape, image_id)
+        with self.timer('seg_iou'):
+            iou = seg_iou(_asnumpy(mask), _asnumpy(pred_mask))
+        # list.append is atomic
+        self.iou_list.append(iou)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    self._process(*item)
+                except Exception as e:  # pylint: disable=broad-except
+                    self._error = e
+
+    def submit(self, outputs, image_shape, image_id, mask, pred_mask):
+        """Queue the device outputs of one batch, blocks while max_queue batches are waiting."""
+        if self._error is not None:
+            raise self._error
+        if not self._workers:
+            self._process(outputs, image_shape, image_id, mask, pred_mask)
+            return
+        with self.timer('queue_wait'):
+            self._queue.put((outputs, image_shape, image_id, mask, pred_mask))
+
+    def close(self):
+        """Wait for every queued batch, returns the seg IoU of every batch."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self._error is not None:
+            raise self._error
+        return self.iou_list
@@ -0,0 +1,140 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Fold / split manifest of the images of an annotation file."""
+import os
+import csv
+import hashlib
+import numpy as np
+
+from .candidate_cache import file_sha1
+
+
+def assign_folds(num_images, fold_num=5, box_counts=None, image_order=None):
+    """
+    Fold of every image.
+
+    Without box counts the images are cut into fold_num contiguous runs in image_order, the
+    remainder going to the last fold. With box counts the images are ranked by their number of
+    boxes and dealt out round robin, so every fold gets the same spread of crowded and empty tiles.
+
+    Args:
+        num_images: Integer. Number of images.
+        fold_num: Integer. Number of folds. Default: 5.
+        box_counts: Array of shape [num_images], boxes per image to stratify by. Default: None.
+        image_order: Array of shape [num_images], position of every image in the run order, e.g. the
+            order of the annotation file like the old generate_csv. Default: None, the index order.
+
+    Returns:
+        Array of shape [num_images], int64 fold of every image.
+    """
+    if box_counts is None:
+        fold_len = max(num_images // fold_num, 1)
+        order = np.arange(num_images, dtype=np.int64) if image_order is None else np.asarray(image_order, np.int64)
+        return np.minimum(order // fold_len, fold_num - 1)
+    folds = np.empty(num_images, dtype=np.int64)
+    folds[np.argsort(np.asarray(box_counts), kind='stable')] = np.arange(num_images) % fold_num
+    return folds
+
+
+def join_folds(img_ids, csv_ids, csv_folds):
+    """Fold of every image looked up in (csv_ids, csv_folds) with one sorted join, -1 for images not listed."""
+    img_ids = np.asarray(img_ids, dtype=np.int64)
+    csv_ids = np.asarray(csv_ids, dtype=np.int64)
+    if not csv_ids.shape[0]:
+        return np.full(img_ids.shape[0], -1, dtype=np.int64)
+    order = np.argsort(csv_ids, kind='stable')
+    sorted_ids = csv_ids[order]
+    pos = np.minimum(np.searchsorted(sorted_ids, img_ids), sorted_ids.shape[0] - 1)
+    found = sorted_ids[pos] == img_ids
+    return np.where(found, np.asarray(csv_folds, dtype=np.int64)[order][pos], -1)
+
+
+def read_fold_csv(csv_path):
+    """(ids, folds) of an id,name,fold csv as written by clip/generate_fold.py."""
+    with open(csv_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    return (np.array([int(row['id']) for row in rows], dtype=np.int64),
+            np.array([int(row['fold']) for row in rows], dtype=np.int64))
+
+
+class FoldManifest:
+    """
+    Fold of every image of an AnnotationIndex.
+
+    Args:
+        img_ids: Array of shape [N_images], image ids.
+        folds: Array of shape [N_images], fold of every image, -1 for images in no fold.
+    """
+    def __init__(self, img_ids, folds):
+        self.img_ids = np.asarray(img_ids, dtype=np.int64)
+        self.folds = np.asarray(folds, dtype=np.int64)
+
+    def __len__(self):
+        return self.img_ids.shape[0]
+
+    def select(self, folds, img_ids=None):
+        """Image ids in any of `folds`, restricted to `img_ids` in their order when given."""
+        if img_ids is None:
+            return self.img_ids[np.isin(self.folds, list(folds))].tolist()
+        img_ids = np.asarray(img_ids, dtype=np.int64)
+        return img_ids[np.isin(join_folds(img_ids, self.img_ids, self.folds), list(folds))].tolist()
+
+    def save(self, file_path):
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, img_ids=self.img_ids, folds=self.folds)
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data['img_ids'], data['folds'])
+
+
+def fold_manifest_key(ann_file, fold_num, stratify):
+    """Key of the manifest of an annotation file's content with a fold setting."""
+    sha1 = hashlib.sha1()
+    sha1.update(file_sha1(ann_file).encode())
+    # runs follow the order of the annotation file since format 2
+    sha1.update('{}:{}:2'.format(int(fold_num), bool(stratify)).encode())
+    return sha1.hexdigest()
+
+
+def load_fold_manifest(index, ann_file, fold_num=5, stratify=False, fold_csv='', cache_dir=''):
+    """
+    Fold manifest of an annotation file.
+
+    Args:
+        index: AnnotationIndex. Index of ann_file, gives the image ids and box counts.
+        ann_file: String. Path of the annotation file.
+        fold_num: Integer. Number of folds. Default: 5.
+        stratify: Bool. Stratify the folds by box count. Default: False.
+        fold_csv: String. An id,name,fold csv to take the folds from instead of assigning them. Default: ''.
+        cache_dir: String. Directory keeping assigned manifests keyed by the annotation file's sha1,
+            '' to assign them every time. Default: ''.
+    """
+    if fold_csv:
+        return FoldManifest(index.img_ids, join_folds(index.img_ids, *read_fold_csv(fold_csv)))
+    cache_path = ''
+    if cache_dir:
+        key = fold_manifest_key(ann_file, fold_num, stratify)
+        cache_path = os.path.join(cache_dir, 'folds_' + key + '.npz')
+        if os.path.isfile(cache_path):
+            return FoldManifest.load(cache_path)
+    box_counts = np.diff(index.offsets) if stratify else None
+    manifest = FoldManifest(index.img_ids, assign_folds(len(index), fold_num, box_counts, index.image_order))
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest.save(cache_path)
+    return manifest
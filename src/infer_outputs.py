@@ -0,0 +1,139 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Memory-mapped batch postprocessing of the offline inference .bin outputs."""
+import os
+import json
+import multiprocessing
+import numpy as np
+
+from .detection_store import DetectionStore
+
+# written next to the .bin files by ascend310_infer, one entry per model output
+OUTPUT_META_FILE = 'output_meta.json'
+# the first outputs are the detection heads in (big, me, small) order, the road mask follows
+NUM_HEADS = 3
+
+# engine, output meta and image table shared with the forked workers of postprocess_results
+_ENGINE = None
+_META = None
+_IMAGES = None
+
+
+def load_output_meta(result_path):
+    """Shape and dtype of every model output, as written by the inference run."""
+    meta_path = os.path.join(result_path, OUTPUT_META_FILE)
+    if not os.path.isfile(meta_path):
+        raise FileNotFoundError(f"{meta_path} not exists, rerun the inference to write the output shapes.")
+    with open(meta_path) as f:
+        outputs = json.load(f)['outputs']
+    return [(tuple(int(dim) for dim in out['shape']), np.dtype(out['dtype'])) for out in outputs]
+
+
+def map_outputs(result_path, stem, meta):
+    """Read-only memory maps of the detection heads of one image, in the (small, me, big) order of detect."""
+    heads = [np.memmap(os.path.join(result_path, '{}_{}.bin'.format(stem, i)), dtype=dtype, mode='r', shape=shape)
+             for i, (shape, dtype) in enumerate(meta[:NUM_HEADS])]
+    return heads[::-1]
+
+
+def image_table(coco):
+    """File name stem -> (image id, width, height) from the annotation, no image is decoded."""
+    table = {}
+    for img in coco.imgs.values():
+        stem = os.path.splitext(os.path.basename(img['file_name']))[0]
+        table[stem] = (int(img['id']), int(img['width']), int(img['height']))
+    return table
+
+
+def result_stems(result_path):
+    """Stems of the images with results in result_path."""
+    return sorted(f[:-len('_0.bin')] for f in os.listdir(result_path) if f.endswith('_0.bin'))
+
+
+def _lookup_image(stem):
+    if stem in _IMAGES:
+        return _IMAGES[stem]
+    # COCO style names end with the image id
+    img_id = int(stem.split('_')[-1])
+    img = _ENGINE.coco.imgs[img_id]
+    return img_id, int(img['width']), int(img['height'])
+
+
+def _postprocess_file(task):
+    """Decode and NMS the results of one image."""
+    result_path, stem = task
+    img_id, width, height = _lookup_image(stem)
+    # every file holds a single image, the maps are only paged in by the decode
+    outputs = [out[:1] for out in map_outputs(result_path, stem, _META)]
+    return _ENGINE.nms_batch(outputs, [[width, height]], [img_id])
+
+
+def _postprocess_chunk(tasks):
+    """
+    Decode and NMS the results of a few images in a worker.
+
+    Returns:
+        Tuple (columns, empty), the surviving (image_ids, category_ids, boxes, scores) column arrays of the
+        chunk in processing order and the ids of the images without any box, so only a few arrays are pickled.
+    """
+    store = DetectionStore()
+    empty = []
+    for task in tasks:
+        finished, no_boxes = _postprocess_file(task)
+        for result in finished:
+            store.append(*result)
+        empty.extend(no_boxes)
+    columns = (store.image_ids, store.category_ids, store.boxes, store.scores)
+    return columns, np.asarray(empty, dtype=np.int64)
+
+
+def _split_images(image_ids, category_ids, boxes, scores):
+    """Per-image (img_id, category_ids, boxes, scores) of column arrays holding each image in one run of rows."""
+    split = np.flatnonzero(np.diff(image_ids)) + 1
+    return [(image_ids[index[0]], category_ids[index], boxes[index], scores[index])
+            for index in np.split(np.arange(image_ids.shape[0]), split) if index.shape[0]]
+
+
+def postprocess_results(engine, result_path, workers=1, chunksize=8):
+    """
+    Decode and NMS every image of an offline inference run into a DetectionEngine.
+
+    Args:
+        engine: DetectionEngine. Receives the surviving boxes, its annotation gives the image sizes.
+        result_path: String. Directory of the <stem>_<output>.bin files and their output_meta.json.
+        workers: Integer. Number of forked processes, 0 for one per cpu core, 1 runs serially. Default: 1.
+        chunksize: Integer. Images handed to a worker at a time. Default: 8.
+
+    Returns:
+        Integer, number of images processed.
+    """
+    global _ENGINE, _META, _IMAGES
+    _ENGINE = engine
+    _META = load_output_meta(result_path)
+    _IMAGES = image_table(engine.coco)
+    tasks = [(result_path, stem) for stem in result_stems(result_path)]
+    workers = min(workers or os.cpu_count() or 1, max(len(tasks), 1))
+    try:
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for columns, empty in pool.imap(_postprocess_chunk, chunks):
+                    engine.add_finished(_split_images(*columns), empty.tolist())
+        else:
+            for task in tasks:
+                engine.add_finished(*_postprocess_file(task))
+    finally:
+        _ENGINE, _META, _IMAGES = None, None, None
+    return len(tasks)
@@ -0,0 +1,191 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Running COCO style mAP updated image by image."""
+import threading
+import numpy as np
+
+
+def box_iou(dt_boxes, gt_boxes, gt_crowd):
+    """IoU matrix [D, G] of [x, y, w, h] boxes, crowd ground truth is divided by the detection area only."""
+    dt_x2 = dt_boxes[:, None, 0] + dt_boxes[:, None, 2]
+    dt_y2 = dt_boxes[:, None, 1] + dt_boxes[:, None, 3]
+    gt_x2 = gt_boxes[None, :, 0] + gt_boxes[None, :, 2]
+    gt_y2 = gt_boxes[None, :, 1] + gt_boxes[None, :, 3]
+    inter_w = np.maximum(np.minimum(dt_x2, gt_x2) - np.maximum(dt_boxes[:, None, 0], gt_boxes[None, :, 0]), 0)
+    inter_h = np.maximum(np.minimum(dt_y2, gt_y2) - np.maximum(dt_boxes[:, None, 1], gt_boxes[None, :, 1]), 0)
+    inter = inter_w * inter_h
+    dt_area = (dt_boxes[:, 2] * dt_boxes[:, 3])[:, None]
+    union = np.where(gt_crowd[None, :], dt_area, dt_area + (gt_boxes[:, 2] * gt_boxes[:, 3])[None, :] - inter)
+    return np.where(union > 0, inter / np.maximum(union, np.spacing(1)), 0.)
+
+
+class MapAccumulator:
+    """
+    Online bbox mAP over the images evaluated so far.
+
+    Every finished image is matched against its ground truth the way COCOeval.evaluateImg does for
+    area 'all' (greedy in score order, crowd boxes ignored, at most max_dets boxes per category), and
+    the matches only update per-class TP / FP histograms over score bins and the ground truth counts.
+    AP is then read from the histograms with COCO's 101 point interpolation, so a provisional value is
+    available at any time. Detections falling in the same score bin are treated as ties, which makes
+    the value slightly differ from COCOeval, the reported final metrics still come from COCOeval.
+
+    update may be called from several threads, the matching runs unlocked and only the histogram
+    update is serialized.
+
+    Args:
+        coco_gt: COCO. Ground truth, looked up by image id.
+        max_dets: Integer. Boxes per image and category taken into account. Default: 100.
+        num_bins: Integer. Score histogram bins over [0, 1]. Default: 1000.
+
+    Examples:
+        accumulator = MapAccumulator(coco_gt)
+        accumulator.update(img_id, category_ids, boxes, scores)
+        accumulator.summary()
+    """
+    def __init__(self, coco_gt, max_dets=100, num_bins=1000):
+        self.coco_gt = coco_gt
+        self.max_dets = max_dets
+        self.num_bins = num_bins
+        self.iou_thresholds = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.rec_thresholds = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+        self.cat_ids = sorted(coco_gt.getCatIds())
+        self._cat_index = {cat_id: k for k, cat_id in enumerate(self.cat_ids)}
+        num_thresholds, num_cats = self.iou_thresholds.shape[0], len(self.cat_ids)
+        self.tp = np.zeros((num_thresholds, num_cats, num_bins), dtype=np.int64)
+        self.fp = np.zeros((num_thresholds, num_cats, num_bins), dtype=np.int64)
+        self.num_gt = np.zeros(num_cats, dtype=np.int64)
+        self.num_images = 0
+        self._lock = threading.Lock()
+
+    def _gt_by_category(self, img_id):
+        gts = {}
+        for ann in self.coco_gt.imgToAnns.get(img_id, []):
+            if ann['category_id'] in self._cat_index:
+                gts.setdefault(ann['category_id'], []).append(ann)
+        return gts
+
+    def update(self, img_id, category_ids, boxes, scores):
+        """
+        Add the final detections of one image, call it once per image, also for images without detections.
+
+        Args:
+            img_id: Integer. COCO image id.
+            category_ids: Array of shape [N], COCO category ids.
+            boxes: Array of shape [N, 4], [x, y, w, h] top-left boxes.
+            scores: Array of shape [N].
+        """
+        img_id = int(img_id)
+        category_ids = np.asarray(category_ids).reshape(-1)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        gts = self._gt_by_category(img_id)
+        matches = []
+        for cat_id in set(gts) | set(category_ids.tolist()):
+            if cat_id not in self._cat_index:
+                continue
+            index = np.flatnonzero(category_ids == cat_id)
+            index = index[np.argsort(-scores[index], kind='mergesort')][:self.max_dets]
+            matches.append((self._cat_index[cat_id],) + self._match(gts.get(cat_id, []), boxes[index], scores[index]))
+        with self._lock:
+            self.num_images += 1
+            for k, num_gt, bins, matched, counted in matches:
+                self.num_gt[k] += num_gt
+                rows, cols = np.nonzero(matched & counted)
+                np.add.at(self.tp[:, k], (rows, bins[cols]), 1)
+                rows, cols = np.nonzero(~matched & counted)
+                np.add.at(self.fp[:, k], (rows, bins[cols]), 1)
+
+    def _match(self, gts, dt_boxes, dt_scores):
+        """
+        COCOeval.evaluateImg of one image and category.
+
+        Returns:
+            Tuple (num_gt, bins, matched, counted), the non ignored ground truth count, the score bin of
+            every detection and the [T, D] matched and not ignored flags.
+        """
+        gt_ignore = np.array([bool(ann.get('iscrowd', 0)) for ann in gts], dtype=bool)
+        # non ignored ground truth first, as COCOeval sorts them
+        gt_order = np.argsort(gt_ignore, kind='mergesort')
+        gt_ignore = gt_ignore[gt_order]
+        num_gt = int((~gt_ignore).sum())
+        num_thresholds, num_dets = self.iou_thresholds.shape[0], dt_scores.shape[0]
+        matched = np.zeros((num_thresholds, num_dets), dtype=bool)
+        dt_ignore = np.zeros((num_thresholds, num_dets), dtype=bool)
+        if gts and num_dets:
+            gt_boxes = np.array([gts[g]['bbox'] for g in gt_order], dtype=np.float64).reshape(-1, 4)
+            ious = box_iou(dt_boxes, gt_boxes, gt_ignore)
+            thresholds = np.minimum(self.iou_thresholds, 1 - 1e-10)[:, None]
+            # ground truth reversed, argmax then keeps the last of equal IoUs like COCOeval
+            ious, gt_ignore = ious[:, ::-1], gt_ignore[::-1]
+            above = ious[:, None, :] >= thresholds
+            gt_taken = np.zeros((num_thresholds, len(gts)), dtype=bool)
+            rows = np.arange(num_thresholds)
+            # detections stay greedy in score order, all IoU thresholds are matched at once,
+            # the ones below the lowest threshold everywhere match nothing
+            for d in np.flatnonzero(above[:, 0].any(axis=1)):
+                # matched non crowd ground truth can not be matched again
+                candidate = above[d] & ~gt_taken
+                if num_gt < len(gts):
+                    candidate |= above[d] & gt_ignore
+                    # an ignored ground truth is only taken when no regular one matches
+                    regular = candidate & ~gt_ignore
+                    candidate = np.where(regular.any(axis=1)[:, None], regular, candidate)
+                m = np.argmax(np.where(candidate, ious[d], -1.), axis=1)
+                found = candidate[rows, m]
+                matched[:, d] = found
+                dt_ignore[:, d] = found & gt_ignore[m]
+                gt_taken[rows[found], m[found]] = True
+
+        bins = np.minimum((np.clip(dt_scores, 0, 1) * self.num_bins).astype(np.int64), self.num_bins - 1)
+        return num_gt, bins, matched, ~dt_ignore
+
+    def precision(self):
+        """Interpolated precision of shape [T, R, K], -1 for categories without ground truth."""
+        num_thresholds, num_cats = self.tp.shape[:2]
+        precision = -np.ones((num_thresholds, self.rec_thresholds.shape[0], num_cats))
+        # walk the bins from the highest score down
+        tp_sum = np.cumsum(self.tp[..., ::-1], axis=-1).astype(np.float64)
+        fp_sum = np.cumsum(self.fp[..., ::-1], axis=-1).astype(np.float64)
+        for k in range(num_cats):
+            if self.num_gt[k] == 0:
+                continue
+            for t in range(num_thresholds):
+                seen = (self.tp[t, k, ::-1] + self.fp[t, k, ::-1]) > 0
+                tp, fp = tp_sum[t, k, seen], fp_sum[t, k, seen]
+                rc = tp / self.num_gt[k]
+                pr = tp / np.maximum(tp + fp, np.spacing(1))
+                # precision envelope, non increasing in recall
+                pr = np.maximum.accumulate(pr[::-1])[::-1]
+                q = np.zeros(self.rec_thresholds.shape[0])
+                inds = np.searchsorted(rc, self.rec_thresholds, side='left')
+                valid = inds < pr.shape[0]
+                q[valid] = pr[inds[valid]]
+                precision[t, :, k] = q
+        return precision
+
+    def summary(self):
+        """Provisional AP, AP50 and AP75 over the images seen so far."""
+        with self._lock:
+            precision = self.precision()
+            num_images = self.num_images
+
+        def mean_ap(p):
+            p = p[p > -1]
+            return float(np.mean(p)) if p.size else -1.0
+        ap50 = np.flatnonzero(np.isclose(self.iou_thresholds, 0.5))[0]
+        ap75 = np.flatnonzero(np.isclose(self.iou_thresholds, 0.75))[0]
+        return {'AP': mean_ap(precision), 'AP50': mean_ap(precision[ap50]), 'AP75': mean_ap(precision[ap75]),
+                'images': num_images}
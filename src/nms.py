@@ -0,0 +1,150 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Non maximum suppression shared by the detection engines."""
+import numpy as np
+
+
+def greedy_nms(predicts, threshold):
+    """Calculate NMS of one class, predicts is [N, 5] of [x, y, w, h, score]."""
+    # convert xywh -> xmin ymin xmax ymax
+    x1 = predicts[:, 0]
+    y1 = predicts[:, 1]
+    x2 = x1 + predicts[:, 2]
+    y2 = y1 + predicts[:, 3]
+    scores = predicts[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    reserved_boxes = []
+    while order.size > 0:
+        i = order[0]
+        reserved_boxes.append(i)
+        max_x1 = np.maximum(x1[i], x1[order[1:]])
+        max_y1 = np.maximum(y1[i], y1[order[1:]])
+        min_x2 = np.minimum(x2[i], x2[order[1:]])
+        min_y2 = np.minimum(y2[i], y2[order[1:]])
+
+        intersect_w = np.maximum(0.0, min_x2 - max_x1 + 1)
+        intersect_h = np.maximum(0.0, min_y2 - max_y1 + 1)
+        intersect_area = intersect_w * intersect_h
+        ovr = intersect_area / (areas[i] + areas[order[1:]] - intersect_area)
+
+        indexes = np.where(ovr <= threshold)[0]
+        order = order[indexes + 1]
+    return reserved_boxes
+
+
+def _pairwise_iou(boxes_a, area_a, boxes_b, area_b):
+    """IoU matrix [len(a), len(b)] of x1y1x2y2 boxes, with the same +1 pixel convention as greedy_nms."""
+    intersect_w = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    intersect_w -= np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    intersect_w += 1
+    np.maximum(intersect_w, 0.0, out=intersect_w)
+    intersect_h = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersect_h -= np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    intersect_h += 1
+    np.maximum(intersect_h, 0.0, out=intersect_h)
+    intersect_w *= intersect_h
+    union = area_a[:, None] + area_b[None, :]
+    union -= intersect_w
+    intersect_w /= union
+    return intersect_w
+
+
+def _neighbour_pairs(query_keys, sorted_keys, grid_width):
+    """Pairs (query, position in sorted_keys) of boxes lying in the same or an adjacent grid cell."""
+    offsets = np.array([dy * grid_width + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)], dtype=np.int64)
+    keys = (query_keys[:, None] + offsets[None, :]).reshape(-1)
+    low = np.searchsorted(sorted_keys, keys, side='left')
+    lengths = np.searchsorted(sorted_keys, keys, side='right') - low
+    total = lengths.sum()
+    query = np.repeat(np.repeat(np.arange(query_keys.shape[0]), offsets.shape[0]), lengths)
+    starts = np.repeat(low - (np.cumsum(lengths) - lengths), lengths)
+    return query, starts + np.arange(total)
+
+
+def batched_nms(boxes, scores, classes, threshold, max_candidates=None, block_size=512):
+    """
+    Multi-class NMS of one image in a single call.
+
+    Boxes of different classes are shifted apart by a class dependent offset so that they never
+    overlap, then one greedy pass runs over all candidates in score order, block by block. Inside a
+    block the IoU matrix is dense, so memory is bounded by block_size * block_size entries. The boxes
+    kept by a block suppress the later ones through a coarse grid with cells as large as the largest
+    box, so only boxes of neighbouring cells are ever compared.
+
+    Args:
+        boxes: Array of shape [N, 4], [x, y, w, h] top-left boxes.
+        scores: Array of shape [N].
+        classes: Array of shape [N], class of every box.
+        threshold: Float. Boxes whose IoU with a kept box is above it are suppressed.
+        max_candidates: Integer. Only the highest scoring candidates are fed to NMS, 0 or None for all.
+            Default: None.
+        block_size: Integer. Number of boxes per IoU block. Default: 512.
+
+    Returns:
+        Array, indexes of the kept boxes, sorted by descending score.
+    """
+    scores = np.asarray(scores)
+    if scores.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(-scores, kind='stable')
+    if max_candidates and order.shape[0] > max_candidates:
+        order = order[:max_candidates]
+
+    boxes = np.asarray(boxes, dtype=np.float64)[order]
+    xyxy = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:4]], axis=-1)
+    areas = (boxes[:, 2] + 1) * (boxes[:, 3] + 1)
+    # offset every class into its own disjoint region, +2 keeps the +1 pixel convention disjoint too
+    span = xyxy.max() - xyxy.min() + 2
+    xyxy += (np.asarray(classes)[order].astype(np.float64) * span)[:, None]
+
+    # boxes can only overlap when their top-left corners fall in the same or adjacent cells
+    cell = max(boxes[:, 2:4].max(), 0) + 1
+    cells = np.floor((xyxy[:, :2] - xyxy[:, :2].min(axis=0)) / cell).astype(np.int64)
+    grid_width = cells[:, 0].max() + 3
+    cell_keys = (cells[:, 1] + 1) * grid_width + cells[:, 0] + 1
+    by_cell = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[by_cell]
+
+    num = order.shape[0]
+    keep = np.ones(num, dtype=bool)
+    for start in range(0, num, block_size):
+        end = min(start + block_size, num)
+        # greedy inside the block over the boxes that earlier blocks left alive, in score order
+        alive = np.nonzero(keep[start:end])[0] + start
+        if alive.shape[0] == 0:
+            continue
+        iou = _pairwise_iou(xyxy[alive], areas[alive], xyxy[alive], areas[alive]) > threshold
+        alive_mask = np.ones(alive.shape[0], dtype=bool)
+        for i in range(alive.shape[0]):
+            if alive_mask[i]:
+                alive_mask[i + 1:] &= ~iou[i, i + 1:]
+        keep[alive[~alive_mask]] = False
+        if end == num:
+            break
+        # suppress the following blocks by the boxes kept in this one
+        kept = alive[alive_mask]
+        query, position = _neighbour_pairs(cell_keys[kept], sorted_keys, grid_width)
+        other = by_cell[position]
+        later = (other >= end) & keep[other]
+        query, other = kept[query[later]], other[later]
+        intersect_w = np.minimum(xyxy[query, 2], xyxy[other, 2]) - np.maximum(xyxy[query, 0], xyxy[other, 0]) + 1
+        intersect_h = np.minimum(xyxy[query, 3], xyxy[other, 3]) - np.maximum(xyxy[query, 1], xyxy[other, 1]) + 1
+        intersect_area = np.maximum(intersect_w, 0.0) * np.maximum(intersect_h, 0.0)
+        ovr = intersect_area / (areas[query] + areas[other] - intersect_area)
+        keep[other[ovr > threshold]] = False
+    return order[keep]
@@ -0,0 +1,231 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Writers of detection results."""
+import abc
+import json
+import queue
+import datetime
+import threading
+import numpy as np
+
+# one record of the binary result format, 32 bytes per box
+RESULT_DTYPE = np.dtype([('image_id', '<i8'), ('category_id', '<i4'), ('bbox', '<f4', (4,)), ('score', '<f4')])
+_NPY_HEADER_LEN = 256
+
+
+def _finite(image_ids, category_ids, boxes, scores):
+    """Drop the boxes with a NaN or inf score or coordinate, JSON has no literal for them and every format agrees."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    keep = np.isfinite(scores) & np.isfinite(boxes).all(axis=-1)
+    if keep.all():
+        return np.asarray(image_ids), np.asarray(category_ids), boxes, scores
+    return np.asarray(image_ids)[keep], np.asarray(category_ids)[keep], boxes[keep], scores[keep]
+
+
+class ResultWriter(abc.ABC):
+    """
+    Base class of the result writers, detections are written chunk by chunk as column arrays.
+
+    Args:
+        file_path: String. Output file path.
+    """
+    mode = 'w'
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        try:
+            self._file = open(file_path, self.mode)
+        except IOError as e:
+            raise RuntimeError("Unable to open result file to dump. What(): {}".format(str(e)))
+        self._start()
+
+    def _start(self):
+        pass
+
+    def _finish(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, image_ids, category_ids, boxes, scores):
+        """Write a chunk of detections given as column arrays."""
+
+    def close(self):
+        """Finish and close the file, returns its path."""
+        self._finish()
+        self._file.close()
+        return self.file_path
+
+
+class CocoJsonWriter(ResultWriter):
+    """Standard COCO result json, one list of box dicts written incrementally."""
+    def _start(self):
+        self._file.write('[')
+        self._first = True
+
+    def _finish(self):
+        self._file.write(']')
+
+    def write(self, image_ids, category_ids, boxes, scores):
+        image_ids, category_ids, boxes, scores = _finite(image_ids, category_ids, boxes, scores)
+        if not len(scores):
+            return
+        # repr of a finite float is a valid JSON number
+        text = ', '.join('{"image_id": %d, "category_id": %d, "bbox": [%r, %r, %r, %r], "score": %r}'
+                         % (img_id, category_id, x, y, w, h, score)
+                         for img_id, category_id, (x, y, w, h), score in zip(
+                             image_ids.tolist(), category_ids.tolist(), boxes.tolist(), scores.tolist()))
+        self._file.write(text if self._first else ', ' + text)
+        self._first = False
+
+
+class NdjsonWriter(ResultWriter):
+    """One json line per image holding the columns of all its boxes."""
+    def write(self, image_ids, category_ids, boxes, scores):
+        image_ids, category_ids, boxes, scores = _finite(image_ids, category_ids, boxes, scores)
+        if not image_ids.shape[0]:
+            return
+        order = np.argsort(image_ids, kind='stable')
+        img_ids, starts = np.unique(image_ids[order], return_index=True)
+        category_ids = category_ids[order].tolist()
+        boxes = boxes[order].tolist()
+        scores = scores[order].tolist()
+        ends = np.append(starts[1:], order.shape[0]).tolist()
+        lines = ['{"image_id": %d, "category_id": %s, "bbox": %s, "score": %s}\n'
+                 % (img_id, category_ids[start:end], boxes[start:end], scores[start:end])
+                 for img_id, start, end in zip(img_ids.tolist(), starts.tolist(), ends)]
+        self._file.write(''.join(lines))
+
+
+class NpyWriter(ResultWriter):
+    """
+    Binary records of RESULT_DTYPE in a .npy file, which can be memory mapped with np.load(mmap_mode='r').
+
+    The header is reserved up front and rewritten with the final box count on close,
+    so the records are streamed straight to disk.
+    """
+    mode = 'wb'
+
+    def _header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (RESULT_DTYPE.descr, self._count)
+        header = header.ljust(_NPY_HEADER_LEN - 10 - 1) + '\n'
+        if len(header) + 10 > _NPY_HEADER_LEN:
+            raise RuntimeError("Result file header is too long: {}".format(header))
+        return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+    def _start(self):
+        self._count = 0
+        self._file.write(self._header())
+
+    def _finish(self):
+        self._file.seek(0)
+        self._file.write(self._header())
+
+    def write(self, image_ids, category_ids, boxes, scores):
+        image_ids, category_ids, boxes, scores = _finite(image_ids, category_ids, boxes, scores)
+        records = np.empty(len(scores), dtype=RESULT_DTYPE)
+        records['image_id'] = image_ids
+        records['category_id'] = category_ids
+        records['bbox'] = boxes
+        records['score'] = scores
+        self._file.write(records.tobytes())
+        self._count += records.shape[0]
+
+
+class AsyncResultWriter:
+    """
+    Run a writer on a background thread so that writing overlaps inference.
+
+    Args:
+        writer: ResultWriter. Writer doing the actual work.
+        max_queue: Integer. Chunks waiting to be written before write blocks. Default: 64.
+    """
+    def __init__(self, writer, max_queue=64):
+        self.writer = writer
+        self.file_path = writer.file_path
+        self._queue = queue.Queue(max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is None:
+                try:
+                    self.writer.write(*chunk)
+                except Exception as e:  # pylint: disable=broad-except
+                    self._error = e
+
+    def write(self, image_ids, category_ids, boxes, scores):
+        if self._error is not None:
+            raise self._error
+        # the caller may reuse its buffers, hand over copies
+        self._queue.put((np.array(image_ids), np.array(category_ids), np.array(boxes), np.array(scores)))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.writer.close()
+
+
+RESULT_WRITERS = {
+    'json': ('.json', CocoJsonWriter),
+    'ndjson': ('.ndjson', NdjsonWriter),
+    'npy': ('.npy', NpyWriter),
+}
+
+
+def create_result_writer(save_prefix, result_format='json', background=True):
+    """Open a writer of the given format at save_prefix/predict_<time><ext>."""
+    if result_format not in RESULT_WRITERS:
+        raise ValueError("Unsupported result format {}, expected one of {}".format(
+            result_format, list(RESULT_WRITERS.keys())))
+    ext, writer_class = RESULT_WRITERS[result_format]
+    t = datetime.datetime.now().strftime('_%Y_%m_%d_%H_%M_%S')
+    writer = writer_class(save_prefix + '/predict' + t + ext)
+    return AsyncResultWriter(writer) if background else writer
+
+
+def load_results(file_path):
+    """
+    Load a result file of any format.
+
+    Returns:
+        Array of shape [N, 7], [image_id, x, y, w, h, score, category_id], as accepted by COCO.loadRes.
+    """
+    if file_path.endswith('.npy'):
+        records = np.load(file_path, mmap_mode='r')
+        return np.concatenate([records['image_id'][:, None], records['bbox'], records['score'][:, None],
+                               records['category_id'][:, None]], axis=-1).astype(np.float64)
+    if file_path.endswith('.ndjson'):
+        rows = []
+        with open(file_path, 'r') as f:
+            for line in f:
+                image = json.loads(line)
+                num = len(image['score'])
+                rows.append(np.concatenate([np.full((num, 1), image['image_id']),
+                                            np.array(image['bbox'], np.float64).reshape(num, 4),
+                                            np.array(image['score'], np.float64)[:, None],
+                                            np.array(image['category_id'], np.float64)[:, None]], axis=-1))
+        return np.concatenate(rows) if rows else np.zeros((0, 7))
+    with open(file_path, 'r') as f:
+        dets = json.load(f)
+    return np.array([[d['image_id']] + list(d['bbox']) + [d['score'], d['category_id']] for d in dets],
+                    np.float64).reshape(-1, 7)
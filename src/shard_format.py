@@ -0,0 +1,254 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Packed shards of image tiles, masks and boxes, written sequentially and streamed back."""
+import os
+import json
+import queue
+import threading
+import numpy as np
+import cv2
+
+from .annotation_index import AnnotationIndex
+
+SHARD_INDEX_FILE = 'index.npz'
+
+# how the mask of a record is stored
+MASK_NONE = 0
+MASK_PNG = 1
+MASK_BITS = 2
+
+
+def encode_mask(mask, mask_bytes=None):
+    """
+    Mask as (codec, payload, value).
+
+    A single channel uint8 mask holding 0 and one other value is bit-packed with that value kept
+    aside, anything else keeps its png bytes, or is encoded to png when no bytes are given.
+    """
+    if mask is None:
+        return MASK_NONE, b'', 0
+    values = np.unique(mask)
+    if mask.dtype == np.uint8 and mask.ndim == 2 and values.shape[0] <= 2 and values[0] == 0:
+        return MASK_BITS, np.packbits(mask.reshape(-1) != 0).tobytes(), int(values[-1])
+    if mask_bytes is None:
+        mask_bytes = cv2.imencode('.png', mask)[1].tobytes()
+    return MASK_PNG, bytes(mask_bytes), 0
+
+
+def decode_mask(payload, codec, shape, value):
+    """Inverse of encode_mask, None for records without a mask."""
+    if codec == MASK_NONE:
+        return None
+    if codec == MASK_PNG:
+        return cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_UNCHANGED)
+    bits = np.unpackbits(np.frombuffer(payload, np.uint8), count=int(shape[0]) * int(shape[1]))
+    return (bits * np.uint8(value)).reshape(int(shape[0]), int(shape[1]))
+
+
+class ShardWriter:
+    """
+    Appends records to shard files of about shard_size bytes and writes their index on close.
+
+    A record is the encoded tile bytes followed by its mask payload. The index keeps where every
+    record lives together with the AnnotationIndex of the packed images, so boxes never have to be
+    read from the shards.
+
+    Args:
+        out_dir: String. Directory of the shards and index.npz.
+        index: AnnotationIndex. Boxes of the images, records are added in its order.
+        shard_size: Integer. Bytes after which a new shard is started. Default: 256 MB.
+    """
+    def __init__(self, out_dir, index, shard_size=256 << 20):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.index = index
+        self.shard_size = shard_size
+        self.shard_files = []
+        self._file = None
+        self._pos = 0
+        self._records = {key: [] for key in ('shard', 'image_offset', 'image_size', 'mask_offset', 'mask_size',
+                                             'mask_codec', 'mask_shape', 'mask_value')}
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = 'shard_{:05d}.bin'.format(len(self.shard_files))
+        self.shard_files.append(name)
+        self._file = open(os.path.join(self.out_dir, name), 'wb')
+        self._pos = 0
+
+    def add(self, image_bytes, mask=None, mask_bytes=None):
+        """Append the record of the next image of the index."""
+        if self._file is None or self._pos >= self.shard_size:
+            self._next_shard()
+        codec, payload, value = encode_mask(mask, mask_bytes)
+        records = self._records
+        records['shard'].append(len(self.shard_files) - 1)
+        records['image_offset'].append(self._pos)
+        records['image_size'].append(len(image_bytes))
+        records['mask_offset'].append(self._pos + len(image_bytes))
+        records['mask_size'].append(len(payload))
+        records['mask_codec'].append(codec)
+        records['mask_shape'].append(mask.shape[:2] if mask is not None else (0, 0))
+        records['mask_value'].append(value)
+        self._file.write(image_bytes)
+        self._file.write(payload)
+        self._pos += len(image_bytes) + len(payload)
+
+    def close(self):
+        """Close the last shard and write the index, returns its path."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if len(self._records['shard']) != len(self.index):
+            raise ValueError("{} records were added for {} indexed images.".format(
+                len(self._records['shard']), len(self.index)))
+        index = self.index
+        path = os.path.join(self.out_dir, SHARD_INDEX_FILE)
+        np.savez(path, img_ids=index.img_ids, file_names=index.file_names, offsets=index.offsets,
+                 boxes=index.boxes, valid=index.valid, image_order=index.image_order, shard_files=np.array(self.shard_files, dtype=str),
+                 meta=np.array(json.dumps({'shard_size': self.shard_size})),
+                 **{key: np.array(value, dtype=np.int64) for key, value in self._records.items()})
+        return path
+
+
+class ShardReader:
+    """
+    Shards written by ShardWriter.
+
+    Args:
+        shard_dir: String. Directory of the shards and index.npz.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with np.load(os.path.join(shard_dir, SHARD_INDEX_FILE)) as data:
+            self.index = AnnotationIndex(data['img_ids'], data['file_names'], data['offsets'], data['boxes'],
+                                         data['valid'], data['image_order'] if 'image_order' in data.files else None)
+            self.shard_files = data['shard_files'].tolist()
+            self.records = {key: data[key] for key in ('shard', 'image_offset', 'image_size', 'mask_offset',
+                                                       'mask_size', 'mask_codec', 'mask_shape', 'mask_value')}
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard_positions(self, shard):
+        """Positions of the records of a shard, in file order."""
+        return np.flatnonzero(self.records['shard'] == shard)
+
+    def read_shard(self, shard):
+        """Whole shard as one sequential read."""
+        with open(os.path.join(self.shard_dir, self.shard_files[shard]), 'rb') as f:
+            return f.read()
+
+    def record(self, buffer, position):
+        """(image bytes as int8, mask) of a record from the buffer of its shard."""
+        records = self.records
+        image = np.frombuffer(buffer, np.int8, int(records['image_size'][position]),
+                              int(records['image_offset'][position]))
+        start = int(records['mask_offset'][position])
+        payload = buffer[start:start + int(records['mask_size'][position])]
+        mask = decode_mask(payload, records['mask_codec'][position], records['mask_shape'][position],
+                           records['mask_value'][position])
+        return image, mask
+
+
+class ShardStream:
+    """
+    Streams the records of a rank's shards with shard-level shuffling and read-ahead.
+
+    Every epoch the shards holding wanted records are shuffled and dealt round robin to the ranks,
+    a background thread reads up to read_ahead whole shards ahead of the consumer, and the records
+    of each shard are shuffled once it is in memory. A rank cycles through its shards until it has
+    yielded num_samples records, so every rank runs the same number of steps. That needs at least
+    one such shard per rank, fewer raise a ValueError.
+
+    Args:
+        reader: ShardReader.
+        positions: Array. Index positions to yield, e.g. the valid images, others are skipped.
+        num_replicas: Integer. Number of ranks. Default: 1.
+        rank: Integer. Rank of this process. Default: 0.
+        shuffle: Bool. Shuffle shards and records. Default: True.
+        read_ahead: Integer. Shards read ahead of the consumer. Default: 2.
+    """
+    def __init__(self, reader, positions, num_replicas=1, rank=0, shuffle=True, read_ahead=2):
+        self.reader = reader
+        self.num_replicas = num_replicas
+        self.rank = rank if num_replicas > 1 else 0
+        self.shuffle = shuffle
+        self.read_ahead = read_ahead
+        self.epoch = 0
+        wanted = np.zeros(len(reader), dtype=bool)
+        wanted[np.asarray(positions, dtype=np.int64)] = True
+        self._shard_positions = [p[wanted[p]] for p in (reader.shard_positions(shard)
+                                                        for shard in range(len(reader.shard_files)))]
+        self.num_samples = int(wanted.sum()) // max(num_replicas, 1)
+        self._shards = np.array([shard for shard, p in enumerate(self._shard_positions) if p.shape[0]], np.int64)
+        if self.num_samples and self._shards.shape[0] < max(num_replicas, 1):
+            raise ValueError("{} shards hold the wanted records, fewer than the {} ranks. Pack smaller shards, "
+                             "e.g. with a lower shard_size_mb.".format(self._shards.shape[0], num_replicas))
+
+    def __len__(self):
+        return self.num_samples
+
+    def _rank_shards(self, rng):
+        # only non-empty shards are dealt, so every rank gets at least one
+        shards = self._shards
+        if self.shuffle:
+            shards = rng.permutation(shards)
+        return shards[self.rank::self.num_replicas].tolist()
+
+    def _prefetch(self, shards, buffers, stop):
+        try:
+            for shard in shards:
+                if stop.is_set():
+                    return
+                buffers.put((shard, self.reader.read_shard(shard)))
+        finally:
+            buffers.put(None)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.epoch)
+        self.epoch += 1
+        shards = self._rank_shards(rng)
+        if not shards or not self.num_samples:
+            return
+        # cycle through the rank's shards until num_samples records are out
+        cycles = -(-self.num_samples // sum(self._shard_positions[shard].shape[0] for shard in shards))
+        buffers = queue.Queue(maxsize=max(self.read_ahead, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._prefetch, args=(shards * cycles, buffers, stop), daemon=True)
+        thread.start()
+        count = 0
+        try:
+            while count < self.num_samples:
+                item = buffers.get()
+                if item is None:
+                    break
+                shard, buffer = item
+                positions = self._shard_positions[shard]
+                if self.shuffle:
+                    positions = rng.permutation(positions)
+                for position in positions[:self.num_samples - count].tolist():
+                    image, mask = self.reader.record(buffer, position)
+                    count += 1
+                    yield position, image, mask
+        finally:
+            stop.set()
+            # unblock a prefetch thread waiting on a full queue
+            while thread.is_alive():
+                try:
+                    buffers.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
@@ -0,0 +1,76 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Decoded tiles and masks kept across epochs by the dataset generator."""
+from collections import OrderedDict
+
+
+class TileCache:
+    """
+    LRU cache of decoded uint8 images and their masks, bounded in bytes.
+
+    GeneratorDataset runs the dataset's __getitem__ in one process, so a plain dict in that process
+    is enough; every rank keeps its own cache of the tiles it reads. Entries larger than the
+    budget are not cached.
+
+    Args:
+        budget_bytes: Integer. Bytes of images and masks kept at most.
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = int(budget_bytes)
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._hits, self._misses, self._evictions = 0, 0, 0
+
+    def get(self, key):
+        """The (image, mask) cached under key, None on a miss. Callers must not write to them."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, image, mask=None):
+        """Cache a decoded image and its mask, evicting the least recently used entries when full."""
+        size = image.nbytes + (mask.nbytes if mask is not None else 0)
+        if size > self.budget_bytes:
+            return False
+        if key in self._entries:
+            return True
+        while self.nbytes + size > self.budget_bytes:
+            _, (old_image, old_mask) = self._entries.popitem(last=False)
+            self.nbytes -= old_image.nbytes + (old_mask.nbytes if old_mask is not None else 0)
+            self._evictions += 1
+        self._entries[key] = (image, mask)
+        self.nbytes += size
+        return True
+
+    def stats(self):
+        """Hits, misses, evictions and entries so far."""
+        return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+                'entries': len(self._entries)}
+
+    def report(self):
+        stats = self.stats()
+        lookups = max(stats['hits'] + stats['misses'], 1)
+        return 'hits {} misses {} ({:.1f}% hit), evictions {}, {} entries, {:.1f}/{:.1f} MB'.format(
+            stats['hits'], stats['misses'], stats['hits'] * 100. / lookups, stats['evictions'],
+            stats['entries'], self.nbytes / 2 ** 20, self.budget_bytes / 2 ** 20)
+
+    def close(self):
+        """Drop every entry."""
+        self._entries.clear()
+        self.nbytes = 0
@@ -14,7 +14,6 @@
 # ============================================================================
 """Preprocess dataset."""
 import random
-import threading
 import copy
 from . import aug_transforms
 import numpy as np
@@ -59,17 +58,25 @@ def bbox_iou(bbox_a, bbox_b, offset=0):
     return area_i / (area_a[:, None] + area_b - area_i)
 
 
+def normalize_coefs(statistic_norm=True):
+    """Per-channel float32 (scale, shift) with img * scale - shift == (img / 255. - mean) / std."""
+    if not statistic_norm:
+        return np.full(3, 1. / 255., np.float32), np.zeros(3, np.float32)
+    # Computed from random subset of ImageNet training images
+    mean = np.array([0.485, 0.456, 0.406], np.float32)
+    std = np.array([0.229, 0.224, 0.225], np.float32)
+    return 1. / (255. * std), mean / std
+
+
 def statistic_normalize_img(img, statistic_norm):
     """Statistic normalize images."""
     # img: RGB
     if isinstance(img, Image.Image):
         img = np.array(img)
-    img = img/255.
-    # Computed from random subset of ImageNet training images
-    mean = np.array([0.485, 0.456, 0.406])
-    std = np.array([0.229, 0.224, 0.225])
-    if statistic_norm:
-        img = (img - mean) / std
+    # one float32 multiply and subtract, no float64 temporaries
+    scale, shift = normalize_coefs(statistic_norm)
+    img = np.multiply(img, scale, dtype=np.float32)
+    img -= shift
     return img
 
 
@@ -133,91 +140,216 @@ def pil_image_reshape(interp):
     return reshape_type[interp]
 
 
-def _preprocess_true_boxes(true_boxes, anchors, in_shape, num_classes,
-                           max_boxes, label_smooth, label_smooth_factor=0.1):
-    """Preprocess annotation boxes."""
+# anchors of the stride 32, 16 and 8 layers
+ANCHOR_MASK = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+# columns of a sparse target row, scale is the layer index above, -1 on padding rows
+SPARSE_TARGET_COLUMNS = ('scale', 'gy', 'gx', 'anchor', 'x', 'y', 'w', 'h', 'class', 'last')
+
+
+def _assign_true_boxes(true_boxes, anchors, in_shape):
+    """
+    Layer, cell and anchor of every valid box of a batch of padded annotation boxes.
+
+    Every box with a positive width goes to the cell of its center on the layer of its best
+    matching anchor. When boxes of an image share a cell and anchor only the last one is flagged
+    in `last`, it is the one whose coordinates the cell keeps.
+
+    Args:
+        true_boxes: Array of shape [B, N, 5], [x_min, y_min, x_max, y_max, label] padded with zeros.
+        anchors: List. The 9 anchors [w, h], small to big.
+        in_shape: List. Input (h, w).
+
+    Returns:
+        Dict of arrays with one entry per valid box: img_index, box_index, layer, gy, gx, anchor,
+        classes, xywh (normalized center boxes), last, and cell, the flat index into the
+        [B, h, w, 3] grid of its layer.
+    """
     anchors = np.array(anchors)
-    num_layers = anchors.shape[0] // 3
-    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
-    true_boxes = np.array(true_boxes, dtype='float32')
+    true_boxes = np.asarray(true_boxes, dtype='float32')
     input_shape = np.array(in_shape, dtype='int32')
+    # trans to box center point, input_shape is [h, w]
     boxes_xy = (true_boxes[..., 0:2] + true_boxes[..., 2:4]) // 2.
-    # trans to box center point
     boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
-    # input_shape is [h, w]
-    true_boxes[..., 0:2] = boxes_xy / input_shape[::-1]
-    true_boxes[..., 2:4] = boxes_wh / input_shape[::-1]
-    # true_boxes [x, y, w, h]
-
-    grid_shapes = [input_shape // 32, input_shape // 16, input_shape // 8]
-    # grid_shape [h, w]
-    y_true = [np.zeros((grid_shapes[l][0], grid_shapes[l][1], len(anchor_mask[l]),
-                        5 + num_classes), dtype='float32') for l in range(num_layers)]
-    # y_true [gridy, gridx]
-    anchors = np.expand_dims(anchors, 0)
-    anchors_max = anchors / 2.
-    anchors_min = -anchors_max
-    valid_mask = boxes_wh[..., 0] > 0
-
-    wh = boxes_wh[valid_mask]
-    if wh.size > 0:
-        wh = np.expand_dims(wh, -2)
-        boxes_max = wh / 2.
-        boxes_min = -boxes_max
-
-        intersect_min = np.maximum(boxes_min, anchors_min)
-        intersect_max = np.minimum(boxes_max, anchors_max)
-        intersect_wh = np.maximum(intersect_max - intersect_min, 0.)
-        intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
-        box_area = wh[..., 0] * wh[..., 1]
-        anchor_area = anchors[..., 0] * anchors[..., 1]
-        iou = intersect_area / (box_area + anchor_area - intersect_area)
-
-        best_anchor = np.argmax(iou, axis=-1)
-        for t, n in enumerate(best_anchor):
-            for l in range(num_layers):
-                if n in anchor_mask[l]:
-                    i = np.floor(true_boxes[t, 0] * grid_shapes[l][1]).astype('int32')  # grid_y
-                    j = np.floor(true_boxes[t, 1] * grid_shapes[l][0]).astype('int32')  # grid_x
-
-                    k = anchor_mask[l].index(n)
-                    c = true_boxes[t, 4].astype('int32')
-                    y_true[l][j, i, k, 0:4] = true_boxes[t, 0:4]
-                    y_true[l][j, i, k, 4] = 1.
-
-                    # lable-smooth
-                    if label_smooth:
-                        sigma = label_smooth_factor/(num_classes-1)
-                        y_true[l][j, i, k, 5:] = sigma
-                        y_true[l][j, i, k, 5+c] = 1-label_smooth_factor
-                    else:
-                        y_true[l][j, i, k, 5 + c] = 1.
-
-    # pad_gt_boxes for avoiding dynamic shape
-    pad_gt_box0 = np.zeros(shape=[max_boxes, 4], dtype=np.float32)
-    pad_gt_box1 = np.zeros(shape=[max_boxes, 4], dtype=np.float32)
-    pad_gt_box2 = np.zeros(shape=[max_boxes, 4], dtype=np.float32)
-
-    mask0 = np.reshape(y_true[0][..., 4:5], [-1])
-    gt_box0 = np.reshape(y_true[0][..., 0:4], [-1, 4])
-    # gt_box [boxes, [x,y,w,h]]
-    gt_box0 = gt_box0[mask0 == 1]
-    # gt_box0: get all boxes which have object
-    pad_gt_box0[:gt_box0.shape[0]] = gt_box0
-    # gt_box0.shape[0]: total number of boxes in gt_box0
-    # top N of pad_gt_box0 is real box, and after are pad by zero
-
-    mask1 = np.reshape(y_true[1][..., 4:5], [-1])
-    gt_box1 = np.reshape(y_true[1][..., 0:4], [-1, 4])
-    gt_box1 = gt_box1[mask1 == 1]
-    pad_gt_box1[:gt_box1.shape[0]] = gt_box1
-
-    mask2 = np.reshape(y_true[2][..., 4:5], [-1])
-    gt_box2 = np.reshape(y_true[2][..., 0:4], [-1, 4])
-
-    gt_box2 = gt_box2[mask2 == 1]
-    pad_gt_box2[:gt_box2.shape[0]] = gt_box2
-    return y_true[0], y_true[1], y_true[2], pad_gt_box0, pad_gt_box1, pad_gt_box2
+    boxes_xywh = np.concatenate([boxes_xy / input_shape[::-1], boxes_wh / input_shape[::-1]],
+                                axis=-1).astype('float32')
+
+    img_index, box_index = np.nonzero(boxes_wh[..., 0] > 0)
+    wh = np.expand_dims(boxes_wh[img_index, box_index], -2)
+    anchors_max = np.expand_dims(anchors, 0) / 2.
+    boxes_max = wh / 2.
+    intersect_wh = np.maximum(np.minimum(boxes_max, anchors_max) - np.maximum(-boxes_max, -anchors_max), 0.)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = wh[..., 0] * wh[..., 1]
+    anchor_area = anchors[..., 0] * anchors[..., 1]
+    best_anchor = np.argmax(intersect_area / (box_area + anchor_area - intersect_area), axis=-1)
+    xywh = boxes_xywh[img_index, box_index]
+
+    num_boxes = img_index.shape[0]
+    layer = np.zeros(num_boxes, dtype='int32')
+    gy = np.zeros(num_boxes, dtype='int32')
+    gx = np.zeros(num_boxes, dtype='int32')
+    cell = np.zeros(num_boxes, dtype=np.int64)
+    last = np.zeros(num_boxes, dtype=bool)
+    for l, mask in enumerate(ANCHOR_MASK):
+        grid_h, grid_w = input_shape // (32 >> l)
+        sel = np.flatnonzero(np.isin(best_anchor, mask))
+        layer[sel] = l
+        gx[sel] = np.floor(xywh[sel, 0].astype(np.float64) * grid_w).astype('int32')
+        gy[sel] = np.floor(xywh[sel, 1].astype(np.float64) * grid_h).astype('int32')
+        cell[sel] = ((img_index[sel] * grid_h + gy[sel]) * grid_w + gx[sel]) * len(mask) + best_anchor[sel] - mask[0]
+        # the last box of every occupied cell
+        _, last_pos = np.unique(cell[sel][::-1], return_index=True)
+        last[sel[sel.shape[0] - 1 - last_pos]] = True
+    return {'img_index': img_index, 'box_index': box_index, 'layer': layer, 'gy': gy, 'gx': gx,
+            'anchor': best_anchor % 3, 'classes': true_boxes[img_index, box_index, 4].astype('int32'),
+            'xywh': xywh, 'last': last, 'cell': cell}
+
+
+def _batch_true_boxes(true_boxes, anchors, in_shape, num_classes,
+                      max_boxes, label_smooth, label_smooth_factor=0.1):
+    """
+    Dense targets of a whole batch of padded annotation boxes at once.
+
+    The boxes assigned by _assign_true_boxes are scattered into the batch grids with fancy
+    indexing. A shared cell keeps the coordinates of its last box, without label smoothing the
+    classes of all of its boxes stay set, as when the boxes were written one by one.
+
+    Args:
+        true_boxes: Array of shape [B, N, 5], [x_min, y_min, x_max, y_max, label] padded with zeros.
+        anchors: List. The 9 anchors [w, h], small to big.
+        in_shape: List. Input (h, w).
+        num_classes: Integer. Number of classes.
+        max_boxes: Integer. Rows of the padded gt boxes.
+        label_smooth: Bool. Smooth the one-hot classes.
+        label_smooth_factor: Float. Smooth strength. Default: 0.1.
+
+    Returns:
+        Tuple, the grids of the stride 32, 16 and 8 layers, each [B, h, w, 3, 5 + num_classes],
+        then their padded gt boxes [x, y, w, h], each [B, max_boxes, 4].
+    """
+    batch_size = np.shape(true_boxes)[0]
+    input_shape = np.array(in_shape, dtype='int32')
+    boxes = _assign_true_boxes(true_boxes, anchors, in_shape)
+    classes, xywh = boxes['classes'], boxes['xywh']
+    y_true = []
+    pad_gt_boxes = []
+    for l, mask in enumerate(ANCHOR_MASK):
+        grid_h, grid_w = input_shape // (32 >> l)
+        layer = np.zeros((batch_size, grid_h, grid_w, len(mask), 5 + num_classes), dtype='float32')
+        pad_gt_box = np.zeros((batch_size, max_boxes, 4), dtype='float32')
+        sel = np.flatnonzero(boxes['layer'] == l)
+        # the boxes a cell keeps, in the grid's row-major order
+        last = sel[boxes['last'][sel]]
+        last = last[np.argsort(boxes['cell'][last])]
+        cells = boxes['cell'][last]
+        flat = layer.reshape(-1, 5 + num_classes)
+        flat[cells, 0:4] = xywh[last]
+        flat[cells, 4] = 1.
+        if label_smooth:
+            flat[cells, 5:] = label_smooth_factor / (num_classes - 1)
+            flat[cells, 5 + classes[last]] = 1 - label_smooth_factor
+        else:
+            flat[boxes['cell'][sel], 5 + classes[sel]] = 1.
+        # pad_gt_boxes for avoiding dynamic shape, the occupied cells of an image first
+        owner = boxes['img_index'][last]
+        rank = np.arange(last.shape[0]) - np.searchsorted(owner, owner)
+        pad_gt_box[owner, rank] = xywh[last]
+        y_true.append(layer)
+        pad_gt_boxes.append(pad_gt_box)
+    return (*y_true, *pad_gt_boxes)
+
+
+def _batch_sparse_targets(true_boxes, anchors, in_shape, max_boxes):
+    """
+    Sparse targets of a batch of padded annotation boxes, one row per box.
+
+    Rows follow SPARSE_TARGET_COLUMNS and sit at the position of their box, rows of padding and
+    invalid boxes have scale -1. SparseTargets in src/yolo.py scatters them into the dense grids
+    and gt boxes of _batch_true_boxes on device.
+
+    Args:
+        true_boxes: Array of shape [B, N, 5], [x_min, y_min, x_max, y_max, label] padded with zeros.
+        anchors: List. The 9 anchors [w, h], small to big.
+        in_shape: List. Input (h, w).
+        max_boxes: Integer. Rows per image, at least N.
+
+    Returns:
+        Array of shape [B, max_boxes, 10], float32.
+    """
+    boxes = _assign_true_boxes(true_boxes, anchors, in_shape)
+    rows = np.zeros((np.shape(true_boxes)[0], max_boxes, len(SPARSE_TARGET_COLUMNS)), dtype='float32')
+    rows[..., 0] = -1
+    rows[boxes['img_index'], boxes['box_index']] = np.concatenate(
+        [np.stack([boxes['layer'], boxes['gy'], boxes['gx'], boxes['anchor']], axis=-1), boxes['xywh'],
+         np.stack([boxes['classes'], boxes['last']], axis=-1)], axis=-1)
+    return rows
+
+
+def cv2_image_reshape(interp):
+    """cv2 counterpart of pil_image_reshape."""
+    reshape_type = {
+        0: cv2.INTER_NEAREST_EXACT,
+        1: cv2.INTER_LINEAR,
+        2: cv2.INTER_CUBIC,
+        3: cv2.INTER_NEAREST_EXACT,
+        4: cv2.INTER_LANCZOS4,
+    }
+    return reshape_type[interp]
+
+
+# imread flags decoding at 1/1, 1/2, 1/4 and 1/8 of the stored resolution
+_IMREAD_REDUCED = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def normalize_chw(img, bgr=False, out=None):
+    """
+    Statistic normalize a uint8 HWC image straight into a float32 CHW array.
+
+    Every output channel is written by one scale and shift in float32, without the float64
+    temporaries and the separate transpose of statistic_normalize_img.
+
+    Args:
+        img: Array of shape [H, W, 3], uint8.
+        bgr: Bool. The channels are in cv2's BGR order and are swapped to RGB on the way. Default: False.
+        out: Array of shape [3, H, W], float32, e.g. one image of a preallocated batch. Default: None.
+    """
+    scale, shift = normalize_coefs()
+    if out is None:
+        out = np.empty((3,) + img.shape[:2], np.float32)
+    for c in range(3):
+        np.multiply(img[..., 2 - c if bgr else c], scale[c], out=out[c], dtype=np.float32)
+        out[c] -= shift[c]
+    return out
+
+
+def decode_eval_image(file_path, image_size=None, reduce=1):
+    """
+    Decode an eval or test image exactly once into the network input.
+
+    Args:
+        file_path: String. Image file, read with np.fromfile so non-ascii paths work.
+        image_size: List. (h, w) to resize to, None keeps the decoded size. Default: None.
+        reduce: Integer. Decode at 1/reduce of the stored resolution, one of 1, 2, 4 and 8. Only JPEG is
+            decoded at the lower resolution, TIF and PNG are decoded in full and then downsampled, which
+            saves nothing. Default: 1.
+
+    Returns:
+        Tuple (float32 CHW normalized RGB image, decoded (w, h)).
+    """
+    img = cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), _IMREAD_REDUCED[reduce])
+    if img is None:
+        raise ValueError("Can not decode {}.".format(file_path))
+    ori_h, ori_w = img.shape[:2]
+    if image_size is not None:
+        h, w = image_size
+        interp = get_interp_method(interp=9, sizes=(ori_h, ori_w, h, w))
+        img = cv2.resize(img, (w, h), interpolation=cv2_image_reshape(interp))
+    return normalize_chw(img, bgr=True), (ori_w, ori_h)
 
 
 def _reshape_data(image, image_size):
@@ -237,31 +369,14 @@ def _reshape_data(image, image_size):
     image_data = image_data.astype(np.float32)
     return image_data, ori_image_shape
 
-def _reshape_seg(image, image_size):
-    """Reshape seg image."""
-    if not isinstance(image, Image.Image):
-        image = Image.fromarray(image)
-    h, w = image_size
-    # interp = get_interp_method(interp=9, sizes=(ori_h, ori_w, h, w))
-    image = image.resize((w, h), 0)
-    # image_data = statistic_normalize_img(image, statistic_norm=True)
-    # if len(image_data.shape) == 2:
-    #     image_data = np.expand_dims(image_data, axis=-1)
-    #     image_data = np.concatenate([image_data, image_data, image_data], axis=-1)
-    image = np.array(image)
-    image_data = image.astype(np.float32)
-    image_data = np.expand_dims(image_data, 0)
-    return image_data
+def _hsv_lut(hue, sat, val):
+    """
+    Lookup table of shape [256, 1, 3] applying a hue shift and saturation / value scaling to uint8 HSV_FULL.
 
-def color_distortion(img, hue, sat, val, device_num):
-    """Color distortion."""
-    hue = _rand(-hue, hue)
-    sat = _rand(1, sat) if _rand() < .5 else 1 / _rand(1, sat)
-    val = _rand(1, val) if _rand() < .5 else 1 / _rand(1, val)
-    if device_num != 1:
-        cv2.setNumThreads(1)
-    x = cv2.cvtColor(img, cv2.COLOR_RGB2HSV_FULL)
-    x = x / 255.
+    Every entry goes through the float steps color_distortion used to run on whole images, so
+    the table gives the very same uint8 values.
+    """
+    x = np.repeat(np.arange(256, dtype=np.float64)[:, None], 3, axis=1) / 255.
     x[..., 0] += hue
     x[..., 0][x[..., 0] > 1] -= 1
     x[..., 0][x[..., 0] < 0] += 1
@@ -270,13 +385,47 @@ def color_distortion(img, hue, sat, val, device_num):
     x[x > 1] = 1
     x[x < 0] = 0
     x = x * 255.
-    x = x.astype(np.uint8)
+    return x.astype(np.uint8).reshape(256, 1, 3)
+
+
+def color_distortion(img, hue, sat, val, device_num):
+    """Color distortion."""
+    hue = _rand(-hue, hue)
+    sat = _rand(1, sat) if _rand() < .5 else 1 / _rand(1, sat)
+    val = _rand(1, val) if _rand() < .5 else 1 / _rand(1, val)
+    if device_num != 1:
+        cv2.setNumThreads(1)
+    x = cv2.cvtColor(img, cv2.COLOR_RGB2HSV_FULL)
+    # per channel uint8 lookup, no float image
+    x = cv2.LUT(x, _hsv_lut(hue, sat, val))
     image_data = cv2.cvtColor(x, cv2.COLOR_HSV2RGB_FULL)
     return image_data
 
 
-def filp_pil_image(img):
-    return img.transpose(Image.FLIP_LEFT_RIGHT)
+def _place_on_canvas(img, dx, dy, nw, nh, flip, input_w, input_h, interp, fill):
+    """
+    Resize to (nw, nh), paste at (dx, dy) on an input_w x input_h canvas of fill and mirror on flip.
+
+    Shrinking resizes with INTER_AREA, which antialiases like PIL, growing with interp. The visible
+    part of the resized image is copied once, already mirrored when flip is set.
+    """
+    h, w = img.shape[:2]
+    if (nw, nh) != (w, h):
+        if interp not in (cv2.INTER_NEAREST, cv2.INTER_NEAREST_EXACT) and (nw < w or nh < h):
+            interp = cv2.INTER_AREA
+        img = cv2.resize(img, (nw, nh), interpolation=interp)
+    canvas = np.empty((input_h, input_w) + img.shape[2:], img.dtype)
+    canvas[...] = fill
+    x0, x1 = max(dx, 0), min(dx + nw, input_w)
+    y0, y1 = max(dy, 0), min(dy + nh, input_h)
+    if x0 >= x1 or y0 >= y1:
+        return canvas
+    patch = img[y0 - dy:y1 - dy, x0 - dx:x1 - dx]
+    if flip:
+        canvas[y0:y1, input_w - x1:input_w - x0] = patch[:, ::-1]
+    else:
+        canvas[y0:y1, x0:x1] = patch
+    return canvas
 
 
 def convert_gray_to_color(img):
@@ -384,7 +533,7 @@ def _correct_bbox_by_candidates(candidates, input_w, input_h, image_w,
 
 
 def _data_aug(image, box, jitter, hue, sat, val, image_input_size, max_boxes,
-              anchors, num_classes, max_trial=10, device_num=1):
+              anchors, num_classes, max_trial=10, device_num=1, mask=None):
     """Crop an image randomly with bounding box constraints.
 
         This data augmentation is used in training of
@@ -392,15 +541,19 @@ def _data_aug(image, box, jitter, hue, sat, val, image_input_size, max_boxes,
         data augmentation section of the original paper.
         .. [#] Wei Liu, Dragomir Anguelov, Dumitru Erhan, Christian Szegedy,
            Scott Reed, Cheng-Yang Fu, Alexander C. Berg.
-           SSD: Single Shot MultiBox Detector. ECCV 2016."""
+           SSD: Single Shot MultiBox Detector. ECCV 2016.
 
-    if not isinstance(image, Image.Image):
-        image = Image.fromarray(image)
+        A mask given along goes through the same scale, offset and flip with nearest neighbour
+        interpolation and zero padding."""
 
-    image_w, image_h = image.size
+    if isinstance(image, Image.Image):
+        image = np.array(image)
+
+    image_h, image_w = image.shape[:2]
     input_h, input_w = image_input_size
 
-    np.random.shuffle(box)
+    # a shuffled copy, box may be a read-only view of the annotation index
+    box = np.random.permutation(box)
     if len(box) > max_boxes:
         box = box[:max_boxes]
     flip = _rand() < .5
@@ -425,28 +578,21 @@ def _data_aug(image, box, jitter, hue, sat, val, image_input_size, max_boxes,
                                                       allow_outside_center=True)
     dx, dy, nw, nh = candidate
     interp = get_interp_method(interp=10)
-    image = image.resize((nw, nh), pil_image_reshape(interp))
-    # place image, gray color as back graoud
-    new_image = Image.new('RGB', (input_w, input_h), (128, 128, 128))
-    new_image.paste(image, (dx, dy))
-    image = new_image
-
-    if flip:
-        image = filp_pil_image(image)
-
-    image = np.array(image)
+    # resize, paste on a gray canvas and flip with one copy of the visible part
+    image = _place_on_canvas(image, dx, dy, nw, nh, flip, input_w, input_h, cv2_image_reshape(interp),
+                             (128, 128, 128))
+    if mask is not None:
+        mask = _place_on_canvas(mask, dx, dy, nw, nh, flip, input_w, input_h, cv2.INTER_NEAREST_EXACT, 0)
 
     image = convert_gray_to_color(image)
 
+    # left in uint8 HWC, the caller normalizes into its batch or leaves it to the device
     image_data = color_distortion(image, hue, sat, val, device_num)
-    image_data = statistic_normalize_img(image_data, statistic_norm=True)
-
-    image_data = image_data.astype(np.float32)
 
-    return image_data, box_data
+    return image_data, box_data, mask
 
 
-def preprocess_fn(image, box, config, input_size, device_num):
+def preprocess_fn(image, box, config, input_size, device_num, mask=None):
     """Preprocess data function."""
     config_anchors = config.anchor_scales
     anchors = np.array([list(x) for x in config_anchors])
@@ -456,10 +602,10 @@ def preprocess_fn(image, box, config, input_size, device_num):
     hue = config.hue
     sat = config.saturation
     val = config.value
-    image, anno = _data_aug(image, box, jitter=jitter, hue=hue, sat=sat, val=val,
-                            image_input_size=input_size, max_boxes=max_boxes,
-                            num_classes=num_classes, anchors=anchors, device_num=device_num)
-    return image, anno
+    image, anno, mask = _data_aug(image, box, jitter=jitter, hue=hue, sat=sat, val=val,
+                                  image_input_size=input_size, max_boxes=max_boxes,
+                                  num_classes=num_classes, anchors=anchors, device_num=device_num, mask=mask)
+    return image, anno, mask
 
 
 def reshape_fn(image, img_id, config):
@@ -486,6 +632,8 @@ class MultiScaleTrans:
         self.max_box = config.max_box
         self.label_smooth = config.label_smooth
         self.label_smooth_factor = config.label_smooth_factor
+        self.sparse_targets = config.sparse_targets
+        self.device_normalize = config.device_normalize
         self.transform = aug_transforms.__dict__[config.transform] if config.transform else None
 
     def generate_seed_list(self, init_seed=1234, seed_num=int(1e6), seed_range=(1, 1000)):
@@ -502,14 +650,7 @@ class MultiScaleTrans:
         seed_key = self.seed_list[(epoch_num * self.resize_count_num + size_idx) % self.seed_num]
         ret_imgs = []
         ret_annos = []
-
-
-        bbox1 = []
-        bbox2 = []
-        bbox3 = []
-        gt1 = []
-        gt2 = []
-        gt3 = []
+        boxes = []
         seg_ann = []
 
         if self.size_dict.get(seed_key, None) is None:
@@ -518,8 +659,10 @@ class MultiScaleTrans:
             self.size_dict[seed_key] = new_size
         seed = seed_key
         input_size = self.size_dict[seed]
+        # host normalization writes every image once, straight into its slot of the CHW batch
+        batch = None if self.device_normalize else np.empty((len(imgs), 3) + tuple(input_size), np.float32)
 
-        for img, anno, s in zip(imgs, annos, seg):
+        for i, (img, anno, s) in enumerate(zip(imgs, annos, seg)):
             # print(type(anno), img.shape, s.shape)
             if self.transform:
                 s = s.transpose(1,2,0)
@@ -527,95 +670,29 @@ class MultiScaleTrans:
                 img, anno, s = transformed['image'], transformed['bboxes'], transformed['mask']
                 anno = np.array(anno)
                 s = s.transpose(2,0,1)
-            img, anno = preprocess_fn(img, anno, self.config, input_size, self.device_num)
-            ret_imgs.append(img.transpose(2, 0, 1).copy())
-            bbox_true_1, bbox_true_2, bbox_true_3, gt_box1, gt_box2, gt_box3 = \
-                _preprocess_true_boxes(true_boxes=anno, anchors=self.anchor_scales, in_shape=img.shape[0:2],
-                                       num_classes=self.num_classes, max_boxes=self.max_box,
-                                       label_smooth=self.label_smooth, label_smooth_factor=self.label_smooth_factor)
-            s = np.squeeze(s,0)
-            s= _reshape_seg(s, input_size)
-            bbox1.append(bbox_true_1)
-            bbox2.append(bbox_true_2)
-            bbox3.append(bbox_true_3)
-            gt1.append(gt_box1)
-            gt2.append(gt_box2)
-            gt3.append(gt_box3)
+            # the mask follows the image through the same resize, paste and flip
+            img, anno, s = preprocess_fn(img, anno, self.config, input_size, self.device_num, mask=np.squeeze(s,0))
+            if self.device_normalize:
+                ret_imgs.append(img)
+            else:
+                ret_imgs.append(normalize_chw(img, out=batch[i]))
+            s = np.expand_dims(s.astype(np.float32), 0)
+            boxes.append(anno)
             seg_ann.append(s)
             ret_annos.append(0)
-        # seg = [1]
+        # targets of the whole batch at once, handed out as one row per image
+        if self.sparse_targets:
+            targets = _batch_sparse_targets(true_boxes=np.stack(boxes), anchors=self.anchor_scales,
+                                            in_shape=input_size, max_boxes=self.max_box)
+            return ret_imgs, ret_annos, seg_ann, list(targets)
+        targets = _batch_true_boxes(true_boxes=np.stack(boxes), anchors=self.anchor_scales, in_shape=input_size,
+                                    num_classes=self.num_classes, max_boxes=self.max_box,
+                                    label_smooth=self.label_smooth, label_smooth_factor=self.label_smooth_factor)
+        bbox1, bbox2, bbox3, gt1, gt2, gt3 = [list(target) for target in targets]
         return ret_imgs, ret_annos, seg_ann, bbox1, bbox2, bbox3, gt1, gt2 , gt3
 
-def thread_batch_preprocess_true_box(annos, config, input_shape, result_index, batch_bbox_true_1, batch_bbox_true_2,
-                                     batch_bbox_true_3, batch_gt_box1, batch_gt_box2, batch_gt_box3):
-    """Preprocess true box for multi-thread."""
-    i = 0
-    for anno in annos:
-        bbox_true_1, bbox_true_2, bbox_true_3, gt_box1, gt_box2, gt_box3 = \
-            _preprocess_true_boxes(true_boxes=anno, anchors=config.anchor_scales, in_shape=input_shape,
-                                   num_classes=config.num_classes, max_boxes=config.max_box,
-                                   label_smooth=config.label_smooth, label_smooth_factor=config.label_smooth_factor)
-        batch_bbox_true_1[result_index + i] = bbox_true_1
-        batch_bbox_true_2[result_index + i] = bbox_true_2
-        batch_bbox_true_3[result_index + i] = bbox_true_3
-        batch_gt_box1[result_index + i] = gt_box1
-        batch_gt_box2[result_index + i] = gt_box2
-        batch_gt_box3[result_index + i] = gt_box3
-        i = i + 1
-
-
 def batch_preprocess_true_box(annos, config, input_shape):
-    """Preprocess true box with multi-thread."""
-    batch_bbox_true_1 = []
-    batch_bbox_true_2 = []
-    batch_bbox_true_3 = []
-    batch_gt_box1 = []
-    batch_gt_box2 = []
-    batch_gt_box3 = []
-    threads = []
-
-    step = 4
-    for index in range(0, len(annos), step):
-        for _ in range(step):
-            batch_bbox_true_1.append(None)
-            batch_bbox_true_2.append(None)
-            batch_bbox_true_3.append(None)
-            batch_gt_box1.append(None)
-            batch_gt_box2.append(None)
-            batch_gt_box3.append(None)
-        step_anno = annos[index: index + step]
-        t = threading.Thread(target=thread_batch_preprocess_true_box,
-                             args=(step_anno, config, input_shape, index, batch_bbox_true_1, batch_bbox_true_2,
-                                   batch_bbox_true_3, batch_gt_box1, batch_gt_box2, batch_gt_box3))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        t.join()
-
-    return np.array(batch_bbox_true_1), np.array(batch_bbox_true_2), np.array(batch_bbox_true_3), \
-           np.array(batch_gt_box1), np.array(batch_gt_box2), np.array(batch_gt_box3)
-
-
-def batch_preprocess_true_box_single(annos, config, input_shape):
-    """Preprocess true boxes."""
-    batch_bbox_true_1 = []
-    batch_bbox_true_2 = []
-    batch_bbox_true_3 = []
-    batch_gt_box1 = []
-    batch_gt_box2 = []
-    batch_gt_box3 = []
-    for anno in annos:
-        bbox_true_1, bbox_true_2, bbox_true_3, gt_box1, gt_box2, gt_box3 = \
-            _preprocess_true_boxes(true_boxes=anno, anchors=config.anchor_scales, in_shape=input_shape,
-                                   num_classes=config.num_classes, max_boxes=config.max_box,
-                                   label_smooth=config.label_smooth, label_smooth_factor=config.label_smooth_factor)
-        batch_bbox_true_1.append(bbox_true_1)
-        batch_bbox_true_2.append(bbox_true_2)
-        batch_bbox_true_3.append(bbox_true_3)
-        batch_gt_box1.append(gt_box1)
-        batch_gt_box2.append(gt_box2)
-        batch_gt_box3.append(gt_box3)
-
-    return np.array(batch_bbox_true_1), np.array(batch_bbox_true_2), np.array(batch_bbox_true_3), \
-           np.array(batch_gt_box1), np.array(batch_gt_box2), np.array(batch_gt_box3)
+    """Targets of a batch of padded annotations, see _batch_true_boxes."""
+    return _batch_true_boxes(np.stack(annos), anchors=config.anchor_scales, in_shape=input_shape,
+                             num_classes=config.num_classes, max_boxes=config.max_box,
+                             label_smooth=config.label_smooth, label_smooth_factor=config.label_smooth_factor)
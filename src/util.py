@@ -13,17 +13,19 @@
 # limitations under the License.
 # ============================================================================
 """Util class or function."""
-import sys
-from collections import defaultdict
-import datetime
+import threading
 import numpy as np
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
 
 import mindspore as ms
 
 
 from .yolo import YoloLossBlock
+from .nms import batched_nms
+from .detection_store import DetectionStore
+from .result_writer import create_result_writer
+from .coco_eval import evaluate_detections
+from .coco_cache import load_coco
+from .map_accumulator import MapAccumulator
 
 
 class AverageMeter:
@@ -165,17 +167,6 @@ def cpu_affinity(rank_id, device_num):
     print(f"==== {rank_id}/{device_num} ==== bind cpu: {used_cpu_list}")
 
 
-class Redirct:
-    def __init__(self):
-        self.content = ""
-
-    def write(self, content):
-        self.content += content
-
-    def flush(self):
-        self.content = ""
-
-
 class DetectionEngine:
     """Detection engine."""
     def __init__(self, args):
@@ -191,140 +182,221 @@ class DetectionEngine:
                        'keyboard', 'cell phone', 'microwave', 'oven', 'toaster', 'sink', 'refrigerator', 'book',
                        'clock', 'vase', 'scissors', 'teddy bear', 'hair drier', 'toothbrush']
         self.num_classes = len(self.labels)
-        self.results = {}
+        # raw candidates waiting for NMS, empty in streaming mode
+        self.results = DetectionStore()
         self.file_path = ''
         self.save_prefix = args.outputs_dir
         self.annFile = args.annFile
-        self._coco = COCO(self.annFile)
+        self._coco = load_coco(self.annFile, args.coco_cache)
         self._img_ids = list(sorted(self._coco.imgs.keys()))
-        self.det_boxes = []
+        self.det_boxes = DetectionStore()
         self.nms_thresh = args.nms_thresh
+        self.nms_pre_top_k = args.nms_pre_top_k
+        # streaming NMS-es every image as soon as its batch is decoded and only keeps the survivors,
+        # it needs all heads of an image to come in a single detect call
+        # the candidate cache needs every candidate, so caching turns streaming off
+        self.streaming = args.eval_streaming and not args.cache_candidates
         self.coco_catIds = self._coco.getCatIds()
+        # surviving boxes are handed to a background writer as they are produced
+        self.result_format = args.result_format
+        self._writer = None
+        self.coco_eval_workers = args.coco_eval_workers
+        # running mAP, updated with the final boxes of every image as it is finished
+        self.map_accumulator = MapAccumulator(self._coco) if args.eval_running_map else None
+        # detect may be called from several postprocessing threads, decode, NMS and the running mAP run unlocked
+        self._lock = threading.Lock()
+
+    @property
+    def coco(self):
+        """Ground truth COCO of the annotation file."""
+        return self._coco
 
     def do_nms_for_results(self):
         """Get result boxes."""
-        for img_id in self.results:
-            for clsi in self.results[img_id]:
-                dets = self.results[img_id][clsi]
-                dets = np.array(dets)
-                keep_index = self._nms(dets, self.nms_thresh)
-
-                keep_box = [{'image_id': int(img_id),
-                             'category_id': int(clsi),
-                             'bbox': list(dets[i][:4].astype(float)),
-                             'score': dets[i][4].astype(float)}
-                            for i in keep_index]
-                self.det_boxes.extend(keep_box)
-
-    def _nms(self, predicts, threshold):
-        """Calculate NMS."""
-        # convert xywh -> xmin ymin xmax ymax
-        x1 = predicts[:, 0]
-        y1 = predicts[:, 1]
-        x2 = x1 + predicts[:, 2]
-        y2 = y1 + predicts[:, 3]
-        scores = predicts[:, 4]
-
-        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-        order = scores.argsort()[::-1]
-
-        reserved_boxes = []
-        while order.size > 0:
-            i = order[0]
-            reserved_boxes.append(i)
-            max_x1 = np.maximum(x1[i], x1[order[1:]])
-            max_y1 = np.maximum(y1[i], y1[order[1:]])
-            min_x2 = np.minimum(x2[i], x2[order[1:]])
-            min_y2 = np.minimum(y2[i], y2[order[1:]])
-
-            intersect_w = np.maximum(0.0, min_x2 - max_x1 + 1)
-            intersect_h = np.maximum(0.0, min_y2 - max_y1 + 1)
-            intersect_area = intersect_w * intersect_h
-            ovr = intersect_area / (areas[i] + areas[order[1:]] - intersect_area)
-
-            indexes = np.where(ovr <= threshold)[0]
-            order = order[indexes + 1]
-        return reserved_boxes
+        with self._lock:
+            start = len(self.det_boxes)
+            finished = [self._nms_image(img_id, classes, boxes, scores)
+                        for img_id, classes, boxes, scores in self.results.iter_images()]
+            for result in finished:
+                self.det_boxes.append(*result)
+            self.results.clear()
+            self._write_boxes(start)
+        self._update_running_map(finished)
+
+    def _nms_image(self, img_id, classes, boxes, scores):
+        """NMS the candidates of one image, returns its surviving boxes."""
+        keep_index = batched_nms(boxes, scores, classes, self.nms_thresh, self.nms_pre_top_k)
+        return img_id, classes[keep_index], boxes[keep_index], scores[keep_index]
+
+    def _update_running_map(self, finished, empty=()):
+        """Match the final boxes of finished images for the running mAP, MapAccumulator has its own lock."""
+        if self.map_accumulator is None:
+            return
+        for img_id in empty:
+            self.map_accumulator.update(img_id, [], np.zeros((0, 4)), [])
+        for result in finished:
+            self.map_accumulator.update(*result)
+
+    def running_map(self):
+        """Provisional AP, AP50 and AP75 of the images finished so far, None when disabled."""
+        if self.map_accumulator is None:
+            return None
+        return self.map_accumulator.summary()
+
+    def _write_boxes(self, start):
+        """Send the result boxes from row `start` on to the result writer."""
+        if self._writer is None:
+            self._writer = create_result_writer(self.save_prefix, self.result_format)
+        self._writer.write(self.det_boxes.image_ids[start:], self.det_boxes.category_ids[start:],
+                           self.det_boxes.boxes[start:], self.det_boxes.scores[start:])
 
     def write_result(self):
         """Save result to file."""
-        import json
-        t = datetime.datetime.now().strftime('_%Y_%m_%d_%H_%M_%S')
-        try:
-            self.file_path = self.save_prefix + '/predict' + t + '.json'
-            f = open(self.file_path, 'w')
-            json.dump(self.det_boxes, f)
-        except IOError as e:
-            raise RuntimeError("Unable to open json file to dump. What(): {}".format(str(e)))
-        else:
-            f.close()
-            return self.file_path
+        if self._writer is None:
+            self._write_boxes(0)
+        self.file_path = self._writer.close()
+        self._writer = None
+        return self.file_path
 
     def get_eval_result(self):
-        """Get eval result."""
-        cocoGt = COCO(self.annFile)
-        cocoDt = cocoGt.loadRes(self.file_path)
-        cocoEval = COCOeval(cocoGt, cocoDt, 'bbox')
-        cocoEval.evaluate()
-        cocoEval.accumulate()
-        rdct = Redirct()
-        stdout = sys.stdout
-        sys.stdout = rdct
-        cocoEval.summarize()
-        sys.stdout = stdout
-        return rdct.content
+        """
+        Get eval result as a dict of COCO metrics, see coco_eval.COCO_METRICS.
+
+        coco_eval_workers > 1 forks, call it after the EvalPipeline feeding the engine is closed.
+        """
+        if self._writer is not None:
+            # join the writer thread before the evaluation forks
+            self.write_result()
+        return evaluate_detections(self._coco, self.det_boxes.to_ndarray(), workers=self.coco_eval_workers)
+
+    def detect_batch(self, outputs, image_shape, image_id):
+        """Decode the heads of a whole batch into flat arrays of COCO detections."""
+        img_ids, clsi, boxes, scores = decode_outputs(outputs, image_shape, image_id, self.eval_ignore_threshold)
+        # transform catId to match coco
+        coco_clsi = np.asarray(self.coco_catIds)[clsi]
+        return img_ids, coco_clsi, boxes, scores
+
+    def nms_batch(self, outputs, image_shape, image_id):
+        """
+        Decode and NMS the heads of a batch without touching the engine state.
+
+        Returns:
+            Tuple (finished, empty), finished are the surviving (img_id, classes, boxes, scores) of every
+            image with candidates and empty are the ids of the images without any.
+        """
+        img_ids, coco_clsi, boxes, scores = self.detect_batch(outputs, image_shape, image_id)
+        # candidates come grouped by image
+        split = np.flatnonzero(np.diff(img_ids)) + 1
+        finished = [self._nms_image(img_ids[index[0]], coco_clsi[index], boxes[index], scores[index])
+                    for index in np.split(np.arange(img_ids.shape[0]), split) if index.shape[0]]
+        empty = np.setdiff1d(np.asarray(image_id).reshape(-1).astype(np.int64), img_ids).tolist()
+        return finished, empty
+
+    def add_finished(self, finished, empty=()):
+        """Keep the results of nms_batch, the ground truth of the empty images still counts in the running mAP."""
+        self._update_running_map(finished, empty)
+        with self._lock:
+            start = len(self.det_boxes)
+            for result in finished:
+                self.det_boxes.append(*result)
+            self._write_boxes(start)
 
     def detect(self, outputs, batch, image_shape, image_id):
         """Detect boxes."""
-        outputs_num = len(outputs)
-        # output [|32, 52, 52, 3, 85| ]
-        for batch_id in range(batch):
-            for out_id in range(outputs_num):
-                # 32, 52, 52, 3, 85
-                out_item = outputs[out_id]
-                # 52, 52, 3, 85
-                out_item_single = out_item[batch_id, :]
-                # get number of items in one head, [B, gx, gy, anchors, 5+80]
-                dimensions = out_item_single.shape[:-1]
-                out_num = 1
-                for d in dimensions:
-                    out_num *= d
-                ori_w, ori_h = image_shape[batch_id]
-                img_id = int(image_id[batch_id])
-                x = out_item_single[..., 0] * ori_w
-                y = out_item_single[..., 1] * ori_h
-                w = out_item_single[..., 2] * ori_w
-                h = out_item_single[..., 3] * ori_h
-
-                conf = out_item_single[..., 4:5]
-                cls_emb = out_item_single[..., 5:]
-
-                cls_argmax = np.expand_dims(np.argmax(cls_emb, axis=-1), axis=-1)
-                x = x.reshape(-1)
-                y = y.reshape(-1)
-                w = w.reshape(-1)
-                h = h.reshape(-1)
-                cls_emb = cls_emb.reshape(-1, self.num_classes)
-                conf = conf.reshape(-1)
-                cls_argmax = cls_argmax.reshape(-1)
-
-                x_top_left = x - w / 2.
-                y_top_left = y - h / 2.
-                # create all False
-                flag = np.random.random(cls_emb.shape) > sys.maxsize
-                for i in range(flag.shape[0]):
-                    c = cls_argmax[i]
-                    flag[i, c] = True
-                confidence = cls_emb[flag] * conf
-                for x_lefti, y_lefti, wi, hi, confi, clsi in zip(x_top_left, y_top_left, w, h, confidence, cls_argmax):
-                    if confi < self.eval_ignore_threshold:
-                        continue
-                    if img_id not in self.results:
-                        self.results[img_id] = defaultdict(list)
-                    x_lefti = max(0, x_lefti)
-                    y_lefti = max(0, y_lefti)
-                    wi = min(wi, ori_w)
-                    hi = min(hi, ori_h)
-                    # transform catId to match coco
-                    coco_clsi = self.coco_catIds[clsi]
-                    self.results[img_id][coco_clsi].append([x_lefti, y_lefti, wi, hi, confi])
+        outputs = [out[:batch] for out in outputs]
+        image_id = np.asarray(image_id).reshape(-1)[:batch]
+        if self.streaming:
+            # finish each image right away
+            self.add_finished(*self.nms_batch(outputs, image_shape, image_id))
+            return
+        img_ids, coco_clsi, boxes, scores = self.detect_batch(outputs, image_shape, image_id)
+        empty = []
+        if self.map_accumulator is not None:
+            # images without any candidate are finished already, their ground truth still counts
+            empty = np.setdiff1d(image_id.astype(np.int64), img_ids).tolist()
+        self._update_running_map((), empty)
+        with self._lock:
+            self.results.append(img_ids, coco_clsi, boxes, scores)
+
+
+def _to_image_boxes(xywh, image_shape):
+    """Normalized center boxes to clipped top-left boxes in original image pixels, image_shape is (w, h) per box."""
+    ori_w = image_shape[:, 0]
+    ori_h = image_shape[:, 1]
+    w = xywh[:, 2] * ori_w
+    h = xywh[:, 3] * ori_h
+    x_top_left = np.maximum(xywh[:, 0] * ori_w - w / 2., 0)
+    y_top_left = np.maximum(xywh[:, 1] * ori_h - h / 2., 0)
+    return np.stack([x_top_left, y_top_left, np.minimum(w, ori_w), np.minimum(h, ori_h)], axis=-1)
+
+
+def decode_outputs(outputs, image_shape, image_id, ignore_threshold):
+    """Decode either dense head outputs or the [B, K, 6] top K outputs of DetectionBlock."""
+    if outputs and np.ndim(outputs[0]) == 3:
+        return decode_topk_detections(outputs, image_shape, image_id, ignore_threshold)
+    return decode_detections(outputs, image_shape, image_id, ignore_threshold)
+
+
+def decode_topk_detections(outputs, image_shape, image_id, ignore_threshold):
+    """
+    Decode the top K outputs of DetectionBlock, already scored and thresholded in graph.
+
+    Args:
+        outputs: List of head outputs, each of shape [B, K, 6] of [x, y, w, h, score, class].
+        image_shape: Array of shape [B, 2], original (w, h) of every image.
+        image_id: Array of shape [B], image id of every image.
+        ignore_threshold: Float. Candidates scoring below it are dropped.
+
+    Returns:
+        Same as decode_detections.
+    """
+    image_shape = np.asarray(image_shape, dtype=np.float32).reshape(-1, 2)
+    image_id = np.asarray(image_id).reshape(-1).astype(np.int64)
+    if not outputs:
+        return (np.zeros(0, np.int64), np.zeros(0, np.int64),
+                np.zeros((0, 4), np.float32), np.zeros(0, np.float32))
+    dets = np.concatenate([np.asarray(out_item, dtype=np.float32) for out_item in outputs], axis=1)
+    # slots the graph zeroed out are padding, nonzero keeps the image-major order
+    b, n = np.nonzero((dets[..., 4] >= ignore_threshold) & (dets[..., 4] > 0))
+    keep = dets[b, n]
+    return (image_id[b], keep[:, 5].astype(np.int64), _to_image_boxes(keep[:, :4], image_shape[b]).astype(np.float32),
+            keep[:, 4])
+
+
+def decode_detections(outputs, image_shape, image_id, ignore_threshold):
+    """
+    Decode dense YOLO head outputs of a batch with array ops only.
+
+    Args:
+        outputs: List of head outputs, each of shape [B, gy, gx, anchors, 5+num_classes].
+        image_shape: Array of shape [B, 2], original (w, h) of every image.
+        image_id: Array of shape [B], image id of every image.
+        ignore_threshold: Float. Candidates scoring below it are dropped.
+
+    Returns:
+        Tuple of flat arrays (image_id, class, xywh, score), class is the continuous class index
+        and xywh is the clipped top-left box in original image pixels.
+    """
+    image_shape = np.asarray(image_shape, dtype=np.float32).reshape(-1, 2)
+    image_id = np.asarray(image_id).reshape(-1).astype(np.int64)
+    batch_idx, cls_idx, boxes, scores = [], [], [], []
+    for out_item in outputs:
+        # [B, gy, gx, anchors, 5+C] -> [B, N, 5+C]
+        out_item = np.asarray(out_item)
+        out_item = out_item.reshape(out_item.shape[0], -1, out_item.shape[-1])
+        cls_emb = out_item[..., 5:]
+        cls_argmax = np.argmax(cls_emb, axis=-1)
+        confidence = np.take_along_axis(cls_emb, cls_argmax[..., None], axis=-1)[..., 0] * out_item[..., 4]
+        b, n = np.nonzero(confidence >= ignore_threshold)
+        batch_idx.append(b)
+        cls_idx.append(cls_argmax[b, n])
+        boxes.append(_to_image_boxes(out_item[b, n, :4], image_shape[b]))
+        scores.append(confidence[b, n])
+    if not outputs:
+        return (np.zeros(0, np.int64), np.zeros(0, np.int64),
+                np.zeros((0, 4), np.float32), np.zeros(0, np.float32))
+    batch_idx = np.concatenate(batch_idx)
+    # keep the image-major, head-minor order of the per-image decode
+    order = np.argsort(batch_idx, kind='stable')
+    return (image_id[batch_idx[order]], np.concatenate(cls_idx)[order],
+            np.concatenate(boxes)[order].astype(np.float32), np.concatenate(scores)[order].astype(np.float32))
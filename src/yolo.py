@@ -13,9 +13,11 @@
 # limitations under the License.
 # ============================================================================
 """YOLOv3 based on DarkNet."""
+import numpy as np
 import mindspore as ms
 import mindspore.nn as nn
 import mindspore.ops as ops
+import mindspore.numpy as mnp
 
 from src.darknet import DarkNet, ResidualBlock
 from src.loss import XYLoss, WHLoss, ConfidenceLoss, ClassLoss
@@ -276,15 +278,18 @@ class DetectionBlock(nn.Cell):
          scale: Character.
          config: Configuration.
          is_training: Bool, Whether train or not, default True.
+         topk: Integer. Boxes per image kept in inference, 0 for the dense output. Default: None, config.detect_topk.
+         score_threshold: Float. Top K boxes scoring below it are zeroed. Default: None, config.eval_ignore_threshold.
 
      Returns:
-         Tuple, tuple of output tensor,(f1,f2,f3).
+         Tuple, tuple of output tensor,(f1,f2,f3). In inference with config.detect_topk > 0, a tensor of shape
+         [batch, K, 6] of [x, y, w, h, score, class] instead, the K highest scoring boxes of every image.
 
      Examples:
          DetectionBlock(scale='l',stride=32,config=config)
      """
 
-    def __init__(self, scale, config=None, is_training=True):
+    def __init__(self, scale, config=None, is_training=True, topk=None, score_threshold=None):
         super(DetectionBlock, self).__init__()
         self.config = config
         if scale == 's':
@@ -305,6 +310,14 @@ class DetectionBlock(nn.Cell):
         self.tile = ops.Tile()
         self.concat = ops.Concat(axis=-1)
         self.conf_training = is_training
+        # score, threshold and select the top K boxes in graph, so only [batch, K, 6] is copied to host
+        if topk is None:
+            topk = self.config.detect_topk
+        self.topk = 0 if is_training else topk
+        self.score_threshold = self.config.eval_ignore_threshold if score_threshold is None else score_threshold
+        self.top_k = ops.TopK(sorted=True)
+        self.argmax_with_value = ops.ArgMaxWithValue(axis=-1)
+        self.gather_d = ops.GatherD()
 
     def construct(self, x, input_shape):
         num_batch = ops.Shape()(x)[0]
@@ -342,7 +355,24 @@ class DetectionBlock(nn.Cell):
         box_probs = prediction[:, :, :, :, 5:]
         box_confidence = self.sigmoid(box_confidence)
         box_probs = self.sigmoid(box_probs)
-        return self.concat((box_xy, box_wh, box_confidence, box_probs))
+        if self.topk == 0:
+            return self.concat((box_xy, box_wh, box_confidence, box_probs))
+        return self.select_topk(box_xy, box_wh, box_confidence, box_probs)
+
+    def select_topk(self, box_xy, box_wh, box_confidence, box_probs):
+        """Score every box by confidence times its best class probability and keep the top K per image."""
+        num_batch = ops.Shape()(box_xy)[0]
+        box_class, class_prob = self.argmax_with_value(box_probs)
+        scores = self.reshape(ops.Squeeze(-1)(box_confidence) * class_prob, (num_batch, -1))
+        # boxes under the threshold score 0 and are dropped on host
+        scores = scores * ops.Cast()(scores >= self.score_threshold, ms.float32)
+        num_boxes = ops.Shape()(scores)[1]
+        top_scores, top_index = self.top_k(scores, min(self.topk, num_boxes))
+        boxes = self.reshape(self.concat((box_xy, box_wh)), (num_batch, num_boxes, 4))
+        top_boxes = self.gather_d(boxes, 1, self.tile(ops.ExpandDims()(top_index, -1), (1, 1, 4)))
+        top_class = self.gather_d(self.reshape(box_class, (num_batch, num_boxes)), 1, top_index)
+        return self.concat((top_boxes, ops.ExpandDims()(top_scores, -1),
+                            ops.ExpandDims()(ops.Cast()(top_class, ms.float32), -1)))
 
 
 class Iou(nn.Cell):
@@ -455,12 +485,99 @@ class YoloLossBlock(nn.Cell):
         return loss / batch_size
 
 
+class SparseTargets(nn.Cell):
+    """
+    Dense targets of one scale scattered on device from the sparse target rows of the pipeline.
+
+    Rows are [scale, gy, gx, anchor, x, y, w, h, class, last] as built by _batch_sparse_targets,
+    rows of other scales and padding scatter zeros. Only the last box of a cell writes its
+    coordinates, confidence and, with label smoothing, its smoothed classes. Without it every box
+    of the cell sets its class, clipped to one. The gt boxes are the kept boxes at their row with
+    zero rows elsewhere, which gives YoloLossBlock the same best IoU as the packed gt boxes.
+
+    Args:
+        scale: Character. 'l', 'm' or 's'.
+        config: Configuration.
+
+    Returns:
+        Tuple of y_true of shape [batch, grid_h, grid_w, 3, 5 + num_classes] and gt_box of shape
+        [batch, max_box, 4].
+
+    Examples:
+        SparseTargets('l', config)
+    """
+    def __init__(self, scale, config=None):
+        super(SparseTargets, self).__init__()
+        if scale not in ('l', 'm', 's'):
+            raise KeyError("Invalid scale value for SparseTargets")
+        # layer index of the scale in the sparse rows
+        self.scale = float(('l', 'm', 's').index(scale))
+        self.num_classes = config.num_classes
+        self.label_smooth = bool(config.label_smooth)
+        self.smooth_on = 1. - config.label_smooth_factor
+        self.smooth_off = config.label_smooth_factor / max(config.num_classes - 1, 1)
+        self.scatter_nd = ops.ScatterNd()
+        self.one_hot = ops.OneHot()
+        self.concat = ops.Concat(axis=-1)
+        self.on_value = ms.Tensor(1.0, ms.float32)
+        self.off_value = ms.Tensor(0.0, ms.float32)
+
+    def construct(self, targets, grid_shape):
+        num_batch, num_rows = ops.Shape()(targets)[0:2]
+        in_scale = ops.Cast()(ops.Equal()(targets[:, :, 0], self.scale), ms.float32)
+        last = ops.ExpandDims()(targets[:, :, 9] * in_scale, -1)
+        # rows of other scales point at cell 0 and add nothing there
+        cells = ops.Cast()(targets[:, :, 1:4] * ops.ExpandDims()(in_scale, -1), ms.int32)
+        batch_index = ops.BroadcastTo((num_batch, num_rows))(ops.ExpandDims()(mnp.arange(num_batch,
+                                                                                        dtype=ms.int32), 1))
+        indices = self.concat((ops.ExpandDims()(batch_index, -1), cells))
+        classes = self.one_hot(ops.Cast()(targets[:, :, 8], ms.int32), self.num_classes, self.on_value,
+                               self.off_value)
+        if self.label_smooth:
+            classes = (classes * self.smooth_on + (1. - classes) * self.smooth_off) * last
+        else:
+            classes = classes * ops.ExpandDims()(in_scale, -1)
+        gt_box = targets[:, :, 4:8] * last
+        updates = self.concat((gt_box, last, classes))
+        y_true = self.scatter_nd(indices, updates, (num_batch,) + grid_shape + (3, 5 + self.num_classes))
+        if not self.label_smooth:
+            y_true = self.concat((y_true[:, :, :, :, :5], ops.Minimum()(y_true[:, :, :, :, 5:], 1.)))
+        return y_true, gt_box
+
+
+class DeviceNormalize(nn.Cell):
+    """
+    Statistic normalization of uint8 HWC batches on device.
+
+    Computes the same (img / 255. - mean) / std as the host pipeline, folded into one multiply and
+    one subtract per channel, and transposes to CHW. The pipeline then ships a quarter of the bytes.
+
+    Returns:
+        Tensor of shape [batch, 3, h, w], float32.
+
+    Examples:
+        DeviceNormalize()
+    """
+    def __init__(self):
+        super(DeviceNormalize, self).__init__()
+        mean = np.array([0.485, 0.456, 0.406], np.float32)
+        std = np.array([0.229, 0.224, 0.225], np.float32)
+        self.scale = ms.Tensor((1. / (255. * std)).reshape(1, 3, 1, 1), ms.float32)
+        self.shift = ms.Tensor((mean / std).reshape(1, 3, 1, 1), ms.float32)
+        self.transpose = ops.Transpose()
+
+    def construct(self, x):
+        x = self.transpose(ops.cast(x, ms.float32), (0, 3, 1, 2))
+        return x * self.scale - self.shift
+
+
 class YOLOV3DarkNet53(nn.Cell):
     """
     Darknet based YOLOV3 network.
 
     Args:
-        is_training: Bool. Whether train or not.
+        is_training: Bool. Whether train or not. With config.device_normalize the training network
+            takes uint8 HWC batches and normalizes them itself.
 
     Returns:
         Cell, cell instance of Darknet based YOLOV3 neural network.
@@ -474,6 +591,9 @@ class YOLOV3DarkNet53(nn.Cell):
         self.config = config
         self.keep_detect = self.config.keep_detect
         self.tenser_to_array = ops.TupleToArray()
+        # eval and export keep the host normalized float32 CHW input
+        self.device_normalize = bool(is_training and self.config.device_normalize)
+        self.normalize = DeviceNormalize()
 
         # YOLOv3 network
         self.feature_map = YOLOv3(backbone=DarkNet(ResidualBlock, self.config.backbone_layers,
@@ -496,6 +616,8 @@ class YOLOV3DarkNet53(nn.Cell):
         backbone_layers: [1, 2, 8, 8, 4]
 
         """
+        if self.device_normalize:
+            x = self.normalize(x)
         input_shape = ops.shape(x)[2:4]
         input_shape = ops.cast(self.tenser_to_array(input_shape), ms.float32)
         big_object_output, medium_object_output, small_object_output, features = self.feature_map(x)
@@ -510,6 +632,89 @@ class YOLOV3DarkNet53(nn.Cell):
         # big is the final output which has smallest feature map
         return output_big, output_me, output_small, seg_road
 
+
+class YOLOV3EndToEnd(nn.Cell):
+    """
+    YOLOV3DarkNet53 with decoding, NMS and mask thresholding in graph, so an exported model outputs final results.
+
+    The wrapper runs the backbone and mask head of network through its own DetectionBlocks, so network itself is
+    left as it is. Every scale keeps its pre_nms_topk best boxes and all of them, or with nms_topk > 0 only the
+    nms_topk best over all scales, go to NMS in descending score order. NMSWithMask needs that order, and a
+    bound caps its mask at nms_topk squared. Boxes are scaled to the original image like DetectionEngine does,
+    classes are shifted apart by a per class offset and one NMSWithMask runs per image. The boxes are fed as [x1, y1, x2 + 1, y2 + 1], which gives NMSWithMask the same +1 pixel IoU
+    as the host NMS.
+
+    Args:
+        network: YOLOV3DarkNet53. Inference network, its parameters are shared and its settings untouched.
+        pre_nms_topk: Integer. Boxes per image and scale kept by DetectionBlock. Default: 1000.
+        max_detections: Integer. Boxes per image in the output. Default: 100.
+        nms_thresh: Float. NMS IoU threshold. Default: 0.5.
+        score_threshold: Float. Boxes scoring below it are dropped. Default: 0.001.
+        mask_threshold: Float. Threshold of the road mask. Default: 0.4.
+        nms_topk: Integer. Boxes per image over all scales fed to NMS, 0 feeds every box. Default: 0.
+
+    Returns:
+        Tuple of detections of shape [batch, max_detections, 6] of [x, y, w, h, score, class], top-left boxes in
+        original image pixels with zero rows as padding, and the uint8 road mask.
+
+    Examples:
+        YOLOV3EndToEnd(YOLOV3DarkNet53(is_training=False))
+    """
+
+    def __init__(self, network, pre_nms_topk=1000, max_detections=100, nms_thresh=0.5, score_threshold=0.001,
+                 mask_threshold=0.4, nms_topk=0):
+        super(YOLOV3EndToEnd, self).__init__()
+        self.network = network
+        self.detect_1, self.detect_2, self.detect_3 = (
+            DetectionBlock(scale, config=network.config, is_training=False, topk=pre_nms_topk,
+                           score_threshold=score_threshold) for scale in ('l', 'm', 's'))
+        self.max_detections = max_detections
+        self.nms_topk = nms_topk
+        self.mask_threshold = mask_threshold
+        self.nms = ops.NMSWithMask(nms_thresh)
+        self.top_k = ops.TopK(sorted=True)
+        self.gather = ops.Gather()
+        self.concat = ops.Concat(axis=-1)
+        self.concat_batch = ops.Concat(axis=0)
+        self.reduce_max = ops.ReduceMax(keep_dims=True)
+
+    def construct(self, x, image_shape):
+        input_shape = ops.cast(ops.tuple_to_array(ops.shape(x)[2:4]), ms.float32)
+        big_object_output, medium_object_output, small_object_output, features = self.network.feature_map(x)
+        seg_road = self.network.unetup(features)
+        output_big = self.detect_1(big_object_output, input_shape)
+        output_me = self.detect_2(medium_object_output, input_shape)
+        output_small = self.detect_3(small_object_output, input_shape)
+        # [batch, 3 * K, 6] of normalized center boxes, score and class
+        dets = ops.Concat(axis=1)((output_small, output_me, output_big))
+        image_wh = ops.ExpandDims()(ops.Cast()(image_shape, ms.float32), 1)
+        wh = dets[:, :, 2:4] * image_wh
+        xy = ops.Maximum()(dets[:, :, 0:2] * image_wh - wh / 2., 0.)
+        wh = ops.Minimum()(wh, image_wh)
+        scores = dets[:, :, 4:5]
+        classes = dets[:, :, 5:6]
+        # boxes of different classes never overlap once shifted by more than the image size
+        offset = classes * (self.reduce_max(image_wh, -1) + 2.)
+        nms_boxes = self.concat((xy + offset, xy + wh + 1. + offset, scores))
+        boxes = self.concat((xy, wh, scores, classes))
+
+        nms_topk = ops.Shape()(dets)[1]
+        if self.nms_topk > 0:
+            nms_topk = min(self.nms_topk, nms_topk)
+        detections = ()
+        for b in range(ops.Shape()(x)[0]):
+            # NMSWithMask keeps boxes greedily in input order, so it gets the best ones sorted
+            nms_scores, nms_index = self.top_k(scores[b, :, 0], nms_topk)
+            _, index, selected = self.nms(self.gather(nms_boxes[b], nms_index, 0))
+            kept_scores = self.gather(nms_scores, index, 0) * ops.Cast()(selected, ms.float32)
+            top_scores, top_index = self.top_k(kept_scores, min(self.max_detections, nms_topk))
+            det = self.gather(boxes[b], self.gather(nms_index, self.gather(index, top_index, 0), 0), 0)
+            # suppressed boxes and the zero score padding of DetectionBlock become zero rows
+            det = det * ops.ExpandDims()(ops.Cast()(top_scores > 0, ms.float32), -1)
+            detections = detections + (ops.ExpandDims()(det, 0),)
+        mask = ops.Cast()(seg_road > self.mask_threshold, ms.uint8)
+        return self.concat_batch(detections), mask
+
 class UnetLossBlock(nn.Cell):
     """
     Loss block cell of YOLOV3 network.
@@ -531,11 +736,38 @@ class YoloWithLossCell(nn.Cell):
         self.loss_me = YoloLossBlock('m', self.config)
         self.loss_small = YoloLossBlock('s', self.config)
         self.unet_loss = UnetLossBlock()
+        # uint8 HWC input of a device normalizing network
+        self.hwc_input = getattr(network, 'device_normalize', False)
+
+    def _input_shape(self, x):
+        input_shape = ops.shape(x)[1:3] if self.hwc_input else ops.shape(x)[2:4]
+        return ops.cast(self.tenser_to_array(input_shape), ms.float32)
 
     def construct(self, x, y_true_0, y_true_1, y_true_2, gt_0, gt_1, gt_2, mask):
-        input_shape = ops.shape(x)[2:4]
-        input_shape = ops.cast(self.tenser_to_array(input_shape), ms.float32)
+        input_shape = self._input_shape(x)
+        yolo_out = self.yolo_network(x)
+        loss_l = self.loss_big(*yolo_out[0], y_true_0, gt_0, input_shape)
+        loss_m = self.loss_me(*yolo_out[1], y_true_1, gt_1, input_shape)
+        loss_s = self.loss_small(*yolo_out[2], y_true_2, gt_2, input_shape)
+        loss_unet = self.unet_loss(yolo_out[3], mask)
+        return loss_l + loss_m + loss_s + loss_unet
+
+
+class YoloWithSparseLossCell(YoloWithLossCell):
+    """YOLOV3 loss on sparse target rows, the dense targets are scattered on device by SparseTargets."""
+    def __init__(self, network, config=default_config):
+        super(YoloWithSparseLossCell, self).__init__(network, config)
+        self.targets_big = SparseTargets('l', self.config)
+        self.targets_me = SparseTargets('m', self.config)
+        self.targets_small = SparseTargets('s', self.config)
+
+    def construct(self, x, targets, mask):
+        input_shape = self._input_shape(x)
         yolo_out = self.yolo_network(x)
+        # prediction is [batch, grid_h, grid_w, 3, num_attrib]
+        y_true_0, gt_0 = self.targets_big(targets, ops.Shape()(yolo_out[0][1])[1:3])
+        y_true_1, gt_1 = self.targets_me(targets, ops.Shape()(yolo_out[1][1])[1:3])
+        y_true_2, gt_2 = self.targets_small(targets, ops.Shape()(yolo_out[2][1])[1:3])
         loss_l = self.loss_big(*yolo_out[0], y_true_0, gt_0, input_shape)
         loss_m = self.loss_me(*yolo_out[1], y_true_1, gt_1, input_shape)
         loss_s = self.loss_small(*yolo_out[2], y_true_2, gt_2, input_shape)
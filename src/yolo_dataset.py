@@ -14,16 +14,21 @@
 # ============================================================================
 """YOLOV3 dataset."""
 import os
-
+import copy
 import multiprocessing
 import cv2
-from PIL import Image
 import numpy as np
-from pycocotools.coco import COCO
 import mindspore.dataset as ds
 
 from src.distributed_sampler import DistributedSampler
-from src.transforms import reshape_fn, MultiScaleTrans
+from src.transforms import MultiScaleTrans, decode_eval_image, normalize_chw
+from src.transforms import statistic_normalize_img as transforms_normalize_img
+from src.coco_cache import load_coco
+from src.annotation_index import load_annotation_index
+from src.fold_manifest import load_fold_manifest
+from src.shard_format import ShardReader, ShardStream
+from src.tile_cache import TileCache
+from src.blank_tile import is_blank_tile
 from mindspore.dataset import CocoDataset
 
 min_keypoints_per_image = 10
@@ -60,21 +65,21 @@ class COCOYoloDataset:
     """YOLOV3 Dataset for COCO."""
     def __init__(self, root, ann_file, cfg=None, remove_images_without_annotations=False,
                  filter_crowd_anno=True, is_training=True):
-        self.coco = COCO(ann_file)
+        self.coco = load_coco(ann_file, use_cache=cfg.coco_cache if cfg is not None else True)
+        self.ann_file = ann_file
         self.root = root
-        self.img_ids = list(sorted(self.coco.imgs.keys()))
         self.filter_crowd_anno = filter_crowd_anno
         self.is_training = is_training
         self.cfg =cfg
+        # decoded tiles kept across epochs, see COCOYoloDatasetWithSeg
+        self.tile_cache = None
+        # boxes of every image precompiled once, __getitem__ only slices it
+        self.index = load_annotation_index(self.coco, ann_file, filter_crowd=filter_crowd_anno,
+                                           use_cache=cfg.annotation_index_cache if cfg is not None else True)
+        self.img_ids = self.index.img_ids.tolist()
         # filter images without any annotations
         if remove_images_without_annotations:
-            img_ids = []
-            for img_id in self.img_ids:
-                ann_ids = self.coco.getAnnIds(imgIds=img_id, iscrowd=None)
-                anno = self.coco.loadAnns(ann_ids)
-                if has_valid_annotation(anno):
-                    img_ids.append(img_id)
-            self.img_ids = img_ids
+            self.img_ids = self.index.img_ids[self.index.valid].tolist()
 
         self.categories = {cat["id"]: cat["name"] for cat in self.coco.cats.values()}
 
@@ -94,57 +99,48 @@ class COCOYoloDataset:
             (img, target) (tuple): target is a dictionary contains "bbox", "segmentation" or "keypoints",
                 generated by the image's annotation. img is a PIL image.
         """
-        coco = self.coco
         img_id = self.img_ids[index]
-        img_path = coco.loadImgs(img_id)[0]["file_name"]
+        position = self.index.position(img_id)
+        img_path = self.index.file_names[position]
         if not self.is_training:
-            img = Image.open(os.path.join(self.root, img_path)).convert("RGB")
-            return img, img_id
+            img, ori_image_shape = self._load_eval_image(img_id, img_path)
+            return img, ori_image_shape, img_id
         img = np.fromfile(os.path.join(self.root, img_path), dtype="int8")
 
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        target = coco.loadAnns(ann_ids)
-        # filter crowd annotations
-        if self.filter_crowd_anno:
-            annos = [anno for anno in target if anno["iscrowd"] == 0]
-        else:
-            annos = [anno for anno in target]
-
-        target = {}
-        boxes = [anno["bbox"] for anno in annos]
-        target["bboxes"] = boxes
-
-        classes = [anno["category_id"] for anno in annos]
-        classes = [self.cat_ids_to_continuous_ids[cl] for cl in classes]
-        target["labels"] = classes
-
-        bboxes = target['bboxes']
-        labels = target['labels']
-        out_target = []
-        for bbox, label in zip(bboxes, labels):
-            tmp = []
-            # convert to [x_min y_min x_max y_max]
-            bbox = self._convetTopDown(bbox)
-            tmp.extend(bbox)
-            tmp.append(int(label))
-            # tmp [x_min y_min x_max y_max, label]
-            out_target.append(tmp)
+        # [x_min y_min x_max y_max, label], crowd boxes already filtered out
+        out_target = self.index.image_boxes(position)
         return img, out_target, [], [], [], [], [], []
 
     def __len__(self):
         return len(self.img_ids)
 
-    def _convetTopDown(self, bbox):
-        x_min = bbox[0]
-        y_min = bbox[1]
-        w = bbox[2]
-        h = bbox[3]
-        return [x_min, y_min, x_min+w, y_min+h]
+    def _load_eval_image(self, img_id, img_path):
+        """Normalized CHW input of an eval tile decoded once, and its original [w, h] from the annotation."""
+        img, _ = decode_eval_image(os.path.join(self.root, img_path), self.cfg.test_img_shape,
+                                   self.cfg.eval_decode_reduce)
+        info = self.coco.imgs[img_id]
+        return img, np.array([info['width'], info['height']], np.int32)
+
 
 class COCOYoloDatasetWithSeg(COCOYoloDataset):
     def __init__(self, *arg, **kwargs):
         super().__init__(*arg, **kwargs)
         self.seg_path= self.cfg.seg_path
+        if self.is_training and self.cfg.tile_cache_mb > 0:
+            # __getitem__ runs in the single generator process, which keeps the cache
+            self.tile_cache = TileCache(self.cfg.tile_cache_mb << 20)
+
+    def _load_decoded(self, img_id, img_path):
+        """Decoded RGB image and mask of a training tile, through the tile cache."""
+        cached = self.tile_cache.get(img_id)
+        if cached is not None:
+            return cached
+        img = cv2.imread(os.path.join(self.root, img_path), cv2.IMREAD_COLOR)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        mask = cv2.imread(os.path.join(self.seg_path, img_path.replace(".tif",".png")), -1)
+        self.tile_cache.put(img_id, img, mask)
+        return img, mask
+
     def __getitem__(self, index):
         """
         Args:
@@ -154,104 +150,81 @@ class COCOYoloDatasetWithSeg(COCOYoloDataset):
             (img, target) (tuple): target is a dictionary contains "bbox", "segmentation" or "keypoints",
                 generated by the image's annotation. img is a PIL image.
         """
-        coco = self.coco
         img_id = self.img_ids[index]
-        img_path = coco.loadImgs(img_id)[0]["file_name"]
-
-        img = np.fromfile(os.path.join(self.root, img_path), dtype="int8")
-        mask_path = os.path.join(self.seg_path, img_path.replace(".tif",".png"))        
+        position = self.index.position(img_id)
+        img_path = self.index.file_names[position]
+        if self.is_training and self.tile_cache is not None:
+            # already decoded, the pipeline skips its Decode
+            img, mask = self._load_decoded(img_id, img_path)
+            return img, self.index.image_boxes(position), [mask], [], [], [], [], [], []
+
+        mask_path = os.path.join(self.seg_path, img_path.replace(".tif",".png"))
         mask = cv2.imread(mask_path, -1)
-        # mask = np.expand_dims(mask,2)
-        # print()
-        # img=np.concatenate((img,mask),2)
         if not self.is_training:
-            img = Image.open(os.path.join(self.root, img_path)).convert("RGB")
-            return img, img_id, [mask]
-        
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        target = coco.loadAnns(ann_ids)
-        # filter crowd annotations
-        if self.filter_crowd_anno:
-            annos = [anno for anno in target if anno["iscrowd"] == 0]
-        else:
-            annos = [anno for anno in target]
-
-        target = {}
-        boxes = [anno["bbox"] for anno in annos]
-        target["bboxes"] = boxes
-
-        classes = [anno["category_id"] for anno in annos]
-        classes = [self.cat_ids_to_continuous_ids[cl] for cl in classes]
-        target["labels"] = classes
-
-        bboxes = target['bboxes']
-        labels = target['labels']
-        out_target = []
-        for bbox, label in zip(bboxes, labels):
-            tmp = []
-            # convert to [x_min y_min x_max y_max]
-            bbox = self._convetTopDown(bbox)
-            tmp.extend(bbox)
-            tmp.append(int(label))
-            # tmp [x_min y_min x_max y_max, label]
-            out_target.append(tmp)
-        # out_target.append()
-        return img, out_target,[mask], [], [], [], [], [], []
+            img, ori_image_shape = self._load_eval_image(img_id, img_path)
+            return img, ori_image_shape, img_id, [mask]
+        img = np.fromfile(os.path.join(self.root, img_path), dtype="int8")
 
-def generate_csv(js_path, csv_path ="./folds.csv", fold_num = 5):
-    coco2 = json.load(open(js_path,'r'))
-    
-    lnth = len(coco2["images"])
-    fold_len = lnth//fold_num
-
-    names = []
-    fold = []
-    ids = []
-    for i, im in enumerate(coco2["images"]):
-        f = i // fold_len
-        names.append(im["file_name"])
-        fold.append(f)
-        ids.append(im['id'])
-
-    with open(csv_path, 'w') as f:
-        f.write('id,name,fold\n')
-        for id, name, fold in zip(ids, names, fold):
-            f.write(str(id)+','+name+','+str(fold)+'\n')
+        # [x_min y_min x_max y_max, label], crowd boxes already filtered out
+        out_target = self.index.image_boxes(position)
+        return img, out_target,[mask], [], [], [], [], [], []
 
 class FoldTrainWithSeg(COCOYoloDatasetWithSeg):
-    def __init__(self, *arg, folds=[0,1,2,3], **kwargs):
+    """COCOYoloDatasetWithSeg restricted to some folds of the fold manifest of its annotation file."""
+    def __init__(self, *arg, folds=None, **kwargs):
         super().__init__(*arg, **kwargs)
-        self.folds = folds if not self.cfg.folds else self.cfg.folds
-        self.folds = set(self.folds)
-        
-        if not self.cfg.fold_csv:
-            generate_csv(self.cfg.ann_file)
-            self.csvpth = './folds.csv' 
-        else:
-            self.csvpth = self.cfg.fold_csv
-        df = pd.read_csv(self.csvpth)
-        img_ids = []
-        
-        for img_id in self.img_ids:
-            f = df[df['id']==img_id]['fold'].tolist()[0]
-            if f in folds:
-                img_ids.append(img_id)
-        self.img_ids = img_ids
+        self.manifest = load_fold_manifest(self.index, self.ann_file, fold_num=self.cfg.fold_num,
+                                           stratify=self.cfg.fold_stratify, fold_csv=self.cfg.fold_csv,
+                                           cache_dir=self.cfg.fold_manifest_dir)
+        self.all_img_ids = self.img_ids
+        self.folds = set(folds if folds is not None else self.cfg.train_folds)
+        self.img_ids = self.manifest.select(self.folds, self.all_img_ids)
+
+    def split(self, folds):
+        """Another split of the same manifest, sharing the loaded annotation and index."""
+        other = copy.copy(self)
+        other.folds = set(folds)
+        other.img_ids = self.manifest.select(other.folds, self.all_img_ids)
+        return other
+
+
+class ShardYoloDatasetWithSeg:
+    """
+    Training samples of COCOYoloDatasetWithSeg streamed from shards packed by pack_shards.py.
+
+    Tiles, masks and boxes are read shard by shard with sequential reads instead of two small
+    files per sample. It is an iterable source, ranks and shuffling are handled by its ShardStream.
+    """
+    def __init__(self, shard_dir, cfg=None, remove_images_without_annotations=True, folds=None,
+                 device_num=1, rank=0, shuffle=True):
+        self.cfg = cfg
+        self.tile_cache = None
+        self.reader = ShardReader(shard_dir)
+        self.index = self.reader.index
+        img_ids = self.index.img_ids
+        if remove_images_without_annotations:
+            img_ids = img_ids[self.index.valid]
+        if folds is not None:
+            manifest = load_fold_manifest(self.index, cfg.annFile, fold_num=cfg.fold_num, stratify=cfg.fold_stratify,
+                                          fold_csv=cfg.fold_csv, cache_dir=cfg.fold_manifest_dir)
+            img_ids = manifest.select(set(folds), img_ids)
+        positions = [self.index.position(img_id) for img_id in np.asarray(img_ids).tolist()]
+        self.stream = ShardStream(self.reader, positions, device_num, rank, shuffle=shuffle,
+                                  read_ahead=cfg.shard_read_ahead if cfg is not None else 2)
+
+    def __iter__(self):
+        for position, img, mask in self.stream:
+            yield img, self.index.image_boxes(position), [mask], [], [], [], [], [], []
 
-        self.categories = {cat["id"]: cat["name"] for cat in self.coco.cats.values()}
+    def __len__(self):
+        return len(self.stream)
 
-        self.cat_ids_to_continuous_ids = {
-            v: i for i, v in enumerate(self.coco.getCatIds())
-        }
-        self.continuous_ids_cat_ids = {
-            v: k for k, v in self.cat_ids_to_continuous_ids.items()
-        }
 
-    
 dataset_dict = {
     "COCOYoloDatasetWithSeg":COCOYoloDatasetWithSeg,
-    "COCOYoloDataset":COCOYoloDataset，
-    "FoldTrainWithSeg":FoldTrainWithSeg
+    "COCOYoloDataset":COCOYoloDataset,
+    "FoldTrainWithSeg":FoldTrainWithSeg,
+    "ShardYoloDatasetWithSeg":ShardYoloDatasetWithSeg
 }
 
 def create_yolo_dataset(image_dir, anno_path, batch_size, device_num, rank,
@@ -265,16 +238,27 @@ def create_yolo_dataset(image_dir, anno_path, batch_size, device_num, rank,
     else:
         filter_crowd = False
         remove_empty_anno = False
-    DataSet = dataset_dict[config.datasettype]
+    DataSet = dataset_dict[config.traindatasettype]
 
-    yolo_dataset = DataSet(root=image_dir, ann_file=anno_path, cfg=config, filter_crowd_anno=filter_crowd,
-                                   remove_images_without_annotations=remove_empty_anno, is_training=is_training)
+    if DataSet is ShardYoloDatasetWithSeg:
+        if not is_training:
+            raise ValueError("ShardYoloDatasetWithSeg only streams training samples.")
+        yolo_dataset = ShardYoloDatasetWithSeg(config.shard_dir, cfg=config, folds=config.train_folds,
+                                               device_num=device_num, rank=rank, shuffle=shuffle)
+    else:
+        yolo_dataset = DataSet(root=image_dir, ann_file=anno_path, cfg=config, filter_crowd_anno=filter_crowd,
+                               remove_images_without_annotations=remove_empty_anno, is_training=is_training)
     hwc_to_chw = ds.vision.HWC2CHW()
 
     config.dataset_size = len(yolo_dataset)
+    # train.py logs its hit rate
+    config.tile_cache = yolo_dataset.tile_cache
     cores = multiprocessing.cpu_count()
     num_parallel_workers = int(cores / device_num)
     distributed_sampler = DistributedSampler(len(yolo_dataset), device_num, rank, shuffle=shuffle)
+    if DataSet is ShardYoloDatasetWithSeg:
+        # an iterable source, it splits the ranks itself
+        distributed_sampler = None
     if is_training:
         multi_scale_trans = MultiScaleTrans(config, device_num)
         dataset_column_names = ["image", "annotation","seg", "bbox1", "bbox2", "bbox3",
@@ -282,20 +266,33 @@ def create_yolo_dataset(image_dir, anno_path, batch_size, device_num, rank,
         # dataset_column_names_out = ["image", "annotation", "bbox1", "bbox2", "bbox3",
         #                         "gt_box1", "gt_box2", "gt_box3","seg"]
         # dataset_column_names = None         
+        output_columns = dataset_column_names
+        if config.sparse_targets:
+            # one [max_box, 10] row block per image instead of the dense grids, see SparseTargets
+            output_columns = ["image", "annotation", "seg", "targets"]
         if device_num != 8:
             dataset = ds.GeneratorDataset(yolo_dataset, column_names=dataset_column_names, sampler=distributed_sampler)
-            dataset = dataset.map(operations=ds.vision.Decode(), input_columns=["image"])
+            if yolo_dataset.tile_cache is None:
+                dataset = dataset.map(operations=ds.vision.Decode(), input_columns=["image"])
             dataset = dataset.batch(batch_size, per_batch_map=multi_scale_trans, input_columns=dataset_column_names,
-                                    num_parallel_workers=min(32, num_parallel_workers), drop_remainder=True)
+                                    output_columns=output_columns, num_parallel_workers=min(32, num_parallel_workers),
+                                    drop_remainder=True)
         else:
             dataset = ds.GeneratorDataset(yolo_dataset, column_names=dataset_column_names, sampler=distributed_sampler)
-            dataset = dataset.map(operations=ds.vision.Decode(), input_columns=["image"])
+            if yolo_dataset.tile_cache is None:
+                dataset = dataset.map(operations=ds.vision.Decode(), input_columns=["image"])
             dataset = dataset.batch(batch_size, per_batch_map=multi_scale_trans, input_columns=dataset_column_names,
-                                    num_parallel_workers=min(8, num_parallel_workers), drop_remainder=True)
+                                    output_columns=output_columns, num_parallel_workers=min(8, num_parallel_workers),
+                                    drop_remainder=True)
     else:
-        valid_dataset = FoldTrainWithSeg(root=image_dir, ann_file=anno_path, cfg=config, filter_crowd_anno=filter_crowd,
-                                   remove_images_without_annotations=remove_empty_anno, is_training=is_training, folds=config.valid_folds)
-        hwc_to_chw = ds.vision.HWC2CHW()
+        if isinstance(yolo_dataset, FoldTrainWithSeg):
+            # same manifest, the annotation is not loaded again
+            valid_dataset = yolo_dataset.split(config.valid_folds)
+        else:
+            valid_dataset = FoldTrainWithSeg(root=image_dir, ann_file=anno_path, cfg=config,
+                                             filter_crowd_anno=filter_crowd,
+                                             remove_images_without_annotations=remove_empty_anno,
+                                             is_training=is_training, folds=config.valid_folds)
         # dataset_column_names
         config.dataset_size = len(yolo_dataset)
         config.valid_dataset_size = len(valid_dataset)
@@ -304,24 +301,16 @@ def create_yolo_dataset(image_dir, anno_path, batch_size, device_num, rank,
         distributed_sampler = DistributedSampler(len(yolo_dataset), device_num, rank, shuffle=shuffle)
 
         # distributed_sampler = DistributedSampler(len(valid_dataset), device_num, rank, shuffle=shuffle)
-        dataset = ds.GeneratorDataset(yolo_dataset, column_names=["image", "img_id", "masks"], sampler=distributed_sampler)
-
-        compose_map_func = (lambda image, img_id, masks: reshape_fn(image, img_id, masks, config))
-        dataset = dataset.map(operations=compose_map_func, input_columns=["image", "img_id","masks"],
-                              output_columns=["image", "image_shape", "img_id", "masks"],
-                              column_order=["image", "image_shape", "img_id", "masks"],
-                              num_parallel_workers=8)
-        dataset = dataset.map(operations=hwc_to_chw, input_columns=["image"], num_parallel_workers=8)
-        # dataset = dataset.map(operations=hwc_to_chw, input_columns=["masks"], num_parallel_workers=8)
+        # decoded, resized and normalized to CHW by the dataset itself
+        dataset = ds.GeneratorDataset(yolo_dataset, column_names=["image", "image_shape", "img_id", "masks"],
+                                      sampler=distributed_sampler, num_parallel_workers=8)
         dataset = dataset.batch(batch_size, drop_remainder=True)
 
     return dataset
 
 def checkvalid(img):
-    unq = np.unique(img)
-    if unq.shape[0]<=2:
-        return False
-    return True
+    """False for blank / nodata tiles of at most two distinct values."""
+    return not is_blank_tile(img)
 
 def statistic_normalize_img(img, idx):
 
@@ -329,18 +318,11 @@ def statistic_normalize_img(img, idx):
 
     """Statistic normalize images."""
     # img: RGB
-    if isinstance(img, Image.Image):
-        img = np.array(img)
-    img = img/255.
-    # Computed from random subset of ImageNet training images
-    mean = np.array([0.485, 0.456, 0.406])
-    std = np.array([0.229, 0.224, 0.225])
-    img = (img - mean) / std
-    return img.astype('float32'), idx, flag
+    return transforms_normalize_img(img, statistic_norm=True), idx, flag
 
 class TestTimeDataset:
     def __init__(self, img_dir, cocofile) -> None:
-        self.coco = COCO(cocofile)
+        self.coco = load_coco(cocofile)
         self.img_dir = img_dir
         self.categories = {cat["id"]: cat["name"] for cat in self.coco.cats.values()}
         self.img_ids = list(sorted(self.coco.imgs.keys()))
@@ -348,25 +330,30 @@ class TestTimeDataset:
         coco = self.coco
         img_id = self.img_ids[index]
         img_path = coco.loadImgs(img_id)[0]["file_name"]
-        img = np.fromfile(os.path.join(self.img_dir, img_path), dtype="uint8")
-        img = Image.open(os.path.join(self.img_dir, img_path)).convert("RGB")
-        return img, img_id
+        img = cv2.imdecode(np.fromfile(os.path.join(self.img_dir, img_path), dtype="uint8"), cv2.IMREAD_COLOR)
+        # one decode feeds both the blank check and the network input
+        flag = checkvalid(img)
+        if not flag:
+            # dropped by create_test_dataset before batching, a one element placeholder instead of a full tile
+            return np.zeros((1, 1, 1), np.float32), img_id, flag
+        return normalize_chw(img, bgr=True), img_id, flag
     def __len__(self):
         return len(self.img_ids)
 
 
-def create_test_dataset(img_dir, cocofile, rank=0, group_size=1):
-    hwc_to_chw = ds.vision.HWC2CHW()
+def create_test_dataset(img_dir, cocofile, rank=0, group_size=1, skip_blank=True):
+    """
+    Test tiles as (image, img_id, flag) batches of one.
+
+    With skip_blank the blank tiles (flag False) are filtered out before batching and never reach
+    the network, the caller emits their empty results from the img_ids it did not get back. Without
+    it blank tiles come with a [1, 1, 1] placeholder image, check the flag before inferring.
+    """
     dataset = TestTimeDataset(img_dir, cocofile)
     distributed_sampler = DistributedSampler(len(dataset), group_size, rank, shuffle=False)
-    compose_map_func = (lambda image, img_id: statistic_normalize_img(image, img_id))
-    dataset = ds.GeneratorDataset(dataset, column_names=["image", "img_id"], sampler=distributed_sampler)
-    # dataset = dataset.map(operations=hwc_to_chw, input_columns=["image"], num_parallel_workers=8)
-    
-    dataset = dataset.map(operations=compose_map_func, input_columns=["image", "img_id"],
-                            output_columns=["image", "img_id", 'flag'], column_order=["image", "img_id", 'flag'],
-                            num_parallel_workers=2)
-    dataset = dataset.map(operations=hwc_to_chw, input_columns=["image"],
-                          num_parallel_workers=2)
-    dataset = dataset.batch(1, drop_remainder=False)         
+    dataset = ds.GeneratorDataset(dataset, column_names=["image", "img_id", "flag"], sampler=distributed_sampler,
+                                  num_parallel_workers=2)
+    if skip_blank:
+        dataset = dataset.filter(predicate=lambda flag: bool(flag), input_columns=["flag"], num_parallel_workers=2)
+    dataset = dataset.batch(1, drop_remainder=False)
     return dataset
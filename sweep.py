@@ -0,0 +1,87 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""YoloV3 NMS / score threshold sweep over cached candidates, the network is never run."""
+import os
+import itertools
+import multiprocessing
+
+from src.nms import batched_nms
+from src.detection_store import DetectionStore
+from src.coco_eval import evaluate_detections
+from src.coco_cache import load_coco
+from src.candidate_cache import candidate_cache_key, candidate_cache_path, load_candidates
+from model_utils.config import config
+
+# shared with the forked sweep workers
+_CANDIDATES = None
+_COCO_GT = None
+
+
+def parse_grid(text):
+    """Comma separated floats, e.g. "0.45,0.5,0.55"."""
+    return [float(value) for value in str(text).split(',') if value.strip()]
+
+
+def run_point(point):
+    """NMS and evaluate the cached candidates at one (nms_thresh, ignore_threshold) point."""
+    nms_thresh, ignore_threshold = point
+    candidates = _CANDIDATES.filter(_CANDIDATES.scores >= ignore_threshold)
+    det_boxes = DetectionStore(max(len(candidates), 1))
+    for img_id, classes, boxes, scores in candidates.iter_images():
+        keep_index = batched_nms(boxes, scores, classes, nms_thresh, config.nms_pre_top_k)
+        det_boxes.append(img_id, classes[keep_index], boxes[keep_index], scores[keep_index])
+    return evaluate_detections(_COCO_GT, det_boxes.to_ndarray())
+
+
+def run_sweep():
+    """Evaluate every point of the sweep grid in a process pool."""
+    global _CANDIDATES, _COCO_GT
+    test_img_shape = config.test_img_shape
+    if config.testing_shape:
+        test_img_shape = [int(config.testing_shape), int(config.testing_shape)]
+    key = candidate_cache_key(config.pretrained, config.annFile, config.data_root, test_img_shape)
+    cache_path = candidate_cache_path(config.candidate_cache_dir, key)
+    if not os.path.isfile(cache_path):
+        raise FileNotFoundError(f"{cache_path} not exists, run eval.py with --cache_candidates=True first.")
+    _CANDIDATES, meta = load_candidates(cache_path)
+    _COCO_GT = load_coco(config.annFile, config.coco_cache)
+    print('loaded {} candidates decoded at ignore threshold {} from {}'.format(
+        len(_CANDIDATES), meta['ignore_threshold'], cache_path))
+
+    nms_grid = parse_grid(config.sweep_nms_thresh)
+    ignore_grid = parse_grid(config.sweep_ignore_threshold)
+    if min(ignore_grid) < meta['ignore_threshold']:
+        raise ValueError("Sweep ignore threshold {} is below the {} the candidates were cached with.".format(
+            min(ignore_grid), meta['ignore_threshold']))
+    points = list(itertools.product(nms_grid, ignore_grid))
+    workers = min(config.sweep_workers or os.cpu_count() or 1, len(points))
+    if workers > 1:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.map(run_point, points, chunksize=1)
+    else:
+        results = [run_point(point) for point in points]
+
+    print('\n=============threshold sweep=========')
+    print('{:>10} {:>16} {:>8} {:>8} {:>8}'.format('nms_thresh', 'ignore_threshold', 'AP', 'AP50', 'AP75'))
+    for (nms_thresh, ignore_threshold), metrics in zip(points, results):
+        print('{:>10.3f} {:>16.4f} {:>8.4f} {:>8.4f} {:>8.4f}'.format(
+            nms_thresh, ignore_threshold, metrics['AP'], metrics['AP50'], metrics['AP75']))
+    best = max(range(len(points)), key=lambda i: results[i]['AP'])
+    print('best AP {:.4f} at nms_thresh {} and eval_ignore_threshold {}'.format(
+        results[best]['AP'], points[best][0], points[best][1]))
+
+
+if __name__ == "__main__":
+    run_sweep()
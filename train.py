@@ -21,7 +21,7 @@ import mindspore as ms
 import mindspore.nn as nn
 import mindspore.communication as comm
 
-from src.yolo import YOLOV3DarkNet53, YoloWithLossCell
+from src.yolo import YOLOV3DarkNet53, YoloWithLossCell, YoloWithSparseLossCell
 from src.logger import get_logger
 from src.util import AverageMeter, get_param_groups, cpu_affinity
 from src.lr_scheduler import get_lr
@@ -140,7 +140,7 @@ def run_train():
     load_yolov3_params(config, network)
     trainable_setting(network, train_backbone=True, train_detect_head=True, train_unetup=False)
 
-    network = YoloWithLossCell(network)
+    network = YoloWithSparseLossCell(network) if config.sparse_targets else YoloWithLossCell(network)
     config.logger.info('finish get network')
 
     if config.training_shape:
@@ -175,20 +175,22 @@ def run_train():
         for step_idx, data in enumerate(data_loader):
             print('batch{}'.format(step_idx))
             images = data["image"]
-            input_shape = images.shape[2:4]
+            input_shape = images.shape[1:3] if config.device_normalize else images.shape[2:4]
             config.logger.info('iter[{}], shape{}'.format(step_idx, input_shape[0]))
             images = ms.Tensor.from_numpy(images)
 
-            batch_y_true_0 = ms.Tensor.from_numpy(data['bbox1'])
-            batch_y_true_1 = ms.Tensor.from_numpy(data['bbox2'])
-            batch_y_true_2 = ms.Tensor.from_numpy(data['bbox3'])
-            batch_gt_box0 = ms.Tensor.from_numpy(data['gt_box1'])
-            batch_gt_box1 = ms.Tensor.from_numpy(data['gt_box2'])
-            batch_gt_box2 = ms.Tensor.from_numpy(data['gt_box3'])
             seg_ann = ms.Tensor.from_numpy(data['seg'])
-
-            loss = network(images, batch_y_true_0, batch_y_true_1, batch_y_true_2, batch_gt_box0, batch_gt_box1,
-                           batch_gt_box2, seg_ann)
+            if config.sparse_targets:
+                loss = network(images, ms.Tensor.from_numpy(data['targets']), seg_ann)
+            else:
+                batch_y_true_0 = ms.Tensor.from_numpy(data['bbox1'])
+                batch_y_true_1 = ms.Tensor.from_numpy(data['bbox2'])
+                batch_y_true_2 = ms.Tensor.from_numpy(data['bbox3'])
+                batch_gt_box0 = ms.Tensor.from_numpy(data['gt_box1'])
+                batch_gt_box1 = ms.Tensor.from_numpy(data['gt_box2'])
+                batch_gt_box2 = ms.Tensor.from_numpy(data['gt_box3'])
+                loss = network(images, batch_y_true_0, batch_y_true_1, batch_y_true_2, batch_gt_box0, batch_gt_box1,
+                               batch_gt_box2, seg_ann)
             loss_meter.update(loss.asnumpy())
 
             # it is used for loss, performance output per config.log_interval steps.
@@ -204,6 +206,8 @@ def run_train():
                 config.logger.info('epoch[{}], iter[{}], {}, fps:{:.2f} imgs/sec, '
                                    'lr:{}, per step time: {}ms'.format(epoch_idx + 1, step_idx + 1,
                                                                        loss_meter, fps, lr[step_idx], per_step_time))
+                if config.tile_cache is not None:
+                    config.logger.info('tile cache: {}'.format(config.tile_cache.report()))
                 t_end = time.time()
                 loss_meter.reset()
             if config.need_profiler:
@@ -220,6 +224,9 @@ def run_train():
         if stop_profiler:
             break
 
+    if config.tile_cache is not None:
+        config.logger.info('tile cache: {}'.format(config.tile_cache.report()))
+        config.tile_cache.close()
     config.logger.info('==========end training===============')
 
 